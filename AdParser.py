@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+#
+# (c) 2020 Yoichi Tanibayashi
+#
+"""
+AD structure parser
+
+parses rawData (bytes or memoryview) into AdStruct(ad_type, payload)
+records without copying. payloads are memoryview slices. typed
+payload decoders use precompiled struct layouts.
+
+a zero length field ends the data (padding). a field longer than the
+remaining data is truncated (strict=False), or AdError (strict=True).
+
+Usage:
+    for (ad_type, payload) in AdParser.parse(dev.rawData):
+        if ad_type == AdParser.MANUFACTURER:
+            (company_id, data) = AdParser.manufacturer(payload)
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__   = '2020'
+
+from collections import namedtuple
+import struct
+from BleUuid import BleUuid
+
+
+AdStruct = namedtuple('AdStruct', ['ad_type', 'payload'])
+
+
+class AdError(ValueError):
+    pass
+
+
+class AdParser:
+    # AD types
+    FLAGS = 0x01
+    INCOMPLETE_16B_SERVICES = 0x02
+    COMPLETE_16B_SERVICES = 0x03
+    INCOMPLETE_32B_SERVICES = 0x04
+    COMPLETE_32B_SERVICES = 0x05
+    INCOMPLETE_128B_SERVICES = 0x06
+    COMPLETE_128B_SERVICES = 0x07
+    SHORT_LOCAL_NAME = 0x08
+    COMPLETE_LOCAL_NAME = 0x09
+    TX_POWER = 0x0a
+    SERVICE_DATA_16B = 0x16
+    SERVICE_DATA_32B = 0x20
+    SERVICE_DATA_128B = 0x21
+    MANUFACTURER = 0xff
+
+    LOCAL_NAME = (SHORT_LOCAL_NAME, COMPLETE_LOCAL_NAME)
+
+    UUID_LIST_SIZE = {
+        INCOMPLETE_16B_SERVICES: 2,
+        COMPLETE_16B_SERVICES: 2,
+        INCOMPLETE_32B_SERVICES: 4,
+        COMPLETE_32B_SERVICES: 4,
+        INCOMPLETE_128B_SERVICES: 16,
+        COMPLETE_128B_SERVICES: 16
+    }
+    SERVICE_DATA_SIZE = {
+        SERVICE_DATA_16B: 2,
+        SERVICE_DATA_32B: 4,
+        SERVICE_DATA_128B: 16
+    }
+
+    _U8 = struct.Struct('<B')
+    _S8 = struct.Struct('<b')
+    _U16 = struct.Struct('<H')
+    _UUID_STRUCT = {2: struct.Struct('<H'), 4: struct.Struct('<I')}
+
+    @staticmethod
+    def offsets(raw, strict=False):
+        '''
+        Returns
+        -------
+        [(ad_type, start, end)]: payload is raw[start:end]
+        '''
+        ret = []
+        n = len(raw)
+        i = 0
+        while i < n:
+            ln = raw[i]
+            if ln == 0:
+                break
+            if i + 1 >= n:
+                if strict:
+                    raise AdError('no AD type at %d' % i)
+                break
+
+            end = i + ln + 1
+            if end > n:
+                if strict:
+                    raise AdError('AD 0x%02x at %d: length %d > %d' % (
+                        raw[i + 1], i, ln, n - i - 1))
+                end = n
+            ret.append((raw[i + 1], i + 2, end))
+            i += ln + 1
+        return ret
+
+    @classmethod
+    def parse(cls, raw, strict=False):
+        '''
+        Returns
+        -------
+        [AdStruct(ad_type, payload)]: payload is memoryview
+        '''
+        if not raw:
+            return []
+        view = memoryview(raw)
+        return [AdStruct(t, view[start:end])
+                for (t, start, end) in cls.offsets(view, strict)]
+
+    @classmethod
+    def find(cls, raw, ad_type):
+        '''
+        Returns
+        -------
+        payload: memoryview of the first ad_type field or None
+        '''
+        if not raw:
+            return None
+        for (t, start, end) in cls.offsets(raw):
+            if t == ad_type:
+                return memoryview(raw)[start:end]
+        return None
+
+    @classmethod
+    def has_type(cls, raw, ad_type):
+        if not raw:
+            return False
+        for (t, start, end) in cls.offsets(raw):
+            if t == ad_type:
+                return True
+        return False
+
+    #
+    # payload decoders. AdError for a short payload
+    #
+    @classmethod
+    def flags(cls, payload):
+        if len(payload) < 1:
+            raise AdError('Flags: empty')
+        return cls._U8.unpack_from(payload)[0]
+
+    @classmethod
+    def tx_power(cls, payload):
+        if len(payload) < 1:
+            raise AdError('Tx Power: empty')
+        return cls._S8.unpack_from(payload)[0]
+
+    @staticmethod
+    def name(payload):
+        '''
+        Local Name. invalid UTF-8 bytes are replaced
+        '''
+        return bytes(payload).decode('utf-8', errors='replace')
+
+    @classmethod
+    def manufacturer(cls, payload):
+        '''
+        Returns
+        -------
+        (company_id, data): (int, memoryview)
+        '''
+        if len(payload) < 2:
+            raise AdError('Manufacturer: %d bytes' % len(payload))
+        return (cls._U16.unpack_from(payload)[0], payload[2:])
+
+    @classmethod
+    def uuid_list(cls, ad_type, payload):
+        '''
+        Returns
+        -------
+        [BleUuid]: trailing bytes not forming a UUID are ignored
+        '''
+        size = cls.UUID_LIST_SIZE[ad_type]
+        n = len(payload) - len(payload) % size
+
+        st = cls._UUID_STRUCT.get(size)
+        if st is not None:
+            return [BleUuid(v) for (v,) in st.iter_unpack(payload[:n])]
+        return [BleUuid.from_le(payload[j:j + size])
+                for j in range(0, n, size)]
+
+    @classmethod
+    def service_data(cls, ad_type, payload):
+        '''
+        Returns
+        -------
+        (uuid, data): (BleUuid, memoryview)
+        '''
+        size = cls.SERVICE_DATA_SIZE[ad_type]
+        if len(payload) < size:
+            raise AdError('Service Data: %d bytes' % len(payload))
+        return (BleUuid.from_le(payload[:size]), payload[size:])
+
+    @classmethod
+    def dump(cls, raw):
+        '''
+        Returns
+        -------
+        lines: list of str, '<len>:<type> <hex>' for each field
+        '''
+        ret = []
+        for (t, start, end) in cls.offsets(raw):
+            ret.append('%02x:%02x %s' % (end - start + 1, t,
+                                         bytes(raw[start:end]).hex()))
+        return ret
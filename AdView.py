@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+#
+# (c) 2020 Yoichi Tanibayashi
+#
+"""
+Lazy view of AD structures
+
+field offsets are indexed once on first access, and a field is decoded
+only when it is accessed. values are memoryview slices of rawData.
+
+Usage:
+    view = AdView.of(dev)   # dev: btle.ScanEntry
+    view.name               # Local Name (str) or None
+    view.flags              # int or None
+    view.service_uuids()    # ['0000180f-0000-1000-8000-00805f9b34fb', ..]
+    view.service_data()     # {uuid(str): bytes}
+    view.manufacturer       # (company_id, bytes) or None
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__   = '2020'
+
+from bluepy import btle
+import binascii
+from AdParser import AdParser, AdError
+
+
+class AdView:
+    '''
+    AD types are AdParser.FLAGS, ..
+    '''
+    # description (same as getScanData()) -> AD type
+    TYPE_BY_DESC = {v: k for k, v in btle.ScanEntry.dataTags.items()}
+
+    __slots__ = ('_raw', '_fallback', '_index')
+
+    def __init__(self, raw, fallback=None):
+        '''
+        raw: bytes (AD structures)
+        fallback: {ad_type: bytes} for the fields not in raw
+          ex. ScanEntry.scanData, that includes the last SCAN_RSP
+        '''
+        self._raw = memoryview(raw or b'')
+        self._fallback = fallback
+        self._index = None
+
+    @classmethod
+    def of(cls, dev):
+        '''
+        dev: btle.ScanEntry
+        '''
+        return cls(dev.rawData, dev.scanData)
+
+    def _build_index(self):
+        '''
+        Returns
+        -------
+        index: {ad_type: [(start, end), ..]}
+        '''
+        index = {}
+        for (ad_type, start, end) in AdParser.offsets(self._raw):
+            index.setdefault(ad_type, []).append((start, end))
+
+        self._index = index
+        return index
+
+    def types(self):
+        '''
+        AD types in raw and fallback
+        '''
+        index = self._index
+        if index is None:
+            index = self._build_index()
+
+        ret = list(index.keys())
+        if self._fallback:
+            ret += [t for t in self._fallback if t not in index]
+        return ret
+
+    def __contains__(self, ad_type):
+        return self.get(ad_type) is not None
+
+    def get(self, ad_type):
+        '''
+        Returns
+        -------
+        val: memoryview, bytes or None
+          first field of ad_type
+        '''
+        index = self._index
+        if index is None:
+            index = self._build_index()
+
+        pos = index.get(ad_type)
+        if pos is not None:
+            (start, end) = pos[0]
+            return self._raw[start:end]
+
+        if self._fallback:
+            return self._fallback.get(ad_type)
+        return None
+
+    def get_all(self, ad_type):
+        '''
+        all fields of ad_type (ex. multiple Service Data)
+        '''
+        index = self._index
+        if index is None:
+            index = self._build_index()
+
+        pos = index.get(ad_type)
+        if pos is not None:
+            return [self._raw[start:end] for (start, end) in pos]
+
+        if self._fallback and ad_type in self._fallback:
+            return [self._fallback[ad_type]]
+        return []
+
+    def items(self):
+        '''
+        (ad_type, val) for each AD type
+        '''
+        return [(t, self.get(t)) for t in self.types()]
+
+    @property
+    def name(self):
+        '''
+        Complete or Shortened Local Name
+        '''
+        val = self.get(AdParser.COMPLETE_LOCAL_NAME)
+        if val is None:
+            val = self.get(AdParser.SHORT_LOCAL_NAME)
+            if val is None:
+                return None
+        return self.decode_name(val)
+
+    @property
+    def flags(self):
+        val = self.get(AdParser.FLAGS)
+        if val is None or len(val) == 0:
+            return None
+        return AdParser.flags(val)
+
+    @property
+    def manufacturer(self):
+        '''
+        Returns
+        -------
+        (company_id, data): (int, bytes) or None
+        '''
+        val = self.get(AdParser.MANUFACTURER)
+        if val is None or len(val) < 2:
+            return None
+        (company_id, data) = AdParser.manufacturer(val)
+        return (company_id, bytes(data))
+
+    def service_uuids(self):
+        '''
+        Returns
+        -------
+        uuids: list of str (128 bit form, same as str(btle.UUID))
+        '''
+        ret = []
+        for ad_type in AdParser.UUID_LIST_SIZE:
+            for val in self.get_all(ad_type):
+                ret += [str(u) for u in AdParser.uuid_list(ad_type, val)]
+        return ret
+
+    def service_data(self):
+        '''
+        Returns
+        -------
+        data: {uuid(str): bytes}
+        '''
+        ret = {}
+        for ad_type in AdParser.SERVICE_DATA_SIZE:
+            for val in self.get_all(ad_type):
+                try:
+                    (uuid, data) = AdParser.service_data(ad_type, val)
+                except AdError:
+                    continue
+                ret[str(uuid)] = bytes(data)
+        return ret
+
+    def text(self, ad_type, val=None):
+        '''
+        same as ScanEntry.getValueText()
+        '''
+        if val is None:
+            val = self.get(ad_type)
+            if val is None:
+                return None
+
+        if ad_type in AdParser.LOCAL_NAME:
+            return self.decode_name(val)
+
+        if ad_type in AdParser.UUID_LIST_SIZE:
+            return ','.join([str(u)
+                             for u in AdParser.uuid_list(ad_type, val)])
+
+        return binascii.b2a_hex(val).decode('ascii')
+
+    @staticmethod
+    def description(ad_type):
+        '''
+        same as ScanEntry.getDescription()
+        '''
+        return btle.ScanEntry.dataTags.get(ad_type, hex(ad_type))
+
+    @staticmethod
+    def decode_name(val):
+        try:
+            return str(val, 'utf-8')
+        except UnicodeDecodeError:
+            return ''.join([chr(x) if 32 <= x <= 127 else '?' for x in val])
@@ -0,0 +1,575 @@
+#!/usr/bin/env python3
+#
+# (c) 2020 Yoichi Tanibayashi
+#
+"""
+Columnar advertisement archive (Parquet)
+
+layout:
+  <root>/YYYY-MM-DD/HH/<first ms>-<last ms>-<pid>.parquet  (UTC hour)
+
+columns:
+  time(double) addr(dictionary<string>) addr_type(uint8) rssi(int8)
+  adv_type(uint8) data(binary, AD structures)
+
+records are buffered by column, and written as a row group when 'batch'
+records are buffered or 'flush_interval' sec passed, also while no
+record comes (flush thread). a file is closed after 'roll_row_groups'
+row groups or 'roll_interval' sec, at the end of the hour (partition)
+or close(), and the addresses in the file are stored in the footer.
+only closed files are queried, and a crash loses the records after
+the last closed file.
+
+a query is pruned by
+  partition: hour directories out of the time range
+  file:      time range in the file name, and addresses in the footer
+  row group: min/max statistics of time and addr
+so the files and row groups without the records are not read.
+
+Usage:
+    # archive
+    writer = AdvArchiveWriter('adv_archive')
+    scanner = btle.Scanner(0).withDelegate(
+        AdvLogDelegate(writer, ScanDelegate(..)))
+    ..
+    writer.close()
+
+    # query
+    reader = AdvArchiveReader('adv_archive')
+    table = reader.query(addrs=['ac:23:3f:a0:01:02'],
+                         start=time.time() - 7 * 24 * 3600)
+    for rec in reader.records(start=.., end=..):  # AdvRecord
+        ..
+
+pyarrow is optional ('pip install pyarrow').
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__   = '2020'
+
+import calendar
+import datetime
+import json
+import threading
+import time
+import os
+import click
+try:
+    import pyarrow
+    import pyarrow.compute
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+from AdvLog import AdvLog, AdvLogReader, AdvRecord
+from MyLogger import get_logger
+CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
+
+
+class AdvArchive:
+    PARTITION = 3600  # sec
+    SUFFIX = '.parquet'
+    TMP_SUFFIX = '.tmp'
+
+    COLUMNS = AdvRecord._fields
+    META_ADDRS = b'addrs'
+
+    _schema = None
+
+    @staticmethod
+    def check():
+        if pyarrow is None:
+            raise RuntimeError('pyarrow is not installed')
+
+    @classmethod
+    def schema(cls):
+        if cls._schema is None:
+            cls.check()
+            pa = pyarrow
+            cls._schema = pa.schema([
+                ('time', pa.float64()),
+                ('addr', pa.dictionary(pa.int32(), pa.string())),
+                ('addr_type', pa.uint8()),
+                ('rssi', pa.int8()),
+                ('adv_type', pa.uint8()),
+                ('data', pa.binary())
+            ])
+        return cls._schema
+
+    @classmethod
+    def partition(cls, ts):
+        '''
+        Returns
+        -------
+        partition: int, start time // PARTITION
+        '''
+        return int(ts // cls.PARTITION)
+
+    @classmethod
+    def partition_dir(cls, root, part):
+        return os.path.join(root, time.strftime(
+            '%Y-%m-%d' + os.sep + '%H', time.gmtime(part * cls.PARTITION)))
+
+    @classmethod
+    def file_name(cls, first, last):
+        return '%d-%d-%d%s' % (first * 1000, last * 1000, os.getpid(),
+                               cls.SUFFIX)
+
+    @classmethod
+    def file_range(cls, name):
+        '''
+        Returns
+        -------
+        (first, last): sec, or None if not an archive file
+        '''
+        if not name.endswith(cls.SUFFIX):
+            return None
+        try:
+            (first, last, _) = name[:-len(cls.SUFFIX)].split('-')
+            return (int(first) / 1000, (int(last) + 1) / 1000)
+        except ValueError:
+            return None
+
+
+class AdvArchiveWriter(AdvArchive):
+    DEF_BATCH = 4096          # records per row group
+    DEF_FLUSH_INTERVAL = 60   # sec
+    DEF_ROLL_ROW_GROUPS = 5   # row groups per file
+    DEF_ROLL_INTERVAL = 300   # sec, max age of a file
+    DEF_COMPRESSION = 'zstd'
+
+    _log = None
+
+    def __init__(self, root, batch=DEF_BATCH,
+                 flush_interval=DEF_FLUSH_INTERVAL,
+                 roll_row_groups=DEF_ROLL_ROW_GROUPS,
+                 roll_interval=DEF_ROLL_INTERVAL,
+                 compression=DEF_COMPRESSION, debug=False):
+        '''
+        root: archive directory
+        flush_interval: sec, 0 for every record
+        roll_row_groups: row groups per file, 0 for no limit
+        roll_interval: sec, max age of a file, 0 for no limit
+        '''
+        self._dbg = debug
+        __class__._log = get_logger(__class__.__name__, self._dbg)
+        self._log.debug('root=%s, batch=%s, flush_interval=%s',
+                        root, batch, flush_interval)
+        self._log.debug('roll_row_groups=%s, roll_interval=%s',
+                        roll_row_groups, roll_interval)
+        self._log.debug('compression=%s', compression)
+
+        self.check()
+
+        self._root = root
+        self._batch = batch
+        self._flush_interval = flush_interval
+        self._roll_row_groups = roll_row_groups
+        self._roll_interval = roll_interval
+        self._compression = compression
+
+        self._cols = tuple([[] for _ in self.COLUMNS])
+        self._flush_time = time.time()
+        self._lock = threading.Lock()
+
+        # current file
+        self._part = None
+        self._pq = None
+        self._tmp_path = None
+        self._open_time = None
+        self._row_groups = 0
+        self._first = None
+        self._last = None
+        self._addrs = set()
+
+        self.count = 0
+        self.stat = {'row_group': 0, 'file': 0}
+
+        self._closed = threading.Event()
+        self._flusher = None
+        if self._flush_interval > 0:
+            self._flusher = threading.Thread(target=self._flush_loop,
+                                             daemon=True)
+            self._flusher.start()
+
+    def write(self, ts, addr, addr_type, rssi, adv_type, data):
+        '''
+        the same arguments as AdvLogWriter.write()
+        '''
+        with self._lock:
+            part = self.partition(ts)
+            if part != self._part:
+                self._flush()
+                self._close_file()
+                self._part = part
+
+            for (col, val) in zip(self._cols, (ts, addr, addr_type, rssi,
+                                               adv_type, data)):
+                col.append(val)
+            self.count += 1
+
+            if len(self._cols[0]) >= self._batch or \
+               time.time() - self._flush_time >= self._flush_interval:
+                self._flush()
+
+    def write_entry(self, dev, ts=None):
+        '''
+        dev: btle.ScanEntry (or AdvEntry)
+        '''
+        self.write(*AdvLog.record(dev, ts))
+
+    def _flush_loop(self):
+        '''
+        flush thread: 'flush_interval' sec after the last flush
+        '''
+        timeout = self._flush_interval
+        while not self._closed.wait(timeout):
+            with self._lock:
+                timeout = self._flush_time + self._flush_interval - time.time()
+                if timeout <= 0:
+                    self._flush()
+                    timeout = self._flush_interval
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        self._flush_time = time.time()
+        if len(self._cols[0]) > 0:
+            self._write_row_group()
+
+        # the flushed row groups are lost by a crash until closed
+        if self._pq is not None and \
+           ((self._roll_row_groups and
+             self._row_groups >= self._roll_row_groups) or
+            (self._roll_interval and
+             self._flush_time - self._open_time >= self._roll_interval)):
+            self._close_file()
+
+    def _write_row_group(self):
+        pa = pyarrow
+        (ts, addr, addr_type, rssi, adv_type, data) = self._cols
+        table = pa.Table.from_arrays([
+            pa.array(ts, pa.float64()),
+            pa.array(addr, pa.string()).dictionary_encode(),
+            pa.array(addr_type, pa.uint8()),
+            pa.array(rssi, pa.int8()),
+            pa.array(adv_type, pa.uint8()),
+            pa.array([bytes(d) for d in data], pa.binary())
+        ], schema=self.schema())
+        self._cols = tuple([[] for _ in self.COLUMNS])
+
+        if self._pq is None:
+            self._open_file()
+
+        self._pq.write_table(table, row_group_size=len(table))
+        self._row_groups += 1
+        self.stat['row_group'] += 1
+
+        self._first = min(ts) if self._first is None \
+            else min(self._first, min(ts))
+        self._last = max(ts) if self._last is None \
+            else max(self._last, max(ts))
+        self._addrs.update(addr)
+
+    def _open_file(self):
+        part_dir = self.partition_dir(self._root, self._part)
+        os.makedirs(part_dir, exist_ok=True)
+
+        # hidden until closed
+        self._tmp_path = os.path.join(part_dir, '.%d-%d%s' % (
+            time.time() * 1000, os.getpid(), self.TMP_SUFFIX))
+        self._log.debug('tmp_path=%s', self._tmp_path)
+        self._open_time = time.time()
+        self._row_groups = 0
+
+        self._pq = pyarrow.parquet.ParquetWriter(
+            self._tmp_path, self.schema(), compression=self._compression)
+
+    def _close_file(self):
+        if self._pq is None:
+            return
+
+        # addresses in the file, for pruning in queries
+        add_meta = getattr(self._pq, 'add_key_value_metadata', None)
+        if add_meta is not None:
+            add_meta({self.META_ADDRS: json.dumps(sorted(self._addrs))})
+
+        self._pq.close()
+
+        # the previous file of the same time range is not replaced
+        part_dir = os.path.dirname(self._tmp_path)
+        last = self._last
+        path = os.path.join(part_dir, self.file_name(self._first, last))
+        while os.path.exists(path):
+            last += 0.001
+            path = os.path.join(part_dir, self.file_name(self._first, last))
+        os.replace(self._tmp_path, path)
+        self._log.debug('%s: %d addrs', path, len(self._addrs))
+        self.stat['file'] += 1
+
+        self._pq = None
+        self._tmp_path = None
+        self._open_time = None
+        self._row_groups = 0
+        self._first = None
+        self._last = None
+        self._addrs = set()
+
+    def close(self):
+        self._log.debug('count=%d, stat=%s', self.count, self.stat)
+        self._closed.set()
+        if self._flusher is not None:
+            self._flusher.join()
+
+        with self._lock:
+            self._flush()
+            self._close_file()
+
+
+class AdvArchiveReader(AdvArchive):
+    _log = None
+
+    def __init__(self, root, debug=False):
+        self._dbg = debug
+        __class__._log = get_logger(__class__.__name__, self._dbg)
+        self._log.debug('root=%s', root)
+
+        self.check()
+
+        self._root = root
+        self.clear_stat()
+
+    def clear_stat(self):
+        self.stat = {'partition': 0, 'file': 0, 'pruned_file': 0,
+                     'row_group': 0, 'pruned_row_group': 0}
+
+    def _listdir(self, d):
+        if not os.path.isdir(d):
+            return []
+        return sorted(os.listdir(d))
+
+    def partitions(self, start=None, end=None):
+        '''
+        Returns
+        -------
+        dirs: partition directories overlapping [start, end), in order
+        '''
+        first = None if start is None else self.partition(start)
+        last = None if end is None else self.partition(end)
+
+        ret = []
+        for day in self._listdir(self._root):
+            for hour in self._listdir(os.path.join(self._root, day)):
+                try:
+                    part = self.partition(calendar.timegm(time.strptime(
+                        day + ' ' + hour, '%Y-%m-%d %H')))
+                except ValueError:
+                    continue
+                if (first is not None and part < first) or \
+                   (last is not None and part > last):
+                    continue
+                ret.append(os.path.join(self._root, day, hour))
+        return ret
+
+    def files(self, start=None, end=None):
+        '''
+        Returns
+        -------
+        paths: closed files overlapping [start, end)
+        '''
+        ret = []
+        for d in self.partitions(start, end):
+            self.stat['partition'] += 1
+            for name in sorted(os.listdir(d)):
+                rng = self.file_range(name)
+                if rng is None:
+                    continue
+                if (start is not None and rng[1] <= start) or \
+                   (end is not None and rng[0] >= end):
+                    self.stat['pruned_file'] += 1
+                    continue
+                ret.append(os.path.join(d, name))
+        return ret
+
+    def _file_addrs(self, meta):
+        kv = meta.metadata or {}
+        addrs = kv.get(self.META_ADDRS)
+        if addrs is None:
+            return None
+        return set(json.loads(addrs))
+
+    @staticmethod
+    def _stat_range(rg, i):
+        st = rg.column(i).statistics
+        if st is None or not st.has_min_max:
+            return None
+        return (st.min, st.max)
+
+    def _row_groups(self, meta, addrs, start, end):
+        '''
+        Returns
+        -------
+        [index]: row groups which may have the records
+        '''
+        i_time = self.COLUMNS.index('time')
+        i_addr = self.COLUMNS.index('addr')
+
+        ret = []
+        for i in range(meta.num_row_groups):
+            rg = meta.row_group(i)
+
+            rng = self._stat_range(rg, i_time)
+            if rng is not None and \
+               ((start is not None and rng[1] < start) or
+                    (end is not None and rng[0] >= end)):
+                self.stat['pruned_row_group'] += 1
+                continue
+
+            rng = self._stat_range(rg, i_addr)
+            if rng is not None and addrs is not None and \
+               not any([rng[0] <= a <= rng[1] for a in addrs]):
+                self.stat['pruned_row_group'] += 1
+                continue
+
+            ret.append(i)
+        return ret
+
+    def query(self, addrs=None, start=None, end=None, columns=None):
+        '''
+        addrs: addresses, None for all
+        start, end: time range [start, end), None for no limit
+        columns: column names, None for all
+
+        Returns
+        -------
+        table: pyarrow.Table, in the order of time of the files
+        '''
+        self._log.debug('addrs=%s, start=%s, end=%s, columns=%s',
+                        addrs, start, end, columns)
+
+        pc = pyarrow.compute
+        self.clear_stat()
+
+        if addrs is not None:
+            addrs = set([a.lower() for a in addrs])
+
+        read_columns = None
+        if columns is not None:
+            read_columns = list(columns)
+            for c in ('time', 'addr'):
+                if c not in read_columns:
+                    read_columns.append(c)
+
+        tables = []
+        for path in self.files(start, end):
+            pf = pyarrow.parquet.ParquetFile(path)
+            meta = pf.metadata
+
+            file_addrs = self._file_addrs(meta)
+            if addrs is not None and file_addrs is not None and \
+               file_addrs.isdisjoint(addrs):
+                self.stat['pruned_file'] += 1
+                continue
+            self.stat['file'] += 1
+
+            row_groups = self._row_groups(meta, addrs, start, end)
+            if len(row_groups) == 0:
+                continue
+            self.stat['row_group'] += len(row_groups)
+
+            table = pf.read_row_groups(row_groups, columns=read_columns)
+
+            mask = None
+            if start is not None:
+                mask = pc.greater_equal(table['time'], start)
+            if end is not None:
+                m = pc.less(table['time'], end)
+                mask = m if mask is None else pc.and_(mask, m)
+            if addrs is not None:
+                m = pc.is_in(table['addr'].cast(pyarrow.string()),
+                             value_set=pyarrow.array(sorted(addrs),
+                                                     pyarrow.string()))
+                mask = m if mask is None else pc.and_(mask, m)
+            if mask is not None:
+                table = table.filter(mask)
+
+            if columns is not None:
+                table = table.select(list(columns))
+            tables.append(table)
+
+        self._log.debug('stat=%s', self.stat)
+        if len(tables) == 0:
+            schema = self.schema()
+            if columns is not None:
+                schema = pyarrow.schema([schema.field(c) for c in columns])
+            return schema.empty_table()
+        return pyarrow.concat_tables(tables)
+
+    def records(self, addrs=None, start=None, end=None):
+        '''
+        Returns
+        -------
+        AdvRecord iterator
+        '''
+        table = self.query(addrs, start, end)
+        for batch in table.to_batches():
+            cols = [batch.column(c).to_pylist() for c in self.COLUMNS]
+            for rec in zip(*cols):
+                yield AdvRecord(*rec)
+
+
+def parse_time(s):
+    '''
+    epoch sec, or ISO format local time ('2020-10-18 12:00')
+    '''
+    if s is None:
+        return None
+    try:
+        return float(s)
+    except ValueError:
+        return datetime.datetime.fromisoformat(s).timestamp()
+
+
+@click.command(context_settings=CONTEXT_SETTINGS, help='''
+Advertisement archive query
+''')
+@click.argument('root', type=click.Path())
+@click.argument('addrs', type=str, nargs=-1)
+@click.option('--start', '-s', 'start', type=str, default=None,
+              help='start time (epoch sec or "YYYY-MM-DD HH:MM[:SS]")')
+@click.option('--end', '-e', 'end', type=str, default=None,
+              help='end time (epoch sec or "YYYY-MM-DD HH:MM[:SS]")')
+@click.option('--import', '-I', 'import_log', type=click.Path(exists=True),
+              default=None,
+              help='import an advertisement log (AdvLog) into ROOT')
+@click.option('--debug', '-d', 'debug', is_flag=True, default=False,
+              help='debug flag')
+def main(root, addrs, start, end, import_log, debug):
+    logger = get_logger(__name__, debug)
+    logger.debug('root=%s, addrs=%s, start=%s, end=%s',
+                 root, addrs, start, end)
+    logger.debug('import_log=%s', import_log)
+
+    if import_log is not None:
+        writer = AdvArchiveWriter(root, debug=debug)
+        try:
+            for rec in AdvLogReader(import_log, debug=debug):
+                writer.write(*rec)
+        finally:
+            writer.close()
+        logger.info('%d records', writer.count)
+        return
+
+    reader = AdvArchiveReader(root, debug=debug)
+    count = 0
+    for rec in reader.records(addrs or None, parse_time(start),
+                              parse_time(end)):
+        print('%.3f [%s](%d) %d dBm type=%d %s' % (
+            rec.time, rec.addr, rec.addr_type, rec.rssi, rec.adv_type,
+            rec.data.hex()))
+        count += 1
+    logger.info('%d records: %s', count, reader.stat)
+
+
+if __name__ == '__main__':
+    main()
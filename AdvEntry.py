@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+#
+# (c) 2020 Yoichi Tanibayashi
+#
+"""
+bluepy ScanEntry built from raw advertising data
+
+for the scanner backends that do not use bluepy-helper
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__   = '2020'
+
+from bluepy import btle
+
+
+class AdvEntry(btle.ScanEntry):
+    # HCI LE Advertising Report: Event_Type
+    ADV_IND = 0x00
+    ADV_DIRECT_IND = 0x01
+    ADV_SCAN_IND = 0x02
+    ADV_NONCONN_IND = 0x03
+    SCAN_RSP = 0x04
+
+    # HCI LE Advertising Report: Address_Type
+    ADDR_TYPE = {
+        0x00: btle.ADDR_TYPE_PUBLIC,
+        0x01: btle.ADDR_TYPE_RANDOM,
+        0x02: btle.ADDR_TYPE_PUBLIC,  # Public Identity Address
+        0x03: btle.ADDR_TYPE_RANDOM   # Random (static) Identity Address
+    }
+
+    def __init__(self, addr, iface=0):
+        super().__init__(addr, iface)
+        self.advType = None
+
+    def update(self, addr_type, rssi, adv_type, data):
+        '''
+        addr_type: HCI Address_Type (int)
+        rssi: int (dBm)
+        adv_type: HCI Event_Type (int)
+        data: bytes (AD structures)
+
+        Returns
+        -------
+        isNewData: bool
+        '''
+        self.addrType = self.ADDR_TYPE.get(addr_type, btle.ADDR_TYPE_RANDOM)
+        self.rssi = rssi
+        self.advType = adv_type
+        if adv_type != self.SCAN_RSP:
+            self.connectable = adv_type in (self.ADV_IND,
+                                            self.ADV_DIRECT_IND)
+        self.rawData = data
+
+        isNewData = False
+        i = 0
+        n = len(data)
+        while i + 1 < n:
+            sdlen = data[i]
+            if sdlen == 0:
+                break
+            sdid = data[i + 1]
+            val = data[i + 2:i + sdlen + 1]
+            if self.scanData.get(sdid) != val:
+                isNewData = True
+                self.scanData[sdid] = val
+            i += sdlen + 1
+
+        self.updateCount += 1
+        return isNewData
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+#
+# (c) 2020 Yoichi Tanibayashi
+#
+"""
+Compiled advertisement filter
+
+evaluated on the address string and raw AD bytes (ScanEntry.rawData),
+before any decoding. an advertisement matches if any criterion matches.
+an empty filter matches everything.
+
+Usage:
+    f = AdvFilter(addrs=['aa:bb:cc:dd:ee:ff'], ouis=['ac:23:3f'],
+                  names=['MyESP*'], uuids=['180f'], companies=[0x004c],
+                  svc_data=['ffe1'])
+    if f.match(dev.addr, dev.rawData):
+        ..
+
+    # also the data of the other packet (ADV_IND or SCAN_RSP)
+    if f.match_dev(dev):
+        ..
+
+with RpaResolver, addrs and ouis are also matched with the identity
+of a resolvable private address:
+
+    f = AdvFilter(addrs=['aa:bb:cc:dd:ee:ff'], resolver=RpaResolver(..))
+    if f.match(dev.addr, dev.rawData):
+        ..
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__   = '2020'
+
+import fnmatch
+import struct
+import re
+from AdParser import AdParser
+from BleUuid import BleUuid
+from MyLogger import get_logger
+
+
+class PrefixTrie:
+    '''
+    prefix set for str or bytes
+    '''
+    _END = None
+
+    def __init__(self, prefixes=()):
+        self._root = {}
+        self.size = 0
+        for p in prefixes:
+            self.add(p)
+
+    def add(self, prefix):
+        node = self._root
+        for c in prefix:
+            node = node.setdefault(c, {})
+        node[self._END] = True
+        self.size += 1
+
+    def match(self, s):
+        '''
+        True if s starts with any prefix
+        '''
+        node = self._root
+        for c in s:
+            if self._END in node:
+                return True
+            node = node.get(c)
+            if node is None:
+                return False
+        return self._END in node
+
+
+class AdvFilter:
+    _log = None
+
+    def __init__(self, addrs=(), ouis=(), names=(), uuids=(), companies=(),
+                 svc_data=(), resolver=None, debug=False):
+        '''
+        addrs: exact addresses ('aa:bb:cc:dd:ee:ff')
+        ouis: address prefixes ('ac:23:3f', 'ac:23:3f:a0')
+        names: Local Name globs ('MyESP*')
+        uuids: service UUIDs (16, 32 or 128 bit)
+        companies: manufacturer company IDs (int)
+        svc_data: service data UUIDs (16, 32 or 128 bit)
+        resolver: RpaResolver. addrs and ouis are matched with the identity
+        '''
+        self._dbg = debug
+        __class__._log = get_logger(__class__.__name__, self._dbg)
+        self._log.debug('addrs=%s, ouis=%s, names=%s',
+                        addrs, ouis, names)
+        self._log.debug('uuids=%s, companies=%s, svc_data=%s',
+                        uuids, companies, svc_data)
+
+        self._addrs = frozenset([a.lower() for a in addrs])
+        self._resolver = resolver
+
+        self._ouis = None
+        if len(ouis) > 0:
+            self._ouis = PrefixTrie([o.lower() for o in ouis])
+
+        self._names = set()
+        self._name_prefix = None
+        self._name_re = None
+        self.compile_names(names)
+
+        self._uuids = self.compile_uuids(uuids)
+        self._companies = frozenset([struct.pack('<H', c)
+                                     for c in companies])
+        self._svc_data = self.compile_uuids(svc_data)
+
+        ad_types = set()
+        if len(self._names) > 0 or self._name_prefix is not None or \
+           self._name_re is not None:
+            ad_types |= set(AdParser.LOCAL_NAME)
+        if len(self._uuids) > 0:
+            ad_types |= set(AdParser.UUID_LIST_SIZE.keys())
+        if len(self._svc_data) > 0:
+            ad_types |= set(AdParser.SERVICE_DATA_SIZE.keys())
+        if len(self._companies) > 0:
+            ad_types.add(AdParser.MANUFACTURER)
+        self._ad_types = frozenset(ad_types)
+
+        self._match_all = len(self._addrs) == 0 and self._ouis is None and \
+            len(self._ad_types) == 0
+
+        self.stat = {'match': 0, 'reject': 0}
+
+    @classmethod
+    def from_spec(cls, spec, resolver=None, debug=False):
+        '''
+        spec: dict {'addrs': [..], 'ouis': [..], ..}
+        '''
+        return cls(resolver=resolver, debug=debug, **spec)
+
+    def compile_names(self, names):
+        globs = []
+        for name in names:
+            b = name.encode('utf-8')
+            if not any([c in name for c in '*?[']):
+                self._names.add(b)
+            elif name.endswith('*') and \
+                    not any([c in name[:-1] for c in '*?[']):
+                if self._name_prefix is None:
+                    self._name_prefix = PrefixTrie()
+                self._name_prefix.add(b[:-1])
+            else:
+                globs.append(fnmatch.translate(name))
+
+        if len(globs) > 0:
+            self._name_re = re.compile(
+                ('|'.join(['(?:%s)' % g for g in globs])).encode('utf-8'),
+                re.DOTALL)
+
+    @staticmethod
+    def compile_uuids(uuids):
+        '''
+        Returns
+        -------
+        uuids: frozenset of bytes (little endian as in AD)
+          short UUIDs are also added in 32 and 128 bit form
+
+        Raises
+        ------
+        ValueError: invalid UUID
+        '''
+        ret = set()
+        for u in uuids:
+            uuid = BleUuid(u)
+            ret.add(uuid.to_bytes(16, 'little'))
+
+            short = uuid.short
+            if short is not None:
+                if short <= 0xffff:
+                    ret.add(short.to_bytes(2, 'little'))
+                ret.add(short.to_bytes(4, 'little'))
+
+        return frozenset(ret)
+
+    def match_dev(self, dev):
+        '''
+        dev: btle.ScanEntry (or AdvEntry)
+        '''
+        return self.match(dev.addr, dev.rawData,
+                          getattr(dev, 'scanData', None))
+
+    def match(self, addr, raw=None, scan_data=None):
+        '''
+        addr: str
+        raw: bytes (AD structures) or None
+        scan_data: {ad_type: value} merged over the advertising and scan
+          response packets (ScanEntry.scanData) or None.
+          raw is the last packet only
+        '''
+        if self._match_all or self._match(addr, raw, scan_data):
+            self.stat['match'] += 1
+            return True
+
+        self.stat['reject'] += 1
+        return False
+
+    def _match(self, addr, raw, scan_data=None):
+        if self.match_addr(addr):
+            return True
+
+        if self._resolver is not None:
+            identity = self._resolver.resolve(addr)
+            if identity is not None and self.match_addr(identity):
+                return True
+
+        if len(self._ad_types) == 0:
+            return False
+
+        ad_types = self._ad_types
+        if raw:
+            for (ad_type, start, end) in AdParser.offsets(raw):
+                if ad_type in ad_types and \
+                   self.match_ad(ad_type, raw[start:end]):
+                    return True
+
+        # the other packet (ADV_IND or SCAN_RSP)
+        if scan_data:
+            for ad_type in ad_types:
+                val = scan_data.get(ad_type)
+                if val is not None and self.match_ad(ad_type, val):
+                    return True
+
+        return False
+
+    def match_addr(self, addr):
+        if addr in self._addrs:
+            return True
+        return self._ouis is not None and self._ouis.match(addr)
+
+    def match_ad(self, ad_type, val):
+        if ad_type == AdParser.MANUFACTURER:
+            return val[:2] in self._companies
+
+        size = AdParser.SERVICE_DATA_SIZE.get(ad_type)
+        if size is not None:
+            return val[:size] in self._svc_data
+
+        size = AdParser.UUID_LIST_SIZE.get(ad_type)
+        if size is not None:
+            uuids = self._uuids
+            for j in range(0, len(val) - size + 1, size):
+                if val[j:j + size] in uuids:
+                    return True
+            return False
+
+        # Local Name
+        if val in self._names:
+            return True
+        if self._name_prefix is not None and self._name_prefix.match(val):
+            return True
+        if self._name_re is not None and self._name_re.match(val):
+            return True
+        return False
@@ -0,0 +1,343 @@
+#!/usr/bin/env python3
+#
+# (c) 2020 Yoichi Tanibayashi
+#
+"""
+Advertisement record/replay log
+
+file format:
+  header: b'BLEADV' + version(uint16 LE)
+  record: length(uint16 LE) + body
+    body: time(double) addr(6 bytes) addr_type(uint8) rssi(int8)
+          adv_type(uint8) AD structures(bytes)
+  all little endian. append only.
+
+Usage:
+    # record
+    writer = AdvLogWriter('adv.log')
+    scanner = btle.Scanner(0).withDelegate(
+        AdvLogDelegate(writer, ScanDelegate(..)))
+
+    # replay
+    scanner = AdvReplayScanner('adv.log', speed=0)
+    devs = scanner.scan(5)
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__   = '2020'
+
+from bluepy import btle
+from collections import namedtuple, OrderedDict
+import struct
+import time
+import os
+import click
+from AdvEntry import AdvEntry
+from MyLogger import get_logger
+CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
+
+
+AdvRecord = namedtuple('AdvRecord', ['time', 'addr', 'addr_type', 'rssi',
+                                     'adv_type', 'data'])
+
+
+class AdvLog:
+    MAGIC = b'BLEADV'
+    VERSION = 1
+
+    HEADER = struct.Struct('<6sH')
+    LENGTH = struct.Struct('<H')
+    BODY = struct.Struct('<d6sBbB')
+
+    MAX_ADDRS = 4096  # cached address conversions (LRU)
+
+    ADDR_TYPE = {
+        btle.ADDR_TYPE_PUBLIC: 0x00,
+        btle.ADDR_TYPE_RANDOM: 0x01
+    }
+
+    @classmethod
+    def record(cls, dev, ts=None):
+        '''
+        dev: btle.ScanEntry (or AdvEntry)
+
+        Returns
+        -------
+        rec: AdvRecord
+        '''
+        if ts is None:
+            ts = time.time()
+
+        adv_type = getattr(dev, 'advType', None)
+        if adv_type is None:
+            adv_type = AdvEntry.ADV_IND if dev.connectable \
+                else AdvEntry.ADV_NONCONN_IND
+
+        return AdvRecord(ts, dev.addr, cls.ADDR_TYPE.get(dev.addrType, 0x01),
+                         dev.rssi, adv_type, dev.rawData or b'')
+
+    @staticmethod
+    def addr2bytes(addr):
+        return bytes.fromhex(addr.replace(':', ''))
+
+    @staticmethod
+    def bytes2addr(raw_addr):
+        return ':'.join(['%02x' % c for c in raw_addr])
+
+    @classmethod
+    def _cached(cls, cache, key, conv):
+        '''
+        cache: OrderedDict, at most MAX_ADDRS entries (LRU)
+        '''
+        val = cache.get(key)
+        if val is not None:
+            cache.move_to_end(key)
+            return val
+
+        val = conv(key)
+        cache[key] = val
+        if len(cache) > cls.MAX_ADDRS:
+            cache.popitem(last=False)
+        return val
+
+
+class AdvLogWriter(AdvLog):
+    _log = None
+
+    def __init__(self, path, debug=False):
+        self._dbg = debug
+        __class__._log = get_logger(__class__.__name__, self._dbg)
+        self._log.debug('path=%s', path)
+
+        self._path = path
+
+        new_file = not os.path.exists(self._path) or \
+            os.path.getsize(self._path) == 0
+        self._f = open(self._path, 'ab')
+        if new_file:
+            self._f.write(self.HEADER.pack(self.MAGIC, self.VERSION))
+
+        # random addresses come and go. bounded
+        self._raw_addr = OrderedDict()
+        self.count = 0
+
+    def close(self):
+        self._log.debug('count=%d', self.count)
+        self._f.close()
+
+    def flush(self):
+        self._f.flush()
+
+    def write(self, ts, addr, addr_type, rssi, adv_type, data):
+        '''
+        addr_type: HCI Address_Type (int)
+        '''
+        raw_addr = self._cached(self._raw_addr, addr, self.addr2bytes)
+
+        body = self.BODY.pack(ts, raw_addr, addr_type, rssi, adv_type)
+        self._f.write(self.LENGTH.pack(len(body) + len(data)) + body + data)
+        self.count += 1
+
+    def write_entry(self, dev, ts=None):
+        '''
+        dev: btle.ScanEntry (or AdvEntry)
+        '''
+        self.write(*self.record(dev, ts))
+
+
+class AdvLogReader(AdvLog):
+    _log = None
+
+    def __init__(self, path, debug=False):
+        self._dbg = debug
+        __class__._log = get_logger(__class__.__name__, self._dbg)
+        self._log.debug('path=%s', path)
+
+        self._path = path
+
+    def __iter__(self):
+        addr_str = OrderedDict()
+
+        with open(self._path, 'rb') as f:
+            hdr = f.read(self.HEADER.size)
+            (magic, ver) = self.HEADER.unpack(hdr)
+            if magic != self.MAGIC:
+                raise ValueError('%s: not an advertisement log' % self._path)
+            self._log.debug('version=%s', ver)
+
+            while True:
+                ln = f.read(self.LENGTH.size)
+                if len(ln) < self.LENGTH.size:
+                    break
+                (length, ) = self.LENGTH.unpack(ln)
+
+                rec = f.read(length)
+                if len(rec) < length:
+                    self._log.warning('truncated record')
+                    break
+
+                (ts, raw_addr, addr_type, rssi,
+                 adv_type) = self.BODY.unpack_from(rec)
+
+                addr = self._cached(addr_str, raw_addr, self.bytes2addr)
+
+                yield AdvRecord(ts, addr, addr_type, rssi, adv_type,
+                                rec[self.BODY.size:])
+
+
+class AdvLogDelegate(btle.DefaultDelegate):
+    '''
+    record every advertisement, then pass it to the delegate
+    '''
+    def __init__(self, writer, delegate=None):
+        self._writer = writer
+        self._delegate = delegate
+
+        super().__init__()
+
+    def handleDiscovery(self, dev, isNewDev, isNewData):
+        self._writer.write_entry(dev)
+
+        if self._delegate is not None:
+            self._delegate.handleDiscovery(dev, isNewDev, isNewData)
+
+
+class AdvReplayScanner:
+    '''
+    bluepy.btle.Scanner compatible replay source
+
+    speed: 1.0 = recorded speed, 0 = as fast as possible
+    timeout of process() and scan() is in recorded time.
+    '''
+    _log = None
+
+    def __init__(self, path, speed=1.0, loop=False, iface=0, debug=False):
+        self._dbg = debug
+        __class__._log = get_logger(__class__.__name__, self._dbg)
+        self._log.debug('path=%s, speed=%s, loop=%s', path, speed, loop)
+
+        self._path = path
+        self._speed = speed
+        self._loop = loop
+        self.iface = iface
+
+        self.delegate = None
+        self.scanned = {}
+
+        self._it = None
+        self._next = None
+        self._offset = 0.0  # added to the recorded time when looping
+
+    def withDelegate(self, delegate_):
+        self.delegate = delegate_
+        return self
+
+    def _read(self):
+        if self._it is None:
+            self._it = iter(AdvLogReader(self._path, debug=self._dbg))
+
+        rec = next(self._it, None)
+        if rec is None and self._loop and self._next is not None:
+            self._log.debug('rewind')
+            last = self._next.time
+            self._it = iter(AdvLogReader(self._path, debug=self._dbg))
+            rec = next(self._it, None)
+            if rec is not None:
+                self._offset = last - rec.time
+
+        if rec is not None:
+            rec = rec._replace(time=rec.time + self._offset)
+        return rec
+
+    @property
+    def done(self):
+        '''
+        True when all records are replayed
+        '''
+        return self._it is not None and self._next is None
+
+    def start(self, passive=False):
+        self._log.debug('passive=%s', passive)
+
+        if self._it is None:
+            self._next = self._read()
+
+    def stop(self):
+        self._log.debug('')
+
+    def clear(self):
+        self.scanned = {}
+
+    def process(self, timeout=10.0):
+        '''
+        Returns
+        -------
+        count: int
+          number of replayed records
+        '''
+        if self._next is None:
+            return 0
+
+        t0_rec = self._next.time
+        t0_wall = time.time()
+        count = 0
+        while self._next is not None:
+            rec = self._next
+            if timeout and rec.time - t0_rec >= timeout:
+                break
+
+            if self._speed > 0:
+                wait = t0_wall + (rec.time - t0_rec) / self._speed - \
+                    time.time()
+                if wait > 0:
+                    time.sleep(wait)
+
+            self.handle_record(rec)
+            count += 1
+            self._next = self._read()
+
+        return count
+
+    def handle_record(self, rec):
+        dev = self.scanned.get(rec.addr)
+        if dev is None:
+            dev = AdvEntry(rec.addr, self.iface)
+            self.scanned[rec.addr] = dev
+
+        isNewData = dev.update(rec.addr_type, rec.rssi, rec.adv_type,
+                               rec.data)
+        if self.delegate is not None:
+            self.delegate.handleDiscovery(dev, (dev.updateCount <= 1),
+                                          isNewData)
+
+    def getDevices(self):
+        return self.scanned.values()
+
+    def scan(self, timeout=10, passive=False):
+        self.clear()
+        self.start(passive=passive)
+        self.process(timeout)
+        self.stop()
+        return self.getDevices()
+
+
+@click.command(context_settings=CONTEXT_SETTINGS, help='''
+Advertisement log dump
+''')
+@click.argument('path', type=click.Path(exists=True))
+@click.option('--debug', '-d', 'debug', is_flag=True, default=False,
+              help='debug flag')
+def main(path, debug):
+    logger = get_logger(__name__, debug)
+    logger.debug('path=%s', path)
+
+    count = 0
+    for rec in AdvLogReader(path, debug=debug):
+        print('%.3f [%s](%d) %d dBm type=%d %s' % (
+            rec.time, rec.addr, rec.addr_type, rec.rssi, rec.adv_type,
+            rec.data.hex()))
+        count += 1
+    logger.info('%d records', count)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+#
+# (c) 2020 Yoichi Tanibayashi
+#
+"""
+ADV_IND + SCAN_RSP merging per address
+
+handleDiscovery() of the delegate is called once for each advertising
+and scan response pair ("complete"), or when the scan response does
+not come in 'timeout' sec. it is not called if the merged content is
+the same as the last one.
+
+the timeout is checked when a packet comes, so call flush() when
+a scan ends.
+
+Usage:
+    merger = AdvMergeDelegate(ScanDelegate(..), timeout=0.5)
+    scanner = btle.Scanner(0).withDelegate(merger)
+    scanner.scan(10)
+    merger.flush()
+
+bluepy does not tell the packet type. a payload with Flags (AD type
+0x01) is taken as an advertisement, since Flags are not allowed in a
+scan response.
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__   = '2020'
+
+from bluepy import btle
+from collections import OrderedDict
+import time
+from AdvEntry import AdvEntry
+from AdParser import AdParser
+from MyLogger import get_logger
+
+
+class AdvPair:
+    __slots__ = ('adv', 'rsp', 'first', 'emitted', 'dev', 'scannable')
+
+    def __init__(self):
+        self.adv = None
+        self.rsp = None
+        self.first = None
+        self.emitted = None  # (adv, rsp) of the last callback
+        self.dev = None
+        self.scannable = False
+
+
+class AdvMergeDelegate(btle.DefaultDelegate):
+    DEF_TIMEOUT = 0.5       # sec
+    DEF_MAX_SIZE = 1024     # addresses
+
+    _log = None
+
+    def __init__(self, delegate, timeout=DEF_TIMEOUT, passive=False,
+                 max_size=DEF_MAX_SIZE, debug=False):
+        '''
+        passive: no scan response is expected
+        '''
+        self._dbg = debug
+        __class__._log = get_logger(__class__.__name__, self._dbg)
+        self._log.debug('timeout=%s, passive=%s, max_size=%s',
+                        timeout, passive, max_size)
+
+        self._delegate = delegate
+        self.timeout = timeout
+        self.passive = passive
+        self._max_size = max_size
+
+        self._pair = OrderedDict()     # addr -> AdvPair (LRU)
+        self._pending = OrderedDict()  # addr -> AdvPair (by first time)
+
+        self.stat = {'packet': 0, 'complete': 0, 'timeout': 0,
+                     'suppress': 0}
+
+        super().__init__()
+
+    @classmethod
+    def is_scan_rsp(cls, dev):
+        adv_type = getattr(dev, 'advType', None)
+        if adv_type is not None:
+            return adv_type == AdvEntry.SCAN_RSP
+
+        data = dev.rawData or b''
+        if AdParser.has_type(data, AdParser.FLAGS):
+            return False
+        return dev.connectable and len(data) > 0
+
+    @staticmethod
+    def is_scannable(dev):
+        adv_type = getattr(dev, 'advType', None)
+        if adv_type is not None:
+            return adv_type in (AdvEntry.ADV_IND, AdvEntry.ADV_SCAN_IND)
+        return dev.connectable
+
+    def handleDiscovery(self, dev, isNewDev, isNewData):
+        now = time.time()
+        self.stat['packet'] += 1
+
+        addr = dev.addr
+        pair = self._pair.get(addr)
+        if pair is None:
+            pair = AdvPair()
+            self._pair[addr] = pair
+            if len(self._pair) > self._max_size:
+                (old, _) = self._pair.popitem(last=False)
+                self._pending.pop(old, None)
+        else:
+            self._pair.move_to_end(addr)
+        pair.dev = dev
+
+        data = bytes(dev.rawData or b'')
+        if self.is_scan_rsp(dev):
+            pair.rsp = data
+        else:
+            pair.adv = data
+            pair.scannable = self.is_scannable(dev)
+
+        if pair.first is None:
+            pair.first = now
+
+        if pair.adv is not None and \
+           (pair.rsp is not None or self.passive or not pair.scannable):
+            self._pending.pop(addr, None)
+            self.stat['complete'] += 1
+            self._emit(pair)
+        elif addr not in self._pending:
+            self._pending[addr] = pair
+
+        self.check(now)
+
+    def check(self, now=None):
+        '''
+        emit the pairs without scan response for timeout sec
+        '''
+        if now is None:
+            now = time.time()
+
+        limit = now - self.timeout
+        while len(self._pending) > 0:
+            pair = next(iter(self._pending.values()))
+            if pair.first > limit:
+                break
+            self._pending.popitem(last=False)
+            self.stat['timeout'] += 1
+            self._emit(pair)
+
+    def flush(self):
+        '''
+        emit all the pending pairs (ex. at the end of a scan)
+        '''
+        self.check(float('inf'))
+
+    def _emit(self, pair):
+        is_new = pair.emitted is None
+
+        # a lost packet is taken as unchanged
+        (adv, rsp) = (pair.adv, pair.rsp)
+        if not is_new:
+            if adv is None:
+                adv = pair.emitted[0]
+            if rsp is None:
+                rsp = pair.emitted[1]
+        content = (adv, rsp)
+
+        pair.first = None
+        pair.adv = None
+        pair.rsp = None
+
+        if content == pair.emitted:
+            self.stat['suppress'] += 1
+            return
+        pair.emitted = content
+
+        self._delegate.handleDiscovery(pair.dev, is_new, True)
@@ -0,0 +1,393 @@
+#!/usr/bin/env python3
+#
+# (c) 2020 Yoichi Tanibayashi
+#
+"""
+Benchmark for the advertisement hot path
+
+  $ ./BleBench.py                       # all benchmarks
+  $ ./BleBench.py -n 50000 dev2string   # selected benchmarks
+  $ ./BleBench.py --save bench.json     # save baseline
+  $ ./BleBench.py --compare bench.json  # diff from baseline
+
+INFO logs are disabled while measuring.
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__   = '2020'
+
+from collections import OrderedDict
+import tracemalloc
+import logging
+import random
+import struct
+import json
+import time
+import click
+from AdvEntry import AdvEntry
+from AdvFilter import AdvFilter
+from AdParser import AdParser
+import BleScan
+import BleScan2
+import MMBLEBC2
+from MyLogger import get_logger
+CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
+
+
+class AdvGenerator:
+    '''
+    synthetic advertisements with a realistic AD mix
+
+    iterate to get (dev, isNewDev, isNewData), same as handleDiscovery()
+    '''
+    MIX = OrderedDict([
+        ('ibeacon', 30),
+        ('eddystone', 10),
+        ('mmblebc2', 10),
+        ('named', 20),
+        ('services', 15),
+        ('msft', 10),
+        ('empty', 5)
+    ])
+
+    _log = None
+
+    def __init__(self, n_addrs=500, mix=None, seed=0, debug=False):
+        self._dbg = debug
+        __class__._log = get_logger(__class__.__name__, self._dbg)
+        self._log.debug('n_addrs=%s, mix=%s, seed=%s', n_addrs, mix, seed)
+
+        self._mix = mix
+        if self._mix is None:
+            self._mix = self.MIX
+
+        self._rnd = random.Random(seed)
+
+        kinds = self._rnd.choices(list(self._mix.keys()),
+                                  list(self._mix.values()), k=n_addrs)
+        self._devs = []
+        for i, kind in enumerate(kinds):
+            if kind == 'mmblebc2':
+                addr = MMBLEBC2.MMBLEBC2.ADDR_HDR + ':%02x:%02x' % (
+                    i >> 8 & 0xff, i & 0xff)
+                addr_type = 0
+            else:
+                addr = ':'.join(['%02x' % self._rnd.randrange(256)
+                                 for j in range(6)])
+                addr_type = self._rnd.randrange(2)
+
+            adv = self.payload(kind)
+            rsp = None
+            if kind in ('named', 'services'):
+                rsp = self.ad(0x09, ('Dev-%04d' % i).encode())
+
+            self._devs.append((AdvEntry(addr), addr_type, kind, adv, rsp))
+
+    def ad(self, ad_type, val):
+        return bytes([len(val) + 1, ad_type]) + val
+
+    def payload(self, kind):
+        flags = self.ad(0x01, b'\x06')
+        rnd = self._rnd
+
+        if kind == 'ibeacon':
+            return flags + self.ad(0xff, struct.pack(
+                '<HBB', 0x004c, 0x02, 0x15) +
+                bytes(rnd.randrange(256) for i in range(16)) +
+                struct.pack('>HHb', rnd.randrange(65536),
+                            rnd.randrange(65536), -59))
+        if kind == 'eddystone':
+            return flags + self.ad(0x03, b'\xaa\xfe') + self.ad(
+                0x16, b'\xaa\xfe\x10\x00\x03' + b'example\x07')
+        if kind == 'mmblebc2':
+            return flags + self.ad(0x16, struct.pack(
+                '<HBB', 0xffe1, 0xa1, 0x01) + struct.pack(
+                '>BHH', rnd.randrange(101), rnd.randrange(0x1000, 0x2000),
+                rnd.randrange(0x2000, 0x5000)) +
+                bytes(rnd.randrange(256) for i in range(6)))
+        if kind == 'named':
+            return flags + self.ad(0x0a, b'\x00') + self.ad(
+                0x08, b'Dev%02d' % rnd.randrange(100))
+        if kind == 'services':
+            return flags + self.ad(0x03, b'\x0f\x18\x0a\x18\x00\x18') + \
+                self.ad(0x19, b'\x40\x00')
+        if kind == 'msft':
+            return self.ad(0xff, b'\x06\x00\x01\x09\x20\x02' +
+                           bytes(rnd.randrange(256) for i in range(23)))
+        return b''
+
+    def __iter__(self):
+        rnd = self._rnd
+        devs = self._devs
+        n = len(devs)
+        while True:
+            (dev, addr_type, kind, adv, rsp) = devs[rnd.randrange(n)]
+            rssi = rnd.randrange(-100, -30)
+            if rsp is not None and dev.updateCount % 2 == 1:
+                isNewData = dev.update(addr_type, rssi, AdvEntry.SCAN_RSP,
+                                       rsp)
+            else:
+                isNewData = dev.update(addr_type, rssi, AdvEntry.ADV_IND,
+                                       adv)
+            yield (dev, dev.updateCount <= 1, isNewData)
+
+    def take(self, n):
+        '''
+        Returns
+        -------
+        adverts: list of (dev, isNewDev, isNewData)
+          dev is a snapshot, safe to keep
+        '''
+        ret = []
+        for (dev, isNewDev, isNewData) in self:
+            snap = AdvEntry(dev.addr, dev.iface)
+            snap.__dict__.update(dev.__dict__)
+            snap.scanData = dict(dev.scanData)
+            ret.append((snap, isNewDev, isNewData))
+            if len(ret) >= n:
+                return ret
+
+
+class ListScanner:
+    '''
+    bluepy.btle.Scanner compatible, returns the given devices
+    '''
+    def __init__(self, devs):
+        self._devs = devs
+        self.delegate = None
+
+    def withDelegate(self, delegate_):
+        self.delegate = delegate_
+        return self
+
+    def scan(self, timeout=10, passive=False):
+        return self._devs
+
+
+class BleBench:
+    '''
+    benchmark: func(adverts) -> per advert callable
+    '''
+    PERCENTILES = (50, 90, 99)
+    ALLOC_SAMPLES = 2000
+
+    _log = None
+
+    def __init__(self, n=20000, n_addrs=500, seed=0, debug=False):
+        self._dbg = debug
+        __class__._log = get_logger(__class__.__name__, self._dbg)
+        self._log.debug('n=%s, n_addrs=%s, seed=%s', n, n_addrs, seed)
+
+        self._n = n
+        self._gen = AdvGenerator(n_addrs, seed=seed, debug=self._dbg)
+        self._adverts = self._gen.take(n)
+
+        self.benchmarks = OrderedDict([
+            ('generator', self.bench_generator),
+            ('handleDiscovery', self.bench_handle_discovery),
+            ('dev2string', self.bench_dev2string),
+            ('dev_data', self.bench_dev_data),
+            ('MMBLEBC2.scan', self.bench_mmblebc2),
+            ('BleScan2.rawData', self.bench_raw_data),
+            ('AdvFilter.match', self.bench_adv_filter),
+            ('getScanData', self.bench_get_scan_data),
+            ('AdParser.parse', self.bench_ad_parser)
+        ])
+
+    def bench_generator(self):
+        it = iter(self._gen)
+        return lambda adv: next(it)
+
+    def bench_handle_discovery(self):
+        ble_scan = BleScan.BleScan(scan_timeout=5, scanner=ListScanner([]))
+        delegate = ble_scan._delegate
+        return lambda adv: delegate.handleDiscovery(*adv)
+
+    def bench_dev2string(self):
+        BleScan.BleScan(scanner=ListScanner([]))
+        return lambda adv: BleScan.BleScan.dev2string(adv[0])
+
+    def bench_dev_data(self):
+        ble_scan = BleScan.BleScan(scanner=ListScanner([]))
+        return lambda adv: ble_scan.dev_data(adv[0])
+
+    def bench_mmblebc2(self):
+        scanners = {}
+
+        def f(adv):
+            dev = adv[0]
+            scanner = scanners.get(id(dev))
+            if scanner is None:
+                scanner = ListScanner([dev])
+                scanners[id(dev)] = scanner
+            mmblebc2._scanner = scanner
+            mmblebc2.scan(0)
+
+        mmblebc2 = MMBLEBC2.MMBLEBC2(ListScanner([]))
+        return f
+
+    def bench_raw_data(self):
+        ble_scan = BleScan2.BleScan()
+        return lambda adv: ble_scan.dump_raw_data(adv[0])
+
+    def bench_adv_filter(self):
+        adv_filter = AdvFilter(ouis=[MMBLEBC2.MMBLEBC2.ADDR_HDR],
+                               names=['MyESP*'], uuids=['180f'],
+                               companies=[0x0006])
+        return lambda adv: adv_filter.match(adv[0].addr, adv[0].rawData)
+
+    def bench_get_scan_data(self):
+        return lambda adv: adv[0].getScanData()
+
+    def bench_ad_parser(self):
+        def f(adv):
+            for (ad_type, payload) in AdParser.parse(adv[0].rawData):
+                if ad_type in AdParser.LOCAL_NAME:
+                    AdParser.name(payload)
+                elif ad_type in AdParser.UUID_LIST_SIZE:
+                    AdParser.uuid_list(ad_type, payload)
+        return f
+
+    def run(self, names=None):
+        '''
+        Returns
+        -------
+        result: {name: {'adverts_per_sec': .., 'p50_us': .., ..}}
+        '''
+        self._log.debug('names=%s', names)
+
+        if names is None or len(names) == 0:
+            names = list(self.benchmarks.keys())
+
+        result = OrderedDict()
+        for name in names:
+            result[name] = self.run1(name, self.benchmarks[name]())
+            self._log.info('%s: %s', name, result[name])
+        return result
+
+    def run1(self, name, f):
+        self._log.debug('name=%s', name)
+
+        adverts = self._adverts
+        perf = time.perf_counter
+
+        # warm up
+        for adv in adverts[:100]:
+            f(adv)
+
+        # throughput
+        start = perf()
+        for adv in adverts:
+            f(adv)
+        elapsed = perf() - start
+
+        # latency
+        lat = []
+        for adv in adverts:
+            t = perf()
+            f(adv)
+            lat.append(perf() - t)
+        lat.sort()
+
+        # allocations
+        samples = adverts[:self.ALLOC_SAMPLES]
+        tracemalloc.start()
+        t0 = tracemalloc.take_snapshot()
+        peak = 0
+        for adv in samples:
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+            f(adv)
+            peak += tracemalloc.get_traced_memory()[1] - base
+        t1 = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        blocks = sum([s.count_diff for s in t1.compare_to(t0, 'filename')
+                      if s.count_diff > 0])
+
+        ret = OrderedDict()
+        ret['adverts_per_sec'] = len(adverts) / elapsed
+        for p in self.PERCENTILES:
+            ret['p%d_us' % p] = lat[min(len(lat) - 1,
+                                        len(lat) * p // 100)] * 1e6
+        ret['alloc_bytes_per_advert'] = peak / len(samples)
+        ret['retained_blocks_per_advert'] = blocks / len(samples)
+        return ret
+
+    @staticmethod
+    def compare(result, baseline):
+        '''
+        Returns
+        -------
+        diff: {name: {key: percent}}
+        '''
+        diff = OrderedDict()
+        for name, r in result.items():
+            b = baseline.get(name)
+            if b is None:
+                continue
+            diff[name] = OrderedDict()
+            for k, v in r.items():
+                if k in b and b[k] != 0:
+                    diff[name][k] = (v - b[k]) / b[k] * 100
+        return diff
+
+
+@click.command(context_settings=CONTEXT_SETTINGS, help='''
+Benchmark for the advertisement hot path
+''')
+@click.argument('names', type=str, nargs=-1)
+@click.option('--num', '-n', 'num', type=int, default=20000,
+              help='number of adverts')
+@click.option('--addrs', '-a', 'n_addrs', type=int, default=500,
+              help='number of addresses')
+@click.option('--seed', 'seed', type=int, default=0,
+              help='random seed')
+@click.option('--save', '-s', 'save', type=str, default=None,
+              help='save the result as a baseline')
+@click.option('--compare', '-c', 'compare', type=click.Path(exists=True),
+              default=None,
+              help='compare with the baseline')
+@click.option('--debug', '-d', 'debug', is_flag=True, default=False,
+              help='debug flag')
+def main(names, num, n_addrs, seed, save, compare, debug):
+    logger = get_logger(__name__, debug)
+    logger.debug('names=%s, num=%s, n_addrs=%s, seed=%s',
+                 names, num, n_addrs, seed)
+    logger.debug('save=%s, compare=%s', save, compare)
+
+    bench = BleBench(num, n_addrs, seed, debug=debug)
+    if not debug:
+        logging.disable(logging.INFO)
+    try:
+        result = bench.run(names)
+    finally:
+        logging.disable(logging.NOTSET)
+
+    print('%-18s %12s %9s %9s %9s %10s %8s' % (
+        'benchmark', 'adverts/s', 'p50(us)', 'p90(us)', 'p99(us)',
+        'alloc(B)', 'blocks'))
+    for name, r in result.items():
+        print('%-18s %12.0f %9.1f %9.1f %9.1f %10.0f %8.2f' % (
+            name, r['adverts_per_sec'], r['p50_us'], r['p90_us'],
+            r['p99_us'], r['alloc_bytes_per_advert'],
+            r['retained_blocks_per_advert']))
+
+    if compare is not None:
+        with open(compare) as f:
+            baseline = json.load(f)
+        print()
+        print('diff from %s (%%)' % (compare))
+        for name, d in BleBench.compare(result, baseline).items():
+            print('%-18s %+11.1f%% %+8.1f%% %+8.1f%% %+8.1f%% %+9.1f%%' % (
+                name, d.get('adverts_per_sec', 0), d.get('p50_us', 0),
+                d.get('p90_us', 0), d.get('p99_us', 0),
+                d.get('alloc_bytes_per_advert', 0)))
+
+    if save is not None:
+        with open(save, 'w') as f:
+            json.dump(result, f, indent=2)
+        logger.info('saved: %s', save)
+
+
+if __name__ == '__main__':
+    main()
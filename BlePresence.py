@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+#
+# (c) 2020 Yoichi Tanibayashi
+#
+"""
+Per device RSSI smoothing and presence events
+
+updated in O(1) per advertisement. emits a handful of events instead of
+every advertisement:
+
+  'enter': first advertisement (or after 'leave')
+  'near':  smoothed RSSI >= near_rssi
+  'far':   smoothed RSSI <= far_rssi (after 'near')
+  'leave': not seen for leave_timeout sec
+
+Usage:
+    def on_event(event, rec):
+        print(event, rec.addr, rec.rssi)
+
+    presence = BlePresence(on_event)
+    presence.update(dev.addr, dev.rssi)  # in handleDiscovery()
+    presence.check()                     # after each scan window
+
+'leave' needs check() without advertisements. in a continuous scan,
+start() calls it in a thread until stop().
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__   = '2020'
+
+from collections import OrderedDict
+import threading
+import time
+from MyLogger import get_logger
+
+
+class Ewma:
+    '''
+    exponentially weighted moving average
+    '''
+    __slots__ = ('alpha', 'value')
+
+    def __init__(self, alpha=0.3):
+        self.alpha = alpha
+        self.value = None
+
+    def update(self, x):
+        if self.value is None:
+            self.value = float(x)
+        else:
+            self.value += self.alpha * (x - self.value)
+        return self.value
+
+
+class Kalman:
+    '''
+    1-D Kalman filter for a (nearly) constant value
+
+    q: process noise, r: measurement noise
+    '''
+    __slots__ = ('q', 'r', 'value', 'p')
+
+    def __init__(self, q=0.05, r=4.0):
+        self.q = q
+        self.r = r
+        self.value = None
+        self.p = 1.0
+
+    def update(self, x):
+        if self.value is None:
+            self.value = float(x)
+            self.p = self.r
+            return self.value
+
+        self.p += self.q
+        k = self.p / (self.p + self.r)
+        self.value += k * (x - self.value)
+        self.p *= 1 - k
+        return self.value
+
+
+class PresenceRecord:
+    __slots__ = ('addr', 'filter', 'raw_rssi', 'interval', 'first', 'last',
+                 'count', 'near')
+
+    def __init__(self, addr, rssi_filter, now):
+        self.addr = addr
+        self.filter = rssi_filter
+        self.raw_rssi = None
+        self.interval = Ewma(BlePresence.RATE_ALPHA)
+        self.first = now
+        self.last = now
+        self.count = 0
+        self.near = False
+
+    @property
+    def rssi(self):
+        '''
+        smoothed RSSI
+        '''
+        return self.filter.value
+
+    @property
+    def rate(self):
+        '''
+        advertisements per sec
+        '''
+        if not self.interval.value:
+            return 0.0
+        return 1.0 / self.interval.value
+
+    def __repr__(self):
+        return '<PresenceRecord %s rssi=%.1f rate=%.2f near=%s>' % (
+            self.addr, self.rssi, self.rate, self.near)
+
+
+class BlePresence:
+    SMOOTHING = ('ewma', 'kalman')
+
+    DEF_NEAR_RSSI = -60  # dBm
+    DEF_FAR_RSSI = -70   # dBm
+    DEF_LEAVE_TIMEOUT = 30  # sec
+    CHECK_INTERVAL = 1.0    # sec, of the check thread
+
+    RATE_ALPHA = 0.2
+
+    _log = None
+
+    def __init__(self, on_event=None, smoothing='ewma', alpha=0.3,
+                 q=0.05, r=4.0, near_rssi=DEF_NEAR_RSSI,
+                 far_rssi=DEF_FAR_RSSI, leave_timeout=DEF_LEAVE_TIMEOUT,
+                 debug=False):
+        '''
+        on_event: func(event, rec)
+        smoothing: 'ewma' (alpha) or 'kalman' (q, r)
+        near_rssi, far_rssi: hysteresis (far_rssi <= near_rssi)
+        '''
+        self._dbg = debug
+        __class__._log = get_logger(__class__.__name__, self._dbg)
+        self._log.debug('smoothing=%s, alpha=%s, q=%s, r=%s',
+                        smoothing, alpha, q, r)
+        self._log.debug('near_rssi=%s, far_rssi=%s, leave_timeout=%s',
+                        near_rssi, far_rssi, leave_timeout)
+
+        if smoothing not in self.SMOOTHING:
+            raise ValueError('smoothing: %s' % smoothing)
+        if far_rssi > near_rssi:
+            raise ValueError('far_rssi(%s) > near_rssi(%s)' % (far_rssi,
+                                                               near_rssi))
+
+        self._on_event = on_event
+        self._smoothing = smoothing
+        self._alpha = alpha
+        self._q = q
+        self._r = r
+        self.near_rssi = near_rssi
+        self.far_rssi = far_rssi
+        self.leave_timeout = leave_timeout
+
+        # least recently seen first
+        self._rec = OrderedDict()
+        self._lock = threading.RLock()
+
+        self._checker = None
+        self._stop = threading.Event()
+
+        self.stat = {'update': 0, 'enter': 0, 'leave': 0, 'near': 0,
+                     'far': 0}
+
+    def __len__(self):
+        return len(self._rec)
+
+    def get(self, addr):
+        return self._rec.get(addr)
+
+    def records(self):
+        return list(self._rec.values())
+
+    def _new_filter(self):
+        if self._smoothing == 'kalman':
+            return Kalman(self._q, self._r)
+        return Ewma(self._alpha)
+
+    def update(self, addr, rssi, now=None):
+        '''
+        Returns
+        -------
+        rec: PresenceRecord
+        '''
+        if now is None:
+            now = time.time()
+
+        with self._lock:
+            self.stat['update'] += 1
+
+            rec = self._rec.get(addr)
+            if rec is None:
+                rec = PresenceRecord(addr, self._new_filter(), now)
+                self._rec[addr] = rec
+            else:
+                rec.interval.update(now - rec.last)
+                rec.last = now
+                self._rec.move_to_end(addr)
+
+            rec.raw_rssi = rssi
+            value = rec.filter.update(rssi)
+            rec.count += 1
+
+            if rec.count == 1:
+                self._emit('enter', rec)
+
+            if not rec.near and value >= self.near_rssi:
+                rec.near = True
+                self._emit('near', rec)
+            elif rec.near and value <= self.far_rssi:
+                rec.near = False
+                self._emit('far', rec)
+
+            self.check(now)
+        return rec
+
+    def check(self, now=None):
+        '''
+        emit 'leave' for the devices not seen for leave_timeout sec
+        '''
+        if now is None:
+            now = time.time()
+
+        limit = now - self.leave_timeout
+        with self._lock:
+            while len(self._rec) > 0:
+                rec = next(iter(self._rec.values()))
+                if rec.last >= limit:
+                    break
+                del self._rec[rec.addr]
+                self._emit('leave', rec)
+
+    def start(self, interval=None):
+        '''
+        call check() every interval sec in a thread, until stop()
+
+        interval: sec, CHECK_INTERVAL if None
+        '''
+        if interval is None:
+            interval = self.CHECK_INTERVAL
+        self._log.debug('interval=%s', interval)
+
+        if self._checker is not None:
+            return
+
+        self._stop.clear()
+        self._checker = threading.Thread(target=self._check_loop,
+                                         args=(interval,), daemon=True)
+        self._checker.start()
+
+    def _check_loop(self, interval):
+        while not self._stop.wait(interval):
+            self.check()
+
+    def stop(self):
+        self._log.debug('')
+
+        if self._checker is None:
+            return
+        self._stop.set()
+        self._checker.join()
+        self._checker = None
+
+    def _emit(self, event, rec):
+        self.stat[event] += 1
+        self._log.debug('%s: %s', event, rec)
+
+        if self._on_event is not None:
+            self._on_event(event, rec)
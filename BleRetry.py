@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+#
+# (c) 2020 Yoichi Tanibayashi
+#
+"""
+Retry policy with exponential backoff, jitter and circuit breaker
+
+Usage:
+    breaker = CircuitBreaker(threshold=3, reset_timeout=60)
+    policy = RetryPolicy('Connection', retry=3,
+                         rules={btle.BTLEDisconnectError: 0.5,
+                                Exception: 0.1},
+                         breaker=breaker)
+    peri = policy.call(btle.Peripheral, addr, addr_type, key=addr)
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__   = '2020'
+
+from collections import OrderedDict
+import threading
+import random
+import time
+from MyLogger import get_logger
+
+
+class RetryError(RuntimeError):
+    '''
+    all attempts failed. ``last`` is the last exception
+    '''
+    def __init__(self, msg, last=None):
+        super().__init__(msg)
+        self.last = last
+
+
+class RetryTimeoutError(RetryError):
+    pass
+
+
+class CircuitOpenError(RetryError):
+    pass
+
+
+class CircuitBreaker:
+    '''
+    per key (device address) circuit breaker
+
+    opens after ``threshold`` consecutive failures, and allows one
+    trial call after ``reset_timeout`` sec (half open).
+
+    the keys that failed last are kept, ``max_size`` at most
+    (ex. rotating random addresses).
+    '''
+    DEF_MAX_SIZE = 4096  # keys
+
+    _log = None
+
+    def __init__(self, threshold=3, reset_timeout=60,
+                 max_size=DEF_MAX_SIZE, debug=False):
+        self._dbg = debug
+        __class__._log = get_logger(__class__.__name__, self._dbg)
+        self._log.debug('threshold=%s, reset_timeout=%s, max_size=%s',
+                        threshold, reset_timeout, max_size)
+
+        self._threshold = threshold
+        self._reset_timeout = reset_timeout
+        self.max_size = max_size
+
+        self._lock = threading.Lock()
+        self._fail = OrderedDict()  # key: consecutive failures (LRU)
+        self._open_at = {}          # key: time.time()
+
+    def allow(self, key):
+        with self._lock:
+            open_at = self._open_at.get(key)
+            if open_at is None:
+                return True
+
+            if time.time() - open_at < self._reset_timeout:
+                return False
+
+            # half open: one trial, re-open on failure
+            self._open_at[key] = time.time()
+            return True
+
+    def success(self, key):
+        with self._lock:
+            self._fail.pop(key, None)
+            self._open_at.pop(key, None)
+
+    def failure(self, key):
+        with self._lock:
+            self._fail[key] = self._fail.get(key, 0) + 1
+            self._fail.move_to_end(key)
+            if self._fail[key] >= self._threshold:
+                if key not in self._open_at:
+                    self._log.warning('%s: circuit open', key)
+                self._open_at[key] = time.time()
+
+            while len(self._fail) > self.max_size:
+                (old, _) = self._fail.popitem(last=False)
+                self._open_at.pop(old, None)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._fail)
+
+    def is_open(self, key):
+        with self._lock:
+            return key in self._open_at
+
+
+class RetryPolicy:
+    '''
+    rules: {exception class: base delay sec or RAISE}
+      the first matching class (in insertion order) is used.
+      unmatched exceptions are raised immediately.
+    '''
+    RAISE = None
+    FOREVER = float('inf')
+
+    DEF_RETRY = 3
+    DEF_BASE = 0.2     # sec
+    DEF_FACTOR = 2.0
+    DEF_MAX_DELAY = 5.0  # sec
+    DEF_JITTER = 0.5   # 0.0 .. 1.0
+
+    _log = None
+
+    def __init__(self, name='', retry=DEF_RETRY, rules=None,
+                 factor=DEF_FACTOR, max_delay=DEF_MAX_DELAY,
+                 jitter=DEF_JITTER, breaker=None, debug=False):
+        self._dbg = debug
+        __class__._log = get_logger(__class__.__name__, self._dbg)
+        self._log.debug('name=%s, retry=%s, rules=%s',
+                        name, retry, rules)
+        self._log.debug('factor=%s, max_delay=%s, jitter=%s',
+                        factor, max_delay, jitter)
+
+        self.name = name
+        self._retry = retry
+        self._rules = rules
+        if self._rules is None:
+            self._rules = {Exception: self.DEF_BASE}
+        self._factor = factor
+        self._max_delay = max_delay
+        self._jitter = jitter
+        self._breaker = breaker
+
+        self._lock = threading.Lock()
+        self._stat = {
+            'call': 0,
+            'attempt': 0,
+            'success': 0,
+            'failure': 0,
+            'open': 0,
+            'sleep': 0.0,
+            'time': 0.0
+        }
+
+    @property
+    def stat(self):
+        with self._lock:
+            return dict(self._stat)
+
+    def _count(self, key, n=1):
+        with self._lock:
+            self._stat[key] += n
+
+    def rule(self, e):
+        for cls, base in self._rules.items():
+            if isinstance(e, cls):
+                return base
+        return self.RAISE
+
+    def delay(self, base, attempt):
+        '''
+        attempt: 0, 1, 2, ..
+        '''
+        d = min(self._max_delay, base * self._factor ** attempt)
+        return d * (1.0 - self._jitter) + random.uniform(0, d * self._jitter)
+
+    def call(self, func, *args, retry=None, key=None, deadline=None,
+             **kwargs):
+        '''
+        key: circuit breaker key (device address)
+        deadline: time.time() value. no more retry after this
+        '''
+        if retry is None:
+            retry = self._retry
+
+        if key is not None and self._breaker is not None:
+            if not self._breaker.allow(key):
+                self._count('open')
+                raise CircuitOpenError('%s: %s: circuit open' % (
+                    self.name, key))
+
+        self._count('call')
+        start = time.time()
+        try:
+            ret = self._call(func, args, kwargs, retry, deadline)
+        except Exception:
+            self._count('failure')
+            if key is not None and self._breaker is not None:
+                self._breaker.failure(key)
+            raise
+        finally:
+            self._count('time', time.time() - start)
+
+        self._count('success')
+        if key is not None and self._breaker is not None:
+            self._breaker.success(key)
+        return ret
+
+    def _call(self, func, args, kwargs, retry, deadline):
+        last = None
+        attempt = 0
+        while attempt < retry:
+            if deadline is not None and time.time() >= deadline:
+                raise RetryTimeoutError('%s: timeout .. %s/%s' % (
+                    self.name, attempt, retry), last)
+
+            self._count('attempt')
+            try:
+                return func(*args, **kwargs)
+
+            except Exception as e:
+                base = self.rule(e)
+                if base is self.RAISE:
+                    raise
+
+                last = e
+                attempt += 1
+                self._log.warning('%s: NG .. %s/%s: %s:%s', self.name,
+                                  attempt, retry, type(e).__name__, e)
+                if attempt >= retry:
+                    break
+
+                d = self.delay(base, attempt - 1)
+                if deadline is not None:
+                    d = min(d, max(0.0, deadline - time.time()))
+                self._count('sleep', d)
+                time.sleep(d)
+
+        raise RetryError('%s: failed .. %s/%s' % (self.name, attempt, retry),
+                         last)
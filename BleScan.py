@@ -10,14 +10,32 @@ __date__   = '2020'
 
 from bluepy import btle
 import time
-import binascii
 import sys
 import click
+from BleScanPool import BleScanPool, DevInfoQueue
+from GattCache import GattCache
+from HciScanner import HciScanner
+from AdvLog import AdvLogWriter, AdvLogDelegate, AdvReplayScanner
+from AdvArchive import AdvArchiveWriter
+from AdvFilter import AdvFilter
+from AdView import AdView
+from DevTable import DevTable
+from BlePresence import BlePresence
+from ScanScheduler import ScanScheduler
+from AdvMerge import AdvMergeDelegate
+from ScanUntil import ScanUntil, Targets
+from GattDecoder import GattDecoder
+from BleUuid import BleUuid, UuidIndex
+from RpaResolver import RpaResolver
+from BleRetry import RetryPolicy, CircuitBreaker
+from BleRetry import RetryError, RetryTimeoutError
 from MyLogger import get_logger
 CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
 
 
 class ScanDelegate(btle.DefaultDelegate):
+    STAT_INTERVAL = 60  # sec
+
     _log = None
 
     def __init__(self, ble_scan, debug=False):
@@ -26,27 +44,68 @@ class ScanDelegate(btle.DefaultDelegate):
         self._log.debug('')
 
         self._ble_scan = ble_scan
-        self._addrs = self._ble_scan.addrs
+        self._filter = self._ble_scan.adv_filter
+
+        self._stat = {
+            'count': 0,
+            'time': 0.0,
+            'max_time': 0.0
+        }
+        self._stat_time = time.time()
+
+    @property
+    def stat(self):
+        stat = dict(self._stat)
+        stat['avg_time'] = stat['time'] / max(stat['count'], 1)
+        return stat
 
     def handleDiscovery(self, dev, isNewDev, isNewData):
+        start = time.time()
+
+        self._handleDiscovery(dev, isNewDev, isNewData)
+
+        t = time.time() - start
+        self._stat['count'] += 1
+        self._stat['time'] += t
+        self._stat['max_time'] = max(self._stat['max_time'], t)
+
+        if start - self._stat_time >= self.STAT_INTERVAL:
+            self._stat_time = start
+            self._log.info('callback=%s', self.stat)
+            self._log.info('queue=%s', self._ble_scan.dev_info_queue.stat)
+
+    def _handleDiscovery(self, dev, isNewDev, isNewData):
         self._log.debug('isNewDev=%s, isNewData=%s', isNewDev, isNewData)
 
         target = False
         newflag = '[-]'
 
+        match = self._filter.match_dev(dev)
+        addr = self._ble_scan.identity(dev)
+
         if isNewData:
             newflag = '[U]'
-            if len(self._addrs) == 0 or dev.addr in self._addrs:
+            if match:
                 target = True
 
         if isNewDev:
             newflag = '[N]'
-            if len(self._addrs) == 0 or dev.addr in self._addrs:
-                self._ble_scan.devs.append(dev)
+
+        # a new private address of a known identity. forget the old one
+        rec = self._ble_scan.dev_table.get(addr)
+        if rec is not None and rec.dev.addr != dev.addr:
+            self._ble_scan.forget(rec.dev.addr)
+
+        (rec, is_new) = self._ble_scan.dev_table.update(dev, addr=addr)
+        if match:
+            rec.target = True
+            if self._ble_scan.presence is not None:
+                self._ble_scan.presence.update(addr, dev.rssi)
 
         if target and isNewData and self._ble_scan.scan_timeout == 0:
             self._log.debug('newflag=%s', newflag)
-            self._ble_scan.dev_info(dev, conn_svc=self._ble_scan._conn_svc)
+            self._ble_scan.dev_info_queue.put(
+                dev, conn_svc=self._ble_scan._conn_svc)
         elif self._ble_scan.scan_timeout != 0:
             self._log.debug('newflag=%s', newflag)
             self._ble_scan.dev_info(dev, dev_data=False, conn_svc=0)
@@ -61,69 +120,295 @@ class BleScan:
       2900-29ff  Characteristic Descriptors
       2a00-7fff  Characteristic Types
     '''
-    BASE_UUID = '0000%s-0000-1000-8000-00805f9b34fb'
     SERVICE = {
-        BASE_UUID % '1800': {
+        BleUuid(0x1800): {
             'Name': '<GeneralAccess>',
             'Characteristic': {
-                BASE_UUID % '2a00': {
+                BleUuid(0x2a00): {
                     'Name': '<Device Name>'
                 },
-                BASE_UUID % '2a01': {
+                BleUuid(0x2a01): {
                     'Name': '<Appearance>'
                 },
             }
         },
-        BASE_UUID % '1801': {
+        BleUuid(0x1801): {
             'Name': '<Generic Attribute>',
             'Characteristic': {
-                BASE_UUID % '': {
+                BleUuid(0x2a05): {
                     'Name': '<Service Changed>'
                 }
             }
         }
     }
-        
+    SERVICE_INDEX = UuidIndex(SERVICE)
+
+    CONN_RETRY_BASE = 0.5  # sec
+    GATT_RETRY_BASE = 0.1  # sec
+
+    ATT_DEFAULT_MTU = 23
+    DEF_MTU = 247          # requested on connection. 0: no exchange
+
     _log = None
 
     def __init__(self, addrs=(), hci=0, scan_timeout=5,
                  conn_svc=3, get_chara=3, read_chara=3,
+                 peripheral=None, gatt_cache=None, breaker=None,
+                 workers=DevInfoQueue.DEF_WORKERS, scanner=None,
+                 adv_filter=None, max_devs=DevTable.DEF_MAX_SIZE,
+                 dev_ttl=DevTable.DEF_TTL, presence=None, merge=None,
+                 mtu=DEF_MTU, batch_read=True, decoder=None, resolver=None,
                  debug=False):
+        '''
+        presence: BlePresence. updated with the target devices
+        merge: sec. merge advertising and scan response data
+          (AdvMergeDelegate) if given
+        mtu: ATT MTU requested on connection, 0 for the default (23)
+        batch_read: read characteristics of the same UUID at once
+          (Read By Type)
+        decoder: GattDecoder for the characteristic values
+        resolver: RpaResolver. a device with a resolvable private address
+          is filtered, tracked and shown by the identity
+        '''
         self._dbg = debug
         __class__._log = get_logger(__class__.__name__, self._dbg)
         self._log.debug('addrs=%s, hci=%s, scan_timeout=%s',
                         addrs, hci, scan_timeout)
+        self._log.debug('max_devs=%s, dev_ttl=%s', max_devs, dev_ttl)
+        self._log.debug('presence=%s, merge=%s', presence, merge)
+        self._log.debug('mtu=%s, batch_read=%s', mtu, batch_read)
+        self._log.debug('resolver=%s', resolver)
 
         self.addrs = addrs
+        self.resolver = resolver
+
+        # AdvFilter. addrs are used if not given
+        self.adv_filter = adv_filter
+        if self.adv_filter is None:
+            self.adv_filter = AdvFilter(addrs=self.addrs,
+                                        resolver=self.resolver,
+                                        debug=self._dbg)
+
         self._hci = hci
         self.scan_timeout = scan_timeout
         self._conn_svc = conn_svc
         self._get_chara = get_chara
         self._read_chara = read_chara
 
+        self._peripheral = peripheral
+        if self._peripheral is None:
+            self._peripheral = btle.Peripheral
+
+        self._gatt_cache = gatt_cache
+        self._mtu = mtu
+        self._batch_read = batch_read
+
+        self.decoder = decoder
+        if self.decoder is None:
+            self.decoder = GattDecoder(self.SERVICE_INDEX, debug=self._dbg)
+
+        self.presence = presence
+
+        # per device circuit breaker, shared with other BleScan objects
+        # if given
+        self._breaker = breaker
+        if self._breaker is None:
+            self._breaker = CircuitBreaker(debug=self._dbg)
+
+        self._conn_retry = RetryPolicy(
+            'Connection',
+            rules={btle.BTLEDisconnectError: self.CONN_RETRY_BASE,
+                   Exception: self.GATT_RETRY_BASE},
+            breaker=self._breaker, debug=self._dbg)
+        self._gatt_retry = RetryPolicy(
+            'GATT',
+            rules={btle.BTLEDisconnectError: RetryPolicy.RAISE,
+                   Exception: self.GATT_RETRY_BASE},
+            debug=self._dbg)
+
+        # interrogation in continuous scan mode
+        self.dev_info_queue = DevInfoQueue(self, workers=workers,
+                                           debug=self._dbg)
+
         self._delegate = ScanDelegate(self, debug=self._dbg)
-        self._scanner = btle.Scanner(self._hci).withDelegate(self._delegate)
 
-        self.devs = []
+        self._merger = None
+        if merge is not None:
+            self._merger = AdvMergeDelegate(self._delegate, merge,
+                                            debug=self._dbg)
+
+        # bluepy.btle.Scanner compatible object (ex. HciScanner)
+        self._scanner = scanner
+        if self._scanner is None:
+            self._scanner = btle.Scanner(self._hci)
+        self._scanner.withDelegate(self._merger or self._delegate)
+
+        # every scanned device. evicted ones are also removed from
+        # the scanner
+        self.dev_table = DevTable(max_devs, dev_ttl, on_evict=self._on_evict,
+                                  debug=self._dbg)
+
+    @property
+    def devs(self):
+        '''
+        target devices
+        '''
+        return self.dev_table.targets()
+
+    def identity(self, dev):
+        '''
+        Returns
+        -------
+        addr: identity of a resolvable private address, or dev.addr
+        '''
+        if self.resolver is None:
+            return dev.addr
+        return self.resolver.resolve(dev.addr) or dev.addr
+
+    def _on_evict(self, rec, reason):
+        self.forget(rec.dev.addr)
+
+    def forget(self, addr):
+        '''
+        remove the address from the scanner
+        '''
+        forget = getattr(self._scanner, 'forget', None)
+        if forget is not None:
+            forget(addr)
+            return
+
+        scanned = getattr(self._scanner, 'scanned', None)
+        if scanned is not None:
+            scanned.pop(addr, None)
 
     def end(self):
         self._log.debug('')
+        if self._merger is not None:
+            self._merger.flush()
+        if self.presence is not None:
+            self.presence.stop()
+            self.presence.check()
+        self.dev_info_queue.stop()
+        self._log.debug('retry_stat=%s', self.retry_stat())
+        self._log.debug('callback_stat=%s', self._delegate.stat)
+        if self._merger is not None:
+            self._log.debug('merge_stat=%s', self._merger.stat)
+        self._log.debug('queue_stat=%s', self.dev_info_queue.stat)
+        self._log.debug('dev_table_stat=%s', self.dev_table.stat)
+        if self.resolver is not None:
+            self._log.debug('resolver_stat=%s', self.resolver.stat)
+        if self.presence is not None:
+            self._log.debug('presence_stat=%s', self.presence.stat)
+
+    def retry_stat(self):
+        return {
+            self._conn_retry.name: self._conn_retry.stat,
+            self._gatt_retry.name: self._gatt_retry.stat
+        }
 
-    def scan(self, scan_timeout=None):
-        self._log.debug('scan_timeout=%s', scan_timeout)
+    def scan(self, scan_timeout=None, passive=False):
+        self._log.debug('scan_timeout=%s, passive=%s', scan_timeout, passive)
 
         if scan_timeout is None:
             scan_timeout = self.scan_timeout
             self._log.debug('scan_timeout=%s', scan_timeout)
 
-        devs = self._scanner.scan(scan_timeout, passive=False)
+        if self.scan_timeout == 0:
+            self.dev_info_queue.start()
+
+        if self._merger is not None:
+            self._merger.passive = passive
+
+        # 'leave' while no advertisement comes
+        if self.presence is not None and scan_timeout == 0:
+            self.presence.start()
+
+        devs = self._scanner.scan(scan_timeout, passive=passive)
+        self._scan_end()
+        return devs
+
+    def _scan_end(self):
+        '''
+        at the end of each scan window
+        '''
+        # the pairs without scan response in this scan window
+        if self._merger is not None:
+            self._merger.flush()
+
+        if self.presence is not None:
+            self.presence.check()
+
+    def scan_until(self, until, scan_timeout=None, passive=False):
+        '''
+        scan until 'until' is satisfied, or scan_timeout sec.
+        see ScanUntil.scan()
+
+        until: func(dev) -> bool, or addresses and Local Names
+        '''
+        self._log.debug('until=%s, scan_timeout=%s, passive=%s',
+                        until, scan_timeout, passive)
+
+        if scan_timeout is None:
+            scan_timeout = self.scan_timeout
+            self._log.debug('scan_timeout=%s', scan_timeout)
+
+        if self.scan_timeout == 0:
+            self.dev_info_queue.start()
+
+        if self._merger is not None:
+            self._merger.passive = passive
+
+        # addresses are matched with the identity
+        if self.resolver is not None and not callable(until):
+            if isinstance(until, str):
+                until = [until]
+            until = Targets(until, identity=self.identity)
+
+        scan_until = ScanUntil(self._scanner, debug=self._dbg)
+        devs = scan_until.scan(until, scan_timeout, passive=passive)
+        self._scan_end()
+        self._log.debug('satisfied=%s, elapsed=%.3f',
+                        scan_until.satisfied, scan_until.elapsed)
         return devs
 
+    def restart_scanner(self):
+        '''
+        stop bluepy-helper left running (ex. by an error in a scan).
+        it is started again by the next scan
+
+        Returns
+        -------
+        stopped: False if not running
+        '''
+        self._log.debug('')
+
+        # bluepy.btle.Scanner has no public method for this.
+        # scan() stops the helper at the end of each window
+        stop_helper = getattr(self._scanner, '_stopHelper', None)
+        if stop_helper is not None:
+            if getattr(self._scanner, '_helper', None) is None:
+                return False
+            stop_helper()
+            return True
+
+        try:
+            self._scanner.stop()
+        except Exception as e:
+            self._log.warning('%s:%s', type(e).__name__, e)
+            return False
+        return True
+
     def dev_info(self, dev, dev_data=True,
-                 conn_svc=None, get_chara=None, read_chara=None):
+                 conn_svc=None, get_chara=None, read_chara=None,
+                 hci=None, deadline=None, report=None):
+        '''
+        deadline: time.time() value. no more retry after this
+        report: dict. filled with the services and characteristics
+        '''
         self._log.debug('dev_data=%s', dev_data)
         self._log.debug('conn_svc=%s, get_chara=%s, read_chara=%s',
                         conn_svc, get_chara, read_chara)
+        self._log.debug('hci=%s, deadline=%s', hci, deadline)
 
         if conn_svc is None:
             conn_svc = self._conn_svc
@@ -137,7 +422,11 @@ class BleScan:
             read_chara = self._read_chara
             self._log.debug('read_chara=%s', read_chara)
 
-        self._log.debug('%s', self.dev2string(dev))
+        if hci is None:
+            hci = self._hci
+            self._log.debug('hci=%s', hci)
+
+        self._log.debug('%s', self.dev2string(dev, self.identity(dev)))
 
         if dev_data:
             self.dev_data(dev, indent=4)
@@ -152,48 +441,50 @@ class BleScan:
 
         self._log.debug('try to connect ..')
 
-        count = 0  # < 0: OK
-        while count < conn_svc:
-            try:
-                with btle.Peripheral(dev, dev.addrType) as peri:
-                    self._log.debug('Connection: OK .. %d/%d',
-                                    count + 1, conn_svc)
-                    ret = self.dump_svc(peri, get_chara, read_chara, indent=2)
-                    self._log.debug('dump_svc()> %s', ret)
-                    count = -1
-
-                return 'OK'
-
-            except btle.BTLEDisconnectError as e:
-                self._log.debug('%s:%s', type(e).__name__, e)
-                self._log.warning('Connection: NG .. %d/%d',
-                                  count + 1, conn_svc)
-                time.sleep(1)
-                count += 1
-
-            except Exception as e:
-                self._log.warning('%s:%s', type(e).__name__, e)
-                self._log.warning('Connection: NG .. %d/%d',
-                                  count + 1, conn_svc)
-                count += 1
-
-        return 'Error'
+        try:
+            ret = self._conn_retry.call(self._connect_dump,
+                                        dev, hci, get_chara, read_chara,
+                                        deadline, report,
+                                        retry=conn_svc, key=dev.addr,
+                                        deadline=deadline)
+            self._log.debug('_connect_dump()> %s', ret)
+            return 'OK'
+
+        except RetryTimeoutError as e:
+            self._log.warning('%s', e)
+            return 'Timeout'
+
+        except RetryError as e:
+            self._log.warning('%s', e)
+            return 'Error'
+
+    def _connect_dump(self, dev, hci, get_chara, read_chara,
+                      deadline=None, report=None):
+        if report is not None:
+            report['svcs'] = []
+
+        with self._peripheral(dev.addr, dev.addrType, iface=hci) as peri:
+            self._log.debug('Connection: OK')
+            return self.dump_svc(peri, get_chara, read_chara, indent=2,
+                                 deadline=deadline, report=report)
 
     @classmethod
-    def dev2string(cls, dev):
+    def dev2string(cls, dev, identity=None):
+        '''
+        identity: shown if it is not dev.addr
+        '''
         cls._log.debug('')
 
         ret = 'Device '
 
-        name = ''
-        for (adtype, desc, val) in dev.getScanData():
-            if 'Local Name' in desc:
-                name = val
-        if name != '':
+        name = AdView.of(dev).name
+        if name:
             ret += '"' + name + '"'
 
         ret += '[%s](%s) %s dBm connectable:%s' % (dev.addr, dev.addrType,
                                                    dev.rssi, dev.connectable)
+        if identity is not None and identity != dev.addr:
+            ret += ' identity:%s' % identity
         return ret
 
     def dev_data(self, dev, indent=4):
@@ -201,12 +492,15 @@ class BleScan:
 
         indent_str = ' ' * indent
 
-        for (adtype, desc, val) in dev.getScanData():
-            self._log.debug('%s%s: "%s"', indent_str, desc, val)
+        view = AdView.of(dev)
+        for (adtype, val) in view.items():
+            self._log.debug('%s%s: "%s"', indent_str,
+                            view.description(adtype), view.text(adtype, val))
         if not dev.scanData:
             self._log.debug('%s(no data)', indent_str)
 
-    def dump_svc(self, peri, get_chara=None, read_chara=None, indent=2):
+    def dump_svc(self, peri, get_chara=None, read_chara=None, indent=2,
+                 deadline=None, report=None):
         self._log.debug('read_chara=%s, indent=%d', read_chara, indent)
 
         if get_chara is None:
@@ -219,15 +513,149 @@ class BleScan:
 
         indent_str = ' ' * indent
 
-        svcs = sorted(peri.services, key=lambda s: s.hndStart)
+        svcs = None
+        if self._gatt_cache is not None:
+            svcs = self._gatt_cache.services(peri)
+            self._log.debug('svcs(cache)=%s', svcs)
+
+        cached = svcs is not None
+        if not cached:
+            svcs = sorted(peri.services, key=lambda s: s.hndStart)
+
+        mtu = self.exchange_mtu(peri)
+        if report is not None:
+            report['mtu'] = mtu
+
         for s in svcs:
-            self._log.debug('%sService [%s]', indent_str, s.uuid)
-            ret = self.dump_chara(s, get_chara, read_chara, indent=indent+2)
+            self._log.debug('%sService [%s] %s', indent_str, s.uuid,
+                            self.decoder.name(s.uuid) or '')
+
+            svc_report = None
+            if report is not None:
+                svc_report = {
+                    'uuid': str(s.uuid),
+                    'hndStart': s.hndStart,
+                    'hndEnd': s.hndEnd,
+                    'charas': []
+                }
+                report['svcs'].append(svc_report)
+
+            ret = self.dump_chara(s, get_chara, read_chara, indent=indent+2,
+                                  deadline=deadline, report=svc_report,
+                                  mtu=mtu)
             self._log.debug('dump_chara()> %s', ret)
 
+        if self._gatt_cache is not None and not cached and get_chara > 0:
+            self._gatt_cache.put(peri.addr, svcs)
+
         return len(svcs)
 
-    def dump_chara(self, svc, get_chara=3, read_chara=3, indent=8):
+    def read_uuid(self, dev, uuid, hci=None):
+        '''
+        read a characteristic value by UUID.
+        with gatt_cache, go straight to the known handle
+        without service discovery.
+        '''
+        self._log.debug('uuid=%s, hci=%s', uuid, hci)
+
+        if hci is None:
+            hci = self._hci
+
+        with self._peripheral(dev.addr, dev.addrType, iface=hci) as peri:
+            hnd = None
+            if self._gatt_cache is not None:
+                if self._gatt_cache.services(peri) is not None:
+                    hnd = self._gatt_cache.handle(dev.addr, uuid)
+                self._log.debug('hnd(cache)=%s', hnd)
+
+            if hnd is not None:
+                return peri.readCharacteristic(hnd)
+
+            svcs = sorted(peri.services, key=lambda s: s.hndStart)
+            charas = [c for s in svcs for c in s.getCharacteristics(uuid)]
+            if self._gatt_cache is not None:
+                self._gatt_cache.put(dev.addr, svcs)
+
+            if len(charas) == 0:
+                return None
+            return charas[0].read()
+
+    def exchange_mtu(self, peri):
+        '''
+        Returns
+        -------
+        mtu: negotiated ATT MTU
+        '''
+        self._log.debug('mtu=%s', self._mtu)
+
+        set_mtu = getattr(peri, 'setMTU', None)
+        if not self._mtu or set_mtu is None:
+            return self.ATT_DEFAULT_MTU
+
+        try:
+            resp = set_mtu(self._mtu)
+        except btle.BTLEDisconnectError:
+            raise
+        except btle.BTLEException as e:
+            self._log.warning('setMTU: %s:%s', type(e).__name__, e)
+            return self.ATT_DEFAULT_MTU
+
+        mtu = resp.get('mtu', [self.ATT_DEFAULT_MTU])[0]
+        self._log.debug('mtu=%s', mtu)
+        return mtu
+
+    def read_by_type(self, svc, charas, read_chara=3,
+                     mtu=ATT_DEFAULT_MTU):
+        '''
+        read the values of the characteristics with one Read By Type
+        request for each UUID that appears more than once.
+
+        only one response PDU is read for each UUID, and a value that
+        fills the attribute data is possibly truncated. such values and
+        the missing ones are not returned (to be read one by one).
+
+        Returns
+        -------
+        vals: {value handle: value}
+        '''
+        self._log.debug('svc=%s, mtu=%s', svc, mtu)
+
+        peri = getattr(svc, 'peripheral', None)
+        read = getattr(peri, '_readCharacteristicByUUID', None)
+        if read is None or read_chara < 1:
+            return {}
+
+        group = {}
+        for c in charas:
+            group.setdefault(str(c.uuid), []).append(c.valHandle)
+
+        # handle (2 bytes) + value in (MTU - 2) bytes, 255 at most
+        max_len = min(mtu - 4, 253)
+
+        vals = {}
+        for (uuid, hnds) in group.items():
+            if len(hnds) < 2:
+                continue
+
+            try:
+                resp = self._gatt_retry.call(read, uuid,
+                                             svc.hndStart, svc.hndEnd,
+                                             retry=read_chara)
+            except RetryError as e:
+                self._log.debug('%s: %s', uuid, e)
+                continue
+
+            for (hnd, val) in zip(resp.get('hnd', []), resp.get('d', [])):
+                if hnd in hnds and len(val) < max_len:
+                    vals[hnd] = val
+
+            self._log.debug('%s: %d/%d', uuid,
+                            len([h for h in hnds if h in vals]), len(hnds))
+
+        return vals
+
+    def dump_chara(self, svc, get_chara=3, read_chara=3, indent=8,
+                   deadline=None, report=None, mtu=ATT_DEFAULT_MTU):
         self._log.debug('get_chara=%s, read_chara=%d, indent=%d',
                        get_chara, read_chara, indent)
 
@@ -244,37 +672,58 @@ class BleScan:
 
         indent_str = ' ' * indent
 
-        count = 0
-        while count < get_chara:
-            try:
-                chara = svc.getCharacteristics()
-                count = -1
-                break
-            except btle.BTLEDisconnectError as e:
-                self._log.warning('%s:%s', type(e).__name__, e)
-                raise e
-            except Exception as e:
-                self._log.warning('%s:%s', type(e).__name__, e)
-                time.sleep(1)
-                count += 1
-
-        if count >= 0:  # failed
+        try:
+            chara = self._gatt_retry.call(svc.getCharacteristics,
+                                          retry=get_chara)
+        except RetryError as e:
             self._log.warning('%s(getCharacteristics: failed)', indent_str)
-            raise RuntimeError('getCharacteristics: failed')
+            raise RuntimeError('getCharacteristics: failed') from e
+
+        vals = {}
+        if self._batch_read and read_chara > 0 and \
+           (deadline is None or time.time() < deadline):
+            vals = self.read_by_type(
+                svc, [c for c in chara if c.supportsRead()],
+                read_chara=read_chara, mtu=mtu)
 
         for c in chara:
-            self._log.debug('%s%s', indent_str, c)
+            self._log.debug('%s%s %s', indent_str, c,
+                            self.decoder.name(c.uuid) or '')
             self._log.debug('%s  Properties: %s',
                             indent_str, c.propertiesToString())
 
-            if c.supportsRead():
-                ret = self.chara_read(c, read_chara=read_chara,
-                                      indent=indent+2)
-                self._log.debug('chara_read()> %s', ret)
+            chara_report = None
+            if report is not None:
+                chara_report = {
+                    'uuid': str(c.uuid),
+                    'handle': c.getHandle(),
+                    'props': c.propertiesToString(),
+                    'value': None
+                }
+                report['charas'].append(chara_report)
+
+            if not c.supportsRead():
+                continue
+
+            if deadline is not None and time.time() >= deadline:
+                self._log.warning('%s(read: timeout)', indent_str)
+                if chara_report is not None:
+                    chara_report['error'] = 'Timeout'
+                continue
+
+            ret = self.chara_read(c, read_chara=read_chara, indent=indent+2,
+                                  val=vals.get(c.valHandle))
+            self._log.debug('chara_read()> %s', ret)
+
+            if chara_report is not None:
+                chara_report['value'] = ret
 
         return len(chara)
 
-    def chara_read(self, chara, read_chara=5, indent=10):
+    def chara_read(self, chara, read_chara=5, indent=10, val=None):
+        '''
+        val: already read value (ex. by read_by_type())
+        '''
         self._log.debug('read_chara=%d, indent=%d', read_chara, indent)
 
         if read_chara is None:
@@ -286,40 +735,17 @@ class BleScan:
 
         indent_str = ' ' * indent
 
-        count = 0
-        while count < read_chara:
+        if val is None:
             try:
-                val = chara.read()
-                count = -1
-                break
-            except btle.BTLEDisconnectError as e:
-                self._log.warning('%s:%s', type(e).__name__, e)
-                raise e
-            except Exception as e:
-                self._log.warning('%s:%s', type(e).__name__, e)
-                time.sleep(1)
-                count += 1
-
-        if count >= 0:  # read failed
-            self._log.warning('%s(read: failed)', indent_str)
-            raise RuntimeError('read: failed')
-
-        val_str1 = ''
-        val_str2 = ''
-        if chara.uuid == btle.AssignedNumbers.device_name:
-            val_str1 = '"' + val.decode('utf-8') + '"'
-        elif chara.uuid == btle.AssignedNumbers.device_information:
-            val_str1 = '|' + repr(val) + '|'
-        else:
-            val_str1 = '%a' % val
-            # val_str2 = '<' + binascii.b2a_hex(val).decode('utf-8') + '>'
-            s = binascii.b2a_hex(val).decode('utf-8')
-            val_str2 = ' '.join([s[i:i+2] for i in range(0, len(s), 2)])
-            val_str2 = '<' + val_str2 + '>'
+                val = self._gatt_retry.call(chara.read, retry=read_chara)
+            except RetryError as e:
+                self._log.warning('%s(read: failed)', indent_str)
+                raise RuntimeError('read: failed') from e
 
-        self._log.debug('%sValue: %s', indent_str, val_str1)
-        if val_str2 != '':
-            self._log.debug('%s      %s', indent_str, val_str2)
+        (val_str, hex_str) = self.decoder.render(chara.uuid, val)
+        self._log.debug('%sValue: %s', indent_str, val_str)
+        if hex_str is not None:
+            self._log.debug('%s      %s', indent_str, hex_str)
 
         return val
 
@@ -329,12 +755,42 @@ class App:
 
     def __init__(self, addrs=(), hci=0, scan_timeout=5,
                  conn_svc=3, get_chara=3, read_chara=3,
+                 concurrency=0, dev_timeout=BleScanPool.DEF_DEV_TIMEOUT,
+                 gatt_cache=None, workers=DevInfoQueue.DEF_WORKERS,
+                 backend='bluepy', record=None, replay=None, speed=1.0,
+                 filter_spec=None, max_devs=DevTable.DEF_MAX_SIZE,
+                 dev_ttl=DevTable.DEF_TTL, presence=None,
+                 near_rssi=BlePresence.DEF_NEAR_RSSI,
+                 far_rssi=BlePresence.DEF_FAR_RSSI, adaptive=None,
+                 passive=False, merge=None, mtu=BleScan.DEF_MTU,
+                 batch_read=True, until=False, irks=(), archive=None,
                  debug=False):
+        '''
+        adaptive: number of windows with ScanScheduler, 0 for forever
+        until: stop scan when all of the addrs are found
+        irks: ['IDENTITY=IRK(hex)', ..] to resolve private addresses
+        archive: directory to archive advertisements (AdvArchiveWriter)
+        '''
         self._dbg = debug
         __class__._log = get_logger(__class__.__name__, self._dbg)
         self._log.debug('hci=%s, scan_timeout=%s', hci, scan_timeout)
         self._log.debug('conn_svc=%s,get_chara=%s,read_chara=%s',
                         conn_svc, get_chara, read_chara)
+        self._log.debug('concurrency=%s, dev_timeout=%s',
+                        concurrency, dev_timeout)
+        self._log.debug('gatt_cache=%s, workers=%s', gatt_cache, workers)
+        self._log.debug('backend=%s', backend)
+        self._log.debug('record=%s, replay=%s, speed=%s',
+                        record, replay, speed)
+        self._log.debug('filter_spec=%s', filter_spec)
+        self._log.debug('max_devs=%s, dev_ttl=%s', max_devs, dev_ttl)
+        self._log.debug('presence=%s, near_rssi=%s, far_rssi=%s',
+                        presence, near_rssi, far_rssi)
+        self._log.debug('adaptive=%s', adaptive)
+        self._log.debug('passive=%s, merge=%s', passive, merge)
+        self._log.debug('mtu=%s, batch_read=%s', mtu, batch_read)
+        self._log.debug('until=%s, irks=%d', until, len(irks))
+        self._log.debug('archive=%s', archive)
 
         self._addrs = addrs
         self._hci = hci
@@ -342,30 +798,141 @@ class App:
         self._conn_svc = conn_svc
         self._get_chara = get_chara
         self._read_chara = read_chara
+        self._passive = passive
+        self._until = until and len(addrs) > 0
+
+        self._gatt_cache = None
+        if gatt_cache is not None:
+            self._gatt_cache = GattCache(gatt_cache, debug=self._dbg)
+
+        scanner = None
+        if backend == 'hci':
+            scanner = HciScanner(self._hci, debug=self._dbg)
+        if replay is not None:
+            scanner = AdvReplayScanner(replay, speed, iface=self._hci,
+                                       debug=self._dbg)
+
+        resolver = None
+        if len(irks) > 0:
+            resolver = RpaResolver.from_spec(irks, debug=self._dbg)
+
+        adv_filter = None
+        if filter_spec is not None:
+            adv_filter = AdvFilter.from_spec(dict(filter_spec,
+                                                  addrs=self._addrs),
+                                             resolver=resolver,
+                                             debug=self._dbg)
+
+        self._presence = None
+        if presence is not None:
+            self._presence = BlePresence(self.print_event, presence,
+                                         near_rssi=near_rssi,
+                                         far_rssi=far_rssi, debug=self._dbg)
 
         self._ble_scan = BleScan(self._addrs, self._hci, self._scan_timeout,
                                  self._conn_svc, self._get_chara,
-                                 self._read_chara, 
-                                 debug=self._dbg)
+                                 self._read_chara,
+                                 gatt_cache=self._gatt_cache,
+                                 workers=workers, scanner=scanner,
+                                 adv_filter=adv_filter, max_devs=max_devs,
+                                 dev_ttl=dev_ttl, presence=self._presence,
+                                 merge=merge, mtu=mtu, batch_read=batch_read,
+                                 resolver=resolver, debug=self._dbg)
+
+        self._writer = None
+        if record is not None:
+            self._writer = AdvLogWriter(record, debug=self._dbg)
+            self._ble_scan._scanner.withDelegate(
+                AdvLogDelegate(self._writer,
+                               self._ble_scan._scanner.delegate))
+
+        self._archive = None
+        if archive is not None:
+            self._archive = AdvArchiveWriter(archive, debug=self._dbg)
+            self._ble_scan._scanner.withDelegate(
+                AdvLogDelegate(self._archive,
+                               self._ble_scan._scanner.delegate))
+
+        self._adaptive = adaptive
+        self._sched = None
+        if self._adaptive is not None:
+            self._sched = ScanScheduler(self._ble_scan, debug=self._dbg)
+
+        self._pool = None
+        if concurrency > 0:
+            self._pool = BleScanPool(self._ble_scan,
+                                     concurrency=concurrency,
+                                     dev_timeout=dev_timeout,
+                                     debug=self._dbg)
 
     def main(self):
         self._log.debug('')
 
         print('=====< Scan start >=====')
-        devs = self._ble_scan.scan()
+        if self._sched is not None:
+            devs = []
+            self._sched.run(self._adaptive, self.print_metrics)
+        elif self._until:
+            devs = self._ble_scan.scan_until(self._addrs,
+                                             passive=self._passive)
+        else:
+            devs = self._ble_scan.scan(passive=self._passive)
         devs2 = self._ble_scan.devs
         print('=====< Scan end: %d devices >=====' % len(devs2))
         self._log.debug('len(devs)=%d, len(dev2)=%d', len(devs), len(devs2))
 
+        if self._pool is not None:
+            report = self._pool.interrogate(devs2,
+                                            conn_svc=self._conn_svc,
+                                            get_chara=self._get_chara,
+                                            read_chara=self._read_chara)
+            self.print_report(report)
+            return
+
         for d in devs2:
             self._ble_scan.dev_info(d, dev_data=True,
                                     conn_svc=self._conn_svc,
                                     get_chara=self._get_chara,
                                     read_chara=self._read_chara)
 
+    def print_metrics(self, devs, metrics):
+        print('-----< %d devices, %.1f adv/s: window=%.1f sec, %s, '
+              'errors=%d, restarts=%d >-----' % (
+                  len(devs), metrics['adverts_per_sec'], metrics['window'],
+                  'passive' if metrics['passive'] else 'active',
+                  metrics['errors'], metrics['restarts']))
+
+    def print_event(self, event, rec):
+        print('%-5s [%s] %.1f dBm (%d dBm) %.2f adv/s' % (
+            event, rec.addr, rec.rssi, rec.raw_rssi, rec.rate))
+
+    def print_report(self, report):
+        self._log.debug('')
+
+        for d in report['devs']:
+            print('[%s](%s) %s dBm hci%s: %s (%.1f sec)' % (
+                d['addr'], d['addrType'], d['rssi'], d['hci'],
+                d['result'], d['elapsed']))
+            for s in d['svcs']:
+                print('  Service [%s]' % (s['uuid']))
+                for c in s['charas']:
+                    print('    %s(0x%02x) %s' % (c['uuid'], c['handle'],
+                                                c['props']))
+                    if c['value'] is not None:
+                        print('      Value: %a' % (c['value']))
+
+        print('=====< %d devices: %.1f sec >=====' % (len(report['devs']),
+                                                     report['elapsed']))
+
     def end(self):
         self._log.debug('')
         self._ble_scan.end()
+        if self._writer is not None:
+            self._writer.close()
+        if self._archive is not None:
+            self._archive.close()
+        if self._gatt_cache is not None:
+            self._gatt_cache.close()
 
 
 
@@ -383,17 +950,115 @@ BLE Device Scanner
               help='get characteristics')
 @click.option('--read_chara', '-r', 'read_chara', type=int, default=3,
               help='read characteristics value')
+@click.option('--concurrency', '-p', 'concurrency', type=int, default=0,
+              help='concurrent connections per interface, 0 for sequential')
+@click.option('--dev_timeout', '-T', 'dev_timeout', type=int,
+              default=BleScanPool.DEF_DEV_TIMEOUT,
+              help='deadline sec for each device (with --concurrency). '
+              'checked between GATT calls, a hung connect is not '
+              'interrupted')
+@click.option('--gatt_cache', '-C', 'gatt_cache', type=str, default=None,
+              help='GATT cache file (ex. %s)' % GattCache.DEF_CACHE_FILE)
+@click.option('--workers', '-w', 'workers', type=int,
+              default=DevInfoQueue.DEF_WORKERS,
+              help='connection threads for continuous scan')
+@click.option('--backend', '-b', 'backend',
+              type=click.Choice(['bluepy', 'hci']), default='bluepy',
+              help='scanner backend (hci: raw HCI socket)')
+@click.option('--record', '-R', 'record', type=str, default=None,
+              help='record advertisements to the log file')
+@click.option('--replay', '-P', 'replay', type=click.Path(exists=True),
+              default=None,
+              help='replay advertisements from the log file')
+@click.option('--speed', 'speed', type=float, default=1.0,
+              help='replay speed, 0 for as fast as possible')
+@click.option('--oui', 'ouis', type=str, multiple=True,
+              help='filter: address prefix (ex. ac:23:3f)')
+@click.option('--name', 'names', type=str, multiple=True,
+              help='filter: Local Name glob (ex. "MyESP*")')
+@click.option('--uuid', 'uuids', type=str, multiple=True,
+              help='filter: service UUID')
+@click.option('--company', 'companies', type=str, multiple=True,
+              help='filter: manufacturer company ID (ex. 0x004c)')
+@click.option('--svc_data', 'svc_data', type=str, multiple=True,
+              help='filter: service data UUID')
+@click.option('--max_devs', 'max_devs', type=int,
+              default=DevTable.DEF_MAX_SIZE,
+              help='max devices in the device table')
+@click.option('--dev_ttl', 'dev_ttl', type=int, default=DevTable.DEF_TTL,
+              help='sec to forget a device not seen, 0 for never')
+@click.option('--presence', '-E', 'presence',
+              type=click.Choice(BlePresence.SMOOTHING), default=None,
+              help='print presence events with RSSI smoothing')
+@click.option('--near_rssi', 'near_rssi', type=int,
+              default=BlePresence.DEF_NEAR_RSSI,
+              help='presence: near threshold (dBm)')
+@click.option('--far_rssi', 'far_rssi', type=int,
+              default=BlePresence.DEF_FAR_RSSI,
+              help='presence: far threshold (dBm)')
+@click.option('--adaptive', '-A', 'adaptive', type=int, default=None,
+              help='adaptive scan windows (ignore scan_timeout), '
+              '0 for forever')
+@click.option('--passive', 'passive', is_flag=True, default=False,
+              help='passive scan (no scan response)')
+@click.option('--merge', '-m', 'merge', type=float, default=None,
+              help='merge advertising and scan response data, '
+              'wait scan response for MERGE sec')
+@click.option('--mtu', 'mtu', type=int, default=BleScan.DEF_MTU,
+              help='ATT MTU to request, 0 for the default (23)')
+@click.option('--no_batch', 'batch_read', is_flag=True, default=True,
+              flag_value=False,
+              help='read characteristics one by one')
+@click.option('--until', '-u', 'until', is_flag=True, default=False,
+              help='stop scan when all of the ADDRS are found '
+              '(scan_timeout is the deadline)')
+@click.option('--irk', 'irks', type=str, multiple=True,
+              help='resolve private addresses: IDENTITY=IRK(hex), '
+              'IDENTITY is shown and matched with ADDRS and --oui')
+@click.option('--archive', '-a', 'archive', type=str, default=None,
+              help='archive advertisements to the directory (Parquet)')
 @click.option('--debug', '-d', 'debug', is_flag=True, default=False,
               help='debug flag')
-def main(addrs, hci, scan_timeout, conn_svc, get_chara, read_chara, debug):
+def main(addrs, hci, scan_timeout, conn_svc, get_chara, read_chara,
+         concurrency, dev_timeout, gatt_cache, workers, backend,
+         record, replay, speed, ouis, names, uuids, companies, svc_data,
+         max_devs, dev_ttl, presence, near_rssi, far_rssi, adaptive,
+         passive, merge, mtu, batch_read, until, irks, archive, debug):
     logger = get_logger(__name__, debug)
     logger.debug('addrs=%s', addrs)
     logger.debug('hci=%s, scan_timeout=%s', hci, scan_timeout)
     logger.debug('conn_svc=%s, get_chara=%s, read_chara=%s',
                  conn_svc, get_chara, read_chara)
+    logger.debug('concurrency=%s, dev_timeout=%s', concurrency, dev_timeout)
+    logger.debug('gatt_cache=%s, workers=%s', gatt_cache, workers)
+    logger.debug('backend=%s', backend)
+    logger.debug('record=%s, replay=%s, speed=%s', record, replay, speed)
+    logger.debug('ouis=%s, names=%s, uuids=%s, companies=%s, svc_data=%s',
+                 ouis, names, uuids, companies, svc_data)
+    logger.debug('max_devs=%s, dev_ttl=%s', max_devs, dev_ttl)
+    logger.debug('presence=%s, near_rssi=%s, far_rssi=%s',
+                 presence, near_rssi, far_rssi)
+    logger.debug('adaptive=%s', adaptive)
+    logger.debug('passive=%s, merge=%s', passive, merge)
+    logger.debug('mtu=%s, batch_read=%s', mtu, batch_read)
+    logger.debug('until=%s, irks=%d', until, len(irks))
+    logger.debug('archive=%s', archive)
+
+    filter_spec = None
+    if len(ouis + names + uuids + companies + svc_data) > 0:
+        filter_spec = {
+            'ouis': ouis,
+            'names': names,
+            'uuids': uuids,
+            'companies': [int(c, 0) for c in companies],
+            'svc_data': svc_data
+        }
 
     app = App(addrs, hci, scan_timeout, conn_svc, get_chara, read_chara,
-              debug=debug)
+              concurrency, dev_timeout, gatt_cache, workers, backend,
+              record, replay, speed, filter_spec, max_devs, dev_ttl,
+              presence, near_rssi, far_rssi, adaptive, passive, merge,
+              mtu, batch_read, until, irks, archive, debug=debug)
     try:
         app.main()
     finally:
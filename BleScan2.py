@@ -9,10 +9,16 @@ __author__ = 'Yoichi Tanibayashi'
 __date__   = '2020'
 
 from bluepy import btle
-import time
-import binascii
 import sys
 import click
+from AdvFilter import AdvFilter
+from AdParser import AdParser
+from AdView import AdView
+from GattDecoder import HexBytes
+from BleUuid import BleUuid
+from NameCache import NameCache
+from BleRetry import RetryPolicy, RetryError
+from ScanUntil import ScanUntil
 from MyLogger import get_logger
 CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
 
@@ -34,18 +40,25 @@ class ScanDelegate(btle.DefaultDelegate):
 
 
 class BleScan:
-    BASE_UUID = '0000%s-0000-1000-8000-00805f9b34fb'
-    UUID_CHARA_DEVICE_NAME = BASE_UUID % '2a00'
+    UUID_CHARA_DEVICE_NAME = BleUuid(0x2a00)
+
+    CONN_RETRY_BASE = 0.5  # sec
+    REFRESH_TIMEOUT = 1    # sec to wait for the name cache refresh at end
 
     _log = None
 
     def __init__(self, addrs=(), hci=0, scan_timeout=5,
                  conn_svc=3, get_chara=3, read_chara=3,
-                 debug=False):
+                 name_cache=None, peripheral=None, debug=False):
+        '''
+        name_cache: NameCache for read_name()
+        peripheral: btle.Peripheral compatible class
+        '''
         self._dbg = debug
         __class__._log = get_logger(__class__.__name__, self._dbg)
         self._log.debug('addrs=%s, hci=%s, scan_timeout=%s',
                         addrs, hci, scan_timeout)
+        self._log.debug('name_cache=%s', name_cache)
 
         self._addrs = addrs
         self._hci = hci
@@ -53,12 +66,23 @@ class BleScan:
         self._conn_svc = conn_svc
         self._get_chara = get_chara
         self._read_chara = read_chara
+        self._name_cache = name_cache
+
+        self._peripheral = peripheral
+        if self._peripheral is None:
+            self._peripheral = btle.Peripheral
+
+        self._conn_retry = RetryPolicy(
+            'Connection', rules={btle.BTLEException: self.CONN_RETRY_BASE},
+            debug=self._dbg)
 
         self._delegate = ScanDelegate(self, debug=self._dbg)
         self._scanner = btle.Scanner(self._hci).withDelegate(self._delegate)
 
     def end(self):
         self._log.debug('')
+        if self._name_cache is not None:
+            self._name_cache.close(self.REFRESH_TIMEOUT)
 
     def scan(self, scan_timeout=None):
         self._log.debug('scan_timeout=%s', scan_timeout)
@@ -70,16 +94,116 @@ class BleScan:
         devs = self._scanner.scan(scan_timeout, passive=True)
         return devs
 
+    def scan_until(self, until, scan_timeout=None):
+        '''
+        scan until 'until' is satisfied, or scan_timeout sec.
+        see ScanUntil.scan()
+        '''
+        self._log.debug('until=%s, scan_timeout=%s', until, scan_timeout)
+
+        if scan_timeout is None:
+            scan_timeout = self._scan_timeout
+            self._log.debug('scan_timeout=%s', scan_timeout)
+
+        return ScanUntil(self._scanner, debug=self._dbg).scan(
+            until, scan_timeout, passive=True)
+
+    def resolve_name(self, dev):
+        '''
+        Device Name from the cache, or read_name().
+        stale entries are returned as they are (see refresh_names())
+
+        Returns
+        -------
+        name: str or None
+        '''
+        if self._name_cache is not None:
+            ent = self._name_cache.get(dev.addr)
+            if ent is not None:
+                self._log.debug('%s: name(cache)=%s, fresh=%s',
+                                dev.addr, ent[0], ent[1])
+                return ent[0]
+
+        name = self.read_name(dev.addr, dev.addrType)
+        if self._name_cache is not None:
+            self._name_cache.put(dev.addr, name, dev.addrType)
+        return name
+
+    def refresh_names(self, addrs=None):
+        '''
+        refresh the stale cache entries in background
+        '''
+        if self._name_cache is not None:
+            self._name_cache.refresh(self.read_name, addrs)
+
+    def read_name(self, addr, addr_type='public'):
+        '''
+        Returns
+        -------
+        name: str or None (not connected or no Device Name)
+        '''
+        self._log.debug('%s(%s)', addr, addr_type)
+
+        try:
+            return self._conn_retry.call(self._read_name, addr, addr_type,
+                                         retry=self._conn_svc)
+        except RetryError as e:
+            self._log.debug('%s', e)
+            return None
+
+    def _read_name(self, addr, addr_type):
+        with self._peripheral(addr, addr_type, iface=self._hci) as p:
+            self._log.debug('OK')
+
+            try:
+                charas = p.getCharacteristics(
+                    uuid=str(self.UUID_CHARA_DEVICE_NAME))
+            except btle.BTLEGattError as e:
+                self._log.debug('%s:%s', type(e).__name__, e)
+                return None
+
+            for c in charas:
+                name = c.read().decode('utf-8', errors='replace')
+                self._log.debug('name=%s', name)
+                return name
+
+        return None
+
+    def dump_raw_data(self, dev):
+        '''
+        Returns
+        -------
+        ads: list of AdStruct
+        '''
+        ads = AdParser.parse(dev.rawData)
+        for (ad_type, payload) in ads:
+            if ad_type in AdParser.LOCAL_NAME:
+                self._log.debug('%s: "%s"', AdView.description(ad_type),
+                                AdParser.name(payload))
+                continue
+            # hex string only when logged
+            self._log.debug('%s: %s', AdView.description(ad_type),
+                            HexBytes(payload))
+        return ads
+
 
 class App:
     _log = None
 
     def __init__(self, addrs=(), hci=0, scan_timeout=5,
                  conn_svc=3, get_chara=3, read_chara=3,
-                 debug=False):
+                 name_cache=NameCache.DEF_CACHE_FILE,
+                 name_ttl=NameCache.DEF_TTL, until=False, debug=False):
+        '''
+        name_cache: name cache file, None for no cache
+        until: stop scan when all of the addrs are found
+          (address or Local Name)
+        '''
         self._dbg = debug
         __class__._log = get_logger(__class__.__name__, self._dbg)
-        self._log.debug('addrs=%s')
+        self._log.debug('addrs=%s', addrs)
+        self._log.debug('name_cache=%s, name_ttl=%s', name_cache, name_ttl)
+        self._log.debug('until=%s', until)
 
         self._addrs = addrs
         self._hci = hci
@@ -87,106 +211,51 @@ class App:
         self._conn_svc = conn_svc
         self._get_chara = get_chara
         self._read_chara = read_chara
+        self._until = until and len(addrs) > 0
+
+        self._name_cache = None
+        if name_cache:
+            self._name_cache = NameCache(name_cache, name_ttl,
+                                         debug=self._dbg)
 
         self._ble_scan = BleScan(self._addrs, self._hci, self._scan_timeout,
                                  self._conn_svc, self._get_chara,
-                                 self._read_chara, 
+                                 self._read_chara,
+                                 name_cache=self._name_cache,
+                                 debug=self._dbg)
+
+        # addrs may be Local Names
+        self._filter = AdvFilter(addrs=self._addrs, names=self._addrs,
                                  debug=self._dbg)
 
     def main(self):
         self._log.debug('')
 
-        devs = self._ble_scan.scan()
+        if self._until:
+            devs = self._ble_scan.scan_until(self._addrs)
+        else:
+            devs = self._ble_scan.scan()
         self._log.debug('scan end')
-        
-        time.sleep(1)
 
         target_addr = []
         for d in devs:
             self._log.debug('[%s]', d.addr)
-            if len(d.rawData) > 0:
-                self._log.debug('rawData=')
-                self._log.debug('%s',
-                                ['%02x' % c for c in d.rawData])
-
-                part = 'len'
-                data = []
-                l_ = 0
-                i_ = 0
-                for c in d.rawData:
-                    if part == 'len':
-                        l_ = int(c)
-                        i_ = 0
-                        data.append('%02x(%d)' % (c, l_))
-                        part = 'data'
-                        continue
-
-                    data.append('%02x' % c)
-                    i_ += 1
-                    if i_ == l_:
-                        self._log.debug('data=%s', data)
-                        part = 'len'
-                        data = []
-                        l_ = 0
-                        i_ = 0
-                        
-            name = None
-
-            for (adtype, desc, val) in d.getScanData():
-                self._log.debug('desc=%s, val=%s', desc, val)
-                if 'Local Name' in desc:
-                    name = val
-                    self._log.debug('name=%s', val)
-
-            if d.addr in self._addrs:
-                target_addr.append(d.addr)
-            else:
-                continue
+            self._ble_scan.dump_raw_data(d)
 
-            if name in self._addrs:
+            # address or Local Name in advertisement
+            if self._filter.match_dev(d):
                 target_addr.append(d.addr)
+                continue
 
             if not d.connectable:
                 continue
 
-            count = 0
-            while count < self._conn_svc:
-                try:
-                    count += 1
-                    self._log.debug('connecting[%d/%d] ..',
-                                    count, self._conn_svc)
-                    with btle.Peripheral(d.addr, d.addrType) as p:
-                        self._log.debug('OK')
-
-                        # self._log.debug('state=%s', p.getState())
-
-                        p.discoverServices()
-                        # self._log.debug('state=%s', p.getState())
-
-                        for s in p.services:
-                            self._log.debug('s:%s', s.uuid)
-
-                            c = s.getCharacteristics()
-                            for c1 in c:
-                                self._log.debug('c1:%s(%s)', c1, c1.uuid)
-
-                                if c1.uuid == BleScan.UUID_CHARA_DEVICE_NAME:
-                                    name = c1.read().decode('utf-8')
-                                    self._log.debug('name=%s', val)
-
-                        break
-
-                except btle.BTLEDisconnectError as e:
-                    # self._log.debug('%s:%s', type(e).__name__, e)
-                    time.sleep(1)
-
-                except Exception as e:
-                    self._log.debug('%s:%s', type(e).__name__, e)
-                    time.sleep(1)
-
+            # Device Name characteristic (cached)
+            name = self._ble_scan.resolve_name(d)
             if name in self._addrs:
                 target_addr.append(d.addr)
-                continue
+
+        self._ble_scan.refresh_names([d.addr for d in devs])
 
         for t in target_addr:
             print(t)
@@ -210,17 +279,28 @@ BLE Device Scanner
               help='get characteristics')
 @click.option('--read_chara', '-r', 'read_chara', type=int, default=3,
               help='read characteristics value')
+@click.option('--name_cache', '-N', 'name_cache', type=str,
+              default=NameCache.DEF_CACHE_FILE,
+              help='device name cache file, "" for no cache')
+@click.option('--name_ttl', 'name_ttl', type=int, default=NameCache.DEF_TTL,
+              help='sec to refresh a cached name, 0 for never')
+@click.option('--until', '-u', 'until', is_flag=True, default=False,
+              help='stop scan when all of the ADDRS are found '
+              '(scan_timeout is the deadline)')
 @click.option('--debug', '-d', 'debug', is_flag=True, default=False,
               help='debug flag')
-def main(addrs, hci, scan_timeout, conn_svc, get_chara, read_chara, debug):
+def main(addrs, hci, scan_timeout, conn_svc, get_chara, read_chara,
+         name_cache, name_ttl, until, debug):
     logger = get_logger(__name__, debug)
     logger.debug('addrs=%s', addrs)
     logger.debug('hci=%s, scan_timeout=%s', hci, scan_timeout)
     logger.debug('conn_svc=%s, get_chara=%s, read_chara=%s',
                  conn_svc, get_chara, read_chara)
+    logger.debug('name_cache=%s, name_ttl=%s', name_cache, name_ttl)
+    logger.debug('until=%s', until)
 
     app = App(addrs, hci, scan_timeout, conn_svc, get_chara, read_chara,
-              debug=debug)
+              name_cache, name_ttl, until, debug=debug)
     try:
         app.main()
     finally:
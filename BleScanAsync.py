@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+#
+# (c) 2020 Yoichi Tanibayashi
+#
+"""
+asyncio facade for BleScan
+
+all blocking bluepy calls run in dedicated executors.
+
+Usage:
+    ble = BleScanAsync(BleScan(addrs))
+
+    async for dev in ble.adverts():
+        ret = await ble.dev_info(dev, timeout=10)
+        val = await ble.read(dev, uuid, timeout=5)
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__   = '2020'
+
+from concurrent.futures import ThreadPoolExecutor
+from bluepy import btle
+import threading
+import asyncio
+import time
+import click
+from BleScan import BleScan
+from MyLogger import get_logger
+CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
+
+
+class AsyncScanDelegate(btle.DefaultDelegate):
+    '''
+    pass ScanEntry to an asyncio.Queue in the event loop thread
+    '''
+    _log = None
+
+    def __init__(self, loop, q, new_data_only=True, debug=False):
+        self._dbg = debug
+        __class__._log = get_logger(__class__.__name__, self._dbg)
+        self._log.debug('new_data_only=%s', new_data_only)
+
+        self._loop = loop
+        self._q = q
+        self._new_data_only = new_data_only
+
+        self.drop = 0
+
+        super().__init__()
+
+    def handleDiscovery(self, dev, isNewDev, isNewData):
+        if self._new_data_only and not isNewData:
+            return
+
+        self._loop.call_soon_threadsafe(self._put, dev)
+
+    def _put(self, dev):
+        try:
+            self._q.put_nowait(dev)
+        except asyncio.QueueFull:
+            self.drop += 1
+            self._log.warning('%s: dropped (queue full)', dev.addr)
+
+
+class BleScanAsync:
+    DEF_WORKERS = 2
+    DEF_QUEUE_SIZE = 256
+    PROCESS_INTERVAL = 0.5  # sec, latency of cancellation
+
+    _log = None
+
+    def __init__(self, ble_scan, scanner=None, workers=DEF_WORKERS,
+                 debug=False):
+        self._dbg = debug
+        __class__._log = get_logger(__class__.__name__, self._dbg)
+        self._log.debug('scanner=%s, workers=%s', scanner, workers)
+
+        self._ble_scan = ble_scan
+
+        self._scanner = scanner
+        if self._scanner is None:
+            self._scanner = btle.Scanner(self._ble_scan._hci)
+            self._log.debug('_scanner=%s', self._scanner)
+
+        self._scan_executor = ThreadPoolExecutor(max_workers=1)
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+
+        self._scanning = False
+
+    def end(self):
+        self._log.debug('')
+
+        self._scan_executor.shutdown(wait=True)
+        self._executor.shutdown(wait=True)
+
+    async def adverts(self, passive=False, new_data_only=True,
+                      maxsize=DEF_QUEUE_SIZE):
+        '''
+        async iterator of ScanEntry.
+        scanning stops when the iteration is closed or cancelled.
+        '''
+        self._log.debug('passive=%s, new_data_only=%s, maxsize=%s',
+                        passive, new_data_only, maxsize)
+
+        if self._scanning:
+            raise RuntimeError('already scanning')
+        self._scanning = True
+
+        loop = asyncio.get_running_loop()
+        q = asyncio.Queue(maxsize=maxsize)
+        stop = threading.Event()
+
+        self._scanner.withDelegate(AsyncScanDelegate(loop, q, new_data_only,
+                                                     debug=self._dbg))
+        fut = loop.run_in_executor(self._scan_executor, self._scan_loop,
+                                   passive, stop)
+
+        get = None
+        try:
+            while True:
+                get = asyncio.ensure_future(q.get())
+                done, pending = await asyncio.wait(
+                    (get, fut), return_when=asyncio.FIRST_COMPLETED)
+                if get in done:
+                    yield get.result()
+                    continue
+
+                # scanner thread ended
+                get.cancel()
+                fut.result()
+                break
+
+        finally:
+            self._log.debug('stop scanning')
+            if get is not None:
+                get.cancel()
+            stop.set()
+            await asyncio.wait((fut,))
+            self._scanning = False
+
+    def _scan_loop(self, passive, stop):
+        self._log.debug('passive=%s', passive)
+
+        self._scanner.clear()
+        self._scanner.start(passive=passive)
+        try:
+            while not stop.is_set():
+                self._scanner.process(self.PROCESS_INTERVAL)
+        finally:
+            self._scanner.stop()
+
+        self._log.debug('done')
+
+    async def scan(self, scan_timeout=None, passive=False):
+        '''
+        Returns
+        -------
+        devs: list of ScanEntry
+        '''
+        self._log.debug('scan_timeout=%s, passive=%s', scan_timeout, passive)
+
+        if scan_timeout is None:
+            scan_timeout = self._ble_scan.scan_timeout
+
+        devs = {}
+
+        async def collect():
+            async for dev in self.adverts(passive=passive,
+                                          new_data_only=False):
+                devs[dev.addr] = dev
+
+        try:
+            await asyncio.wait_for(collect(), scan_timeout)
+        except asyncio.TimeoutError:
+            pass
+
+        return list(devs.values())
+
+    async def _run(self, timeout, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        fut = loop.run_in_executor(self._executor,
+                                   lambda: func(*args, **kwargs))
+        return await asyncio.wait_for(fut, timeout)
+
+    async def dev_info(self, dev, timeout=None, **kwargs):
+        '''
+        kwargs: passed to BleScan.dev_info()
+
+        bluepy calls can not be interrupted. on timeout or cancellation,
+        the worker stops at the next retry or read (deadline).
+        '''
+        self._log.debug('addr=%s, timeout=%s', dev.addr, timeout)
+
+        if timeout is not None:
+            kwargs['deadline'] = time.time() + timeout
+        kwargs.setdefault('dev_data', False)
+
+        return await self._run(timeout, self._ble_scan.dev_info, dev,
+                               **kwargs)
+
+    async def read(self, dev, uuid, timeout=None, hci=None):
+        self._log.debug('addr=%s, uuid=%s, timeout=%s',
+                        dev.addr, uuid, timeout)
+
+        return await self._run(timeout, self._ble_scan.read_uuid, dev, uuid,
+                               hci=hci)
+
+
+class App:
+    _log = None
+
+    def __init__(self, addrs=(), hci=0, conn_svc=0, dev_timeout=20,
+                 debug=False):
+        self._dbg = debug
+        __class__._log = get_logger(__class__.__name__, self._dbg)
+        self._log.debug('addrs=%s, hci=%s, conn_svc=%s, dev_timeout=%s',
+                        addrs, hci, conn_svc, dev_timeout)
+
+        self._addrs = addrs
+        self._conn_svc = conn_svc
+        self._dev_timeout = dev_timeout
+
+        self._ble_scan = BleScan(addrs, hci, debug=self._dbg)
+        self._ble = BleScanAsync(self._ble_scan, debug=self._dbg)
+
+    def main(self):
+        self._log.debug('')
+        asyncio.run(self.async_main())
+
+    async def async_main(self):
+        self._log.debug('')
+
+        tasks = {}
+        async for dev in self._ble.adverts():
+            if len(self._addrs) > 0 and dev.addr not in self._addrs:
+                continue
+
+            print(self._ble_scan.dev2string(dev))
+
+            if self._conn_svc < 1 or not dev.connectable:
+                continue
+
+            task = tasks.get(dev.addr)
+            if task is not None and not task.done():
+                continue
+
+            tasks[dev.addr] = asyncio.ensure_future(
+                self._ble.dev_info(dev, timeout=self._dev_timeout,
+                                   conn_svc=self._conn_svc))
+
+    def end(self):
+        self._log.debug('')
+        self._ble.end()
+        self._ble_scan.end()
+
+
+@click.command(context_settings=CONTEXT_SETTINGS, help='''
+BLE Device Scanner (asyncio)
+''')
+@click.argument('addrs', type=str, nargs=-1)
+@click.option('--hci', '-i', 'hci', type=int, default=0,
+              help='Interface number for scan')
+@click.option('--conn_svc', '-s', 'conn_svc', type=int, default=0,
+              help='connect service')
+@click.option('--dev_timeout', '-T', 'dev_timeout', type=int, default=20,
+              help='timeout sec for each device')
+@click.option('--debug', '-d', 'debug', is_flag=True, default=False,
+              help='debug flag')
+def main(addrs, hci, conn_svc, dev_timeout, debug):
+    logger = get_logger(__name__, debug)
+    logger.debug('addrs=%s, hci=%s, conn_svc=%s, dev_timeout=%s',
+                 addrs, hci, conn_svc, dev_timeout)
+
+    app = App(addrs, hci, conn_svc, dev_timeout, debug=debug)
+    try:
+        app.main()
+    finally:
+        logger.debug('finally')
+        app.end()
+        logger.info('done')
+
+
+if __name__ == '__main__':
+    main()
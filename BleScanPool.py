@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+#
+# (c) 2020 Yoichi Tanibayashi
+#
+"""
+BLE GATT interrogation pool
+
+Usage:
+    pool = BleScanPool(ble_scan, hcis=(0, 1), concurrency=2)
+    report = pool.interrogate(ble_scan.devs)
+
+    devq = DevInfoQueue(ble_scan, workers=2)
+    devq.start()
+    devq.put(dev, conn_svc=3)  # in handleDiscovery()
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__   = '2020'
+
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import queue
+import time
+from MyLogger import get_logger
+
+
+class BleScanPool:
+    '''
+    bounded worker pool for BleScan.dev_info()
+
+    concurrency: max concurrent connections per HCI adapter
+    dev_timeout: deadline (sec) for each device. it is cooperative:
+      checked before each retry and each characteristic read.
+      a call already running (ex. a hung btle.Peripheral() connect)
+      is not interrupted, and the device takes as long as the call
+    '''
+    DEF_CONCURRENCY = 2
+    DEF_DEV_TIMEOUT = 20  # sec. see dev_timeout above
+
+    _log = None
+
+    def __init__(self, ble_scan, hcis=None,
+                 concurrency=DEF_CONCURRENCY, dev_timeout=DEF_DEV_TIMEOUT,
+                 debug=False):
+        self._dbg = debug
+        __class__._log = get_logger(__class__.__name__, self._dbg)
+        self._log.debug('hcis=%s, concurrency=%s, dev_timeout=%s',
+                        hcis, concurrency, dev_timeout)
+
+        self._ble_scan = ble_scan
+        self._hcis = hcis
+        if self._hcis is None:
+            self._hcis = (self._ble_scan._hci, )
+        self._concurrency = concurrency
+        self._dev_timeout = dev_timeout
+
+        # one slot per connection, interleaved by adapter
+        self._slot = queue.Queue()
+        for i in range(self._concurrency):
+            for hci in self._hcis:
+                self._slot.put(hci)
+
+    def interrogate(self, devs, conn_svc=None, get_chara=None,
+                    read_chara=None):
+        '''
+        Returns
+        -------
+        report: dict
+          {'elapsed': sec, 'devs': [dev_report, ..]}
+        '''
+        self._log.debug('len(devs)=%d', len(devs))
+
+        start = time.time()
+
+        workers = self._concurrency * len(self._hcis)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(self.dev_report, d,
+                                       conn_svc, get_chara, read_chara)
+                       for d in devs]
+            dev_reports = [f.result() for f in futures]
+
+        report = {
+            'elapsed': time.time() - start,
+            'devs': dev_reports
+        }
+        self._log.debug('elapsed=%.3f', report['elapsed'])
+        return report
+
+    def dev_report(self, dev, conn_svc=None, get_chara=None,
+                   read_chara=None):
+        self._log.debug('addr=%s', dev.addr)
+
+        report = {
+            'addr': dev.addr,
+            'addrType': dev.addrType,
+            'rssi': dev.rssi,
+            'connectable': dev.connectable,
+            'hci': None,
+            'result': None,
+            'elapsed': 0.0,
+            'svcs': []
+        }
+
+        if not dev.connectable:
+            return report
+
+        hci = self._slot.get()
+        try:
+            start = time.time()
+            report['hci'] = hci
+            report['result'] = self._ble_scan.dev_info(
+                dev, dev_data=False, conn_svc=conn_svc,
+                get_chara=get_chara, read_chara=read_chara,
+                hci=hci, deadline=start + self._dev_timeout, report=report)
+            report['elapsed'] = time.time() - start
+
+        except Exception as e:
+            self._log.warning('%s:%s', type(e).__name__, e)
+            report['result'] = 'Error'
+
+        finally:
+            self._slot.put(hci)
+
+        self._log.debug('%s: %s', dev.addr, report['result'])
+        return report
+
+
+class DevInfoQueue:
+    '''
+    discovery -> interrogation queue for continuous scan
+
+    put() never blocks: it is called from ScanDelegate.handleDiscovery().
+    consumer threads call BleScan.dev_info().
+    '''
+    DEF_WORKERS = 2
+    DEF_MAXSIZE = 64
+
+    _log = None
+
+    def __init__(self, ble_scan, workers=DEF_WORKERS, maxsize=DEF_MAXSIZE,
+                 debug=False):
+        self._dbg = debug
+        __class__._log = get_logger(__class__.__name__, self._dbg)
+        self._log.debug('workers=%s, maxsize=%s', workers, maxsize)
+
+        self._ble_scan = ble_scan
+        self._workers = workers
+        self._q = queue.Queue(maxsize=maxsize)
+
+        self._lock = threading.Lock()
+        self._pending = set()  # addresses in queue or in progress
+        self._thr = []
+        self._stat = {
+            'put': 0,
+            'dup': 0,
+            'drop': 0,
+            'done': 0,
+            'max_depth': 0
+        }
+
+    @property
+    def stat(self):
+        with self._lock:
+            stat = dict(self._stat)
+        stat['depth'] = self._q.qsize()
+        return stat
+
+    def start(self):
+        self._log.debug('')
+
+        if len(self._thr) > 0:
+            return
+
+        for i in range(self._workers):
+            thr = threading.Thread(target=self.worker, args=(i,), daemon=True)
+            thr.start()
+            self._thr.append(thr)
+
+    def stop(self):
+        self._log.debug('')
+
+        # discard pending work, wait only for the running ones
+        try:
+            while True:
+                (dev, kwargs) = self._q.get_nowait()
+                with self._lock:
+                    self._pending.discard(dev.addr)
+        except queue.Empty:
+            pass
+
+        for thr in self._thr:
+            self._q.put(None)
+        for thr in self._thr:
+            thr.join()
+        self._thr = []
+
+    def put(self, dev, **kwargs):
+        '''
+        kwargs: passed to dev_info()
+
+        Returns
+        -------
+        result: bool
+          False if dropped
+        '''
+        with self._lock:
+            if dev.addr in self._pending:
+                self._stat['dup'] += 1
+                return False
+
+            try:
+                self._q.put_nowait((dev, kwargs))
+            except queue.Full:
+                self._stat['drop'] += 1
+                self._log.warning('%s: dropped (queue full)', dev.addr)
+                return False
+
+            self._pending.add(dev.addr)
+            self._stat['put'] += 1
+            self._stat['max_depth'] = max(self._stat['max_depth'],
+                                          self._q.qsize())
+        return True
+
+    def worker(self, idx):
+        self._log.debug('[%d] start', idx)
+
+        while True:
+            item = self._q.get()
+            if item is None:
+                break
+
+            (dev, kwargs) = item
+            try:
+                ret = self._ble_scan.dev_info(dev, **kwargs)
+                self._log.debug('[%d] %s: %s', idx, dev.addr, ret)
+            except Exception as e:
+                self._log.warning('[%d] %s:%s', idx, type(e).__name__, e)
+            finally:
+                with self._lock:
+                    self._pending.discard(dev.addr)
+                    self._stat['done'] += 1
+
+        self._log.debug('[%d] end', idx)
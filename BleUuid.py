@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+#
+# (c) 2020 Yoichi Tanibayashi
+#
+"""
+Interned UUID as a 128-bit int
+
+BleUuid objects are compared and hashed as int. the same UUID is the
+same object, and parsed strings are cached, so no string formatting
+nor parsing is needed in the hot path.
+
+Usage:
+    DEVICE_NAME = BleUuid(0x2a00)
+    if BleUuid(chara.uuid) == DEVICE_NAME:  # btle.UUID, str or int
+        ..
+
+    index = UuidIndex(BleScan.SERVICE)
+    index.name(chara.uuid)  # '<Device Name>'
+
+int values up to 0xffffffff are taken as 16/32-bit short form.
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__   = '2020'
+
+
+class BleUuid(int):
+    __slots__ = ()
+
+    BASE = 0x0000000000001000800000805f9b34fb
+    SHORT_MAX = 0xffffffff
+    LOW_MASK = (1 << 96) - 1
+
+    MAX_PARSED = 4096
+
+    _interned = {}  # int -> BleUuid
+    _parsed = {}    # str -> BleUuid
+
+    def __new__(cls, val):
+        if isinstance(val, cls):
+            return val
+
+        if type(val) is str:
+            obj = cls._parsed.get(val)
+            if obj is None:
+                obj = cls._intern(cls._parse(val))
+                if len(cls._parsed) >= cls.MAX_PARSED:
+                    cls._parsed.clear()
+                cls._parsed[val] = obj
+            return obj
+
+        if isinstance(val, int):
+            if val < 0:
+                raise ValueError('invalid UUID: %s' % val)
+            if val <= cls.SHORT_MAX:
+                val = (val << 96) | cls.BASE
+            return cls._intern(val)
+
+        bin_val = getattr(val, 'binVal', None)  # btle.UUID
+        if bin_val is not None:
+            return cls._intern(int.from_bytes(bin_val, 'big'))
+
+        return cls(str(val))
+
+    @classmethod
+    def _intern(cls, n):
+        obj = cls._interned.get(n)
+        if obj is None:
+            obj = int.__new__(cls, n)
+            cls._interned[n] = obj
+        return obj
+
+    @classmethod
+    def _parse(cls, s):
+        h = s.replace('-', '')
+        try:
+            n = int(h, 16)
+        except ValueError:
+            raise ValueError('invalid UUID: %s' % s) from None
+
+        if len(h) <= 8:
+            return (n << 96) | cls.BASE
+        if len(h) != 32:
+            raise ValueError('invalid UUID: %s' % s)
+        return n
+
+    @classmethod
+    def from_le(cls, val):
+        '''
+        val: 2, 4 or 16 bytes, little endian (as in AD and ATT)
+        '''
+        if len(val) not in (2, 4, 16):
+            raise ValueError('invalid UUID length: %d' % len(val))
+        n = int.from_bytes(val, 'little')
+        if len(val) == 16:
+            return cls._intern(n)
+        return cls(n)
+
+    @property
+    def short(self):
+        '''
+        16/32-bit value, or None
+        '''
+        if self & self.LOW_MASK != self.BASE:
+            return None
+        return self >> 96
+
+    def __str__(self):
+        s = '%032x' % self
+        return '-'.join([s[0:8], s[8:12], s[12:16], s[16:20], s[20:32]])
+
+    def __repr__(self):
+        short = self.short
+        if short is not None:
+            return 'BleUuid(0x%04x)' % short
+        return "BleUuid('%s')" % self
+
+    def __format__(self, spec):
+        if spec == '':
+            return str(self)
+        return int.__format__(self, spec)
+
+
+class UuidIndex:
+    '''
+    known services and characteristics
+
+    table: {svc_uuid: {'Name': .., 'Characteristic': {uuid: {'Name': ..}}}}
+      (ex. BleScan.SERVICE)
+    '''
+    def __init__(self, table=None):
+        self.services = {}  # BleUuid -> name
+        self.charas = {}    # BleUuid -> (name, service BleUuid)
+
+        if table is not None:
+            self.update(table)
+
+    def update(self, table):
+        for (svc_uuid, svc) in table.items():
+            svc_uuid = BleUuid(svc_uuid)
+            self.services[svc_uuid] = svc.get('Name')
+            for (uuid, chara) in svc.get('Characteristic', {}).items():
+                self.charas[BleUuid(uuid)] = (chara.get('Name'), svc_uuid)
+
+    def __contains__(self, uuid):
+        uuid = BleUuid(uuid)
+        return uuid in self.charas or uuid in self.services
+
+    def __len__(self):
+        return len(self.services) + len(self.charas)
+
+    def name(self, uuid):
+        uuid = BleUuid(uuid)
+        if uuid in self.charas:
+            return self.charas[uuid][0]
+        return self.services.get(uuid)
+
+    def service_of(self, uuid):
+        '''
+        Returns
+        -------
+        svc_uuid: BleUuid of the service of the characteristic, or None
+        '''
+        ent = self.charas.get(BleUuid(uuid))
+        if ent is None:
+            return None
+        return ent[1]
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+#
+# (c) 2020 Yoichi Tanibayashi
+#
+"""
+Bounded device table with TTL and LRU eviction
+
+memory stays flat regardless of how many transient (ex. random)
+addresses pass by.
+
+Usage:
+    def on_evict(rec, reason):  # reason: 'ttl', 'lru' or 'remove'
+        ..
+
+    devs = DevTable(max_size=1024, ttl=300, on_evict=on_evict)
+    (rec, is_new) = devs.update(dev)   # in handleDiscovery()
+    for dev in devs:
+        ..
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__   = '2020'
+
+from collections import OrderedDict
+import time
+from MyLogger import get_logger
+
+
+class DevRecord:
+    __slots__ = ('addr', 'dev', 'first', 'last', 'count', 'target')
+
+    def __init__(self, addr, dev, now):
+        self.addr = addr
+        self.dev = dev
+        self.first = now
+        self.last = now
+        self.count = 0
+        self.target = False
+
+    def __repr__(self):
+        return '<DevRecord %s count=%d target=%s>' % (self.addr, self.count,
+                                                      self.target)
+
+
+class DevTable:
+    DEF_MAX_SIZE = 1024
+    DEF_TTL = 300  # sec, 0: no TTL
+
+    _log = None
+
+    def __init__(self, max_size=DEF_MAX_SIZE, ttl=DEF_TTL, on_evict=None,
+                 debug=False):
+        '''
+        on_evict: func(rec, reason)
+        '''
+        self._dbg = debug
+        __class__._log = get_logger(__class__.__name__, self._dbg)
+        self._log.debug('max_size=%s, ttl=%s, on_evict=%s',
+                        max_size, ttl, on_evict)
+
+        self.max_size = max_size
+        self.ttl = ttl
+        self._on_evict = on_evict
+
+        # least recently seen first
+        self._rec = OrderedDict()
+
+        self.stat = {'add': 0, 'update': 0, 'ttl': 0, 'lru': 0,
+                     'remove': 0}
+
+    def __len__(self):
+        return len(self._rec)
+
+    def __contains__(self, addr):
+        return addr in self._rec
+
+    def __iter__(self):
+        '''
+        ScanEntry of the records, least recently seen first
+        '''
+        return iter([rec.dev for rec in self._rec.values()])
+
+    def get(self, addr):
+        return self._rec.get(addr)
+
+    def records(self):
+        return list(self._rec.values())
+
+    def targets(self):
+        '''
+        ScanEntry of the records marked as target
+        '''
+        return [rec.dev for rec in self._rec.values() if rec.target]
+
+    def update(self, dev, now=None, addr=None):
+        '''
+        dev: btle.ScanEntry
+        addr: key of the device, dev.addr if None
+          (ex. identity of a resolvable private address)
+
+        Returns
+        -------
+        (rec, is_new): (DevRecord, bool)
+        '''
+        if now is None:
+            now = time.time()
+
+        if addr is None:
+            addr = dev.addr
+        rec = self._rec.get(addr)
+        if rec is None:
+            rec = DevRecord(addr, dev, now)
+            self._rec[addr] = rec
+            self.stat['add'] += 1
+            is_new = True
+        else:
+            rec.dev = dev
+            rec.last = now
+            self._rec.move_to_end(addr)
+            self.stat['update'] += 1
+            is_new = False
+        rec.count += 1
+
+        self.expire(now)
+        while len(self._rec) > self.max_size:
+            self._evict(next(iter(self._rec)), 'lru')
+
+        return (rec, is_new)
+
+    def expire(self, now=None):
+        '''
+        evict the records not seen for ttl sec
+        '''
+        if not self.ttl:
+            return
+
+        if now is None:
+            now = time.time()
+
+        limit = now - self.ttl
+        while len(self._rec) > 0:
+            rec = next(iter(self._rec.values()))
+            if rec.last >= limit:
+                break
+            self._evict(rec.addr, 'ttl')
+
+    def remove(self, addr):
+        if addr in self._rec:
+            self._evict(addr, 'remove')
+
+    def clear(self):
+        while len(self._rec) > 0:
+            self._evict(next(iter(self._rec)), 'remove')
+
+    def _evict(self, addr, reason):
+        rec = self._rec.pop(addr)
+        self.stat[reason] += 1
+        self._log.debug('%s: %s', reason, rec)
+
+        if self._on_evict is not None:
+            self._on_evict(rec, reason)
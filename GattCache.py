@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+#
+# (c) 2020 Yoichi Tanibayashi
+#
+"""
+Persistent GATT discovery cache
+
+service/characteristic/handle tree per device address.
+
+invalidated by
+  * TTL
+  * Database Hash(0x2b2a) value changed
+  * Service Changed(0x2a05) indication. the indication is enabled on
+    each connection with the cache, and the one sent at once (ex. the
+    changes while disconnected, for a bonded device) is waited for
+    SC_WAIT sec before the cache is used
+
+changes are saved to the file every SAVE_INTERVAL sec at most,
+and in close().
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__   = '2020'
+
+from bluepy import btle
+import threading
+import json
+import time
+import os
+from BleUuid import BleUuid
+from MyLogger import get_logger
+
+
+class GattCacheDelegate(btle.DefaultDelegate):
+    _log = None
+
+    def __init__(self, gatt_cache, addr, handle, debug=False):
+        self._dbg = debug
+        __class__._log = get_logger(__class__.__name__, self._dbg)
+        self._log.debug('addr=%s, handle=%s', addr, handle)
+
+        self._gatt_cache = gatt_cache
+        self._addr = addr
+        self._handle = handle
+        self.changed = False
+
+        super().__init__()
+
+    def handleNotification(self, cHandle, data):
+        self._log.debug('cHandle=%s, data=%s', cHandle, data)
+
+        if cHandle == self._handle:
+            self._log.info('%s: Service Changed', self._addr)
+            self.changed = True
+            self._gatt_cache.invalidate(self._addr)
+
+
+class GattCache:
+    UUID_SERVICE_CHANGED = BleUuid(0x2a05)
+    UUID_DATABASE_HASH = BleUuid(0x2b2a)
+    UUID_CCCD = BleUuid(0x2902)
+
+    CCCD_INDICATE = b'\x02\x00'
+    SC_WAIT = 0.1  # sec, for the Service Changed indication
+
+    DEF_CACHE_FILE = '~/.BleBeacon_gatt_cache.json'
+    DEF_TTL = 24 * 3600  # sec
+    SAVE_INTERVAL = 60   # sec
+
+    _log = None
+
+    def __init__(self, cache_file=DEF_CACHE_FILE, ttl=DEF_TTL, debug=False):
+        self._dbg = debug
+        __class__._log = get_logger(__class__.__name__, self._dbg)
+        self._log.debug('cache_file=%s, ttl=%s', cache_file, ttl)
+
+        self._cache_file = os.path.expanduser(cache_file)
+        self._ttl = ttl
+
+        self._lock = threading.Lock()
+        self._cache = {}
+        self._dirty = False
+        self._save_time = time.time()
+        self.load()
+
+    def load(self):
+        self._log.debug('')
+
+        try:
+            with open(self._cache_file) as f:
+                self._cache = json.load(f)
+        except FileNotFoundError:
+            self._cache = {}
+        except Exception as e:
+            self._log.warning('%s:%s', type(e).__name__, e)
+            self._cache = {}
+
+        self._log.debug('%d entries', len(self._cache))
+
+    def save(self):
+        self._log.debug('')
+
+        with self._lock:
+            self._save_time = time.time()
+            if not self._dirty:
+                return
+
+            tmp_file = self._cache_file + '.tmp'
+            with open(tmp_file, 'w') as f:
+                json.dump(self._cache, f)
+            os.replace(tmp_file, self._cache_file)
+            self._dirty = False
+
+    def _changed(self):
+        '''
+        save later, SAVE_INTERVAL sec after the last save
+        '''
+        with self._lock:
+            self._dirty = True
+            if time.time() - self._save_time < self.SAVE_INTERVAL:
+                return
+        self.save()
+
+    def close(self):
+        self._log.debug('')
+        self.save()
+
+    def get(self, addr):
+        with self._lock:
+            ent = self._cache.get(addr)
+            if ent is None:
+                return None
+
+            if self._ttl > 0 and time.time() - ent['time'] > self._ttl:
+                self._log.debug('%s: expired', addr)
+                del self._cache[addr]
+                self._dirty = True
+                return None
+
+        return ent
+
+    def put(self, addr, svcs):
+        '''
+        svcs: list of btle.Service
+        '''
+        self._log.debug('addr=%s', addr)
+
+        db_hash = None
+        sc_cccd = None
+        ent_svcs = []
+        for s in svcs:
+            ent_charas = []
+            for c in s.getCharacteristics():
+                ent_charas.append([str(c.uuid), c.handle, c.properties,
+                                   c.valHandle])
+                uuid = BleUuid(c.uuid)
+                if uuid == self.UUID_DATABASE_HASH:
+                    db_hash = c.read().hex()
+                elif uuid == self.UUID_SERVICE_CHANGED:
+                    sc_cccd = self._cccd(c, s.hndEnd)
+            ent_svcs.append([str(s.uuid), s.hndStart, s.hndEnd, ent_charas])
+
+        with self._lock:
+            self._cache[addr] = {
+                'time': time.time(),
+                'hash': db_hash,
+                'sc_cccd': sc_cccd,
+                'svcs': ent_svcs
+            }
+
+        self._changed()
+
+    def _cccd(self, chara, hnd_end):
+        '''
+        Returns
+        -------
+        handle: Client Characteristic Configuration of chara, or None
+        '''
+        try:
+            descs = chara.getDescriptors(forUUID=str(self.UUID_CCCD),
+                                         hndEnd=hnd_end)
+        except btle.BTLEDisconnectError as e:
+            raise e
+        except btle.BTLEException as e:
+            self._log.debug('%s:%s', type(e).__name__, e)
+            return None
+
+        if len(descs) == 0:
+            return None
+        return descs[0].handle
+
+    def invalidate(self, addr):
+        self._log.debug('addr=%s', addr)
+
+        with self._lock:
+            if self._cache.pop(addr, None) is None:
+                return
+
+        self._changed()
+
+    def handle(self, addr, uuid):
+        '''
+        Returns
+        -------
+        valHandle: int or None
+        '''
+        ent = self.get(addr)
+        if ent is None:
+            return None
+
+        uuid = BleUuid(uuid)
+        for s_uuid, hnd_start, hnd_end, ent_charas in ent['svcs']:
+            for c_uuid, hnd, props, val_hnd in ent_charas:
+                if BleUuid(c_uuid) == uuid:
+                    return val_hnd
+
+        return None
+
+    def services(self, peri, addr=None):
+        '''
+        Returns
+        -------
+        svcs: list of btle.Service or None
+          characteristics are already set, no discovery needed
+        '''
+        if addr is None:
+            addr = peri.addr
+        self._log.debug('addr=%s', addr)
+
+        ent = self.get(addr)
+        if ent is None:
+            return None
+
+        if not self.validate(peri, addr):
+            return None
+
+        svcs = []
+        for s_uuid, hnd_start, hnd_end, ent_charas in ent['svcs']:
+            s = btle.Service(peri, s_uuid, hnd_start, hnd_end)
+            s.chars = [btle.Characteristic(peri, c_uuid, hnd, props, val_hnd)
+                       for c_uuid, hnd, props, val_hnd in ent_charas]
+            svcs.append(s)
+
+        return svcs
+
+    def validate(self, peri, addr):
+        '''
+        enable Service Changed indication, and compare Database Hash.
+        two ATT round-trips and SC_WAIT sec at most.
+        '''
+        self._log.debug('addr=%s', addr)
+
+        if not self.watch_service_changed(peri, addr):
+            return False
+
+        hnd = self.handle(addr, self.UUID_DATABASE_HASH)
+        if hnd is None:
+            return True
+
+        try:
+            db_hash = peri.readCharacteristic(hnd).hex()
+        except btle.BTLEDisconnectError as e:
+            raise e
+        except Exception as e:
+            self._log.warning('%s:%s', type(e).__name__, e)
+            self.invalidate(addr)
+            return False
+
+        with self._lock:
+            ent = self._cache.get(addr)
+            if ent is None:
+                return False
+            old_hash = ent['hash']
+
+        if old_hash != db_hash:
+            self._log.info('%s: Database Hash changed', addr)
+            self.invalidate(addr)
+            return False
+
+        return True
+
+    def watch_service_changed(self, peri, addr):
+        '''
+        enable Service Changed indication. the cache is invalidated
+        when it arrives, now or later in the connection.
+
+        Returns
+        -------
+        valid: False if the services changed
+        '''
+        ent = self.get(addr)
+        hnd = self.handle(addr, self.UUID_SERVICE_CHANGED)
+        if ent is None or hnd is None or ent.get('sc_cccd') is None:
+            return ent is not None
+
+        delegate = GattCacheDelegate(self, addr, hnd, debug=self._dbg)
+        peri.withDelegate(delegate)
+
+        try:
+            peri.writeCharacteristic(ent['sc_cccd'], self.CCCD_INDICATE,
+                                     withResponse=True)
+            peri.waitForNotifications(self.SC_WAIT)
+        except btle.BTLEDisconnectError as e:
+            raise e
+        except Exception as e:
+            self._log.warning('%s:%s', type(e).__name__, e)
+            self.invalidate(addr)
+            return False
+
+        return not delegate.changed
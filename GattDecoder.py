@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+#
+# (c) 2020 Yoichi Tanibayashi
+#
+"""
+Characteristic value decoders keyed by UUID
+
+standard GATT characteristics are registered by default. names are
+also taken from a UuidIndex like BleScan.SERVICE_INDEX. decoders are
+keyed by the interned BleUuid, so a lookup is an int dict lookup.
+
+Usage:
+    decoder = GattDecoder(BleScan.SERVICE_INDEX)
+    decoder.register('2a6e', ValueDecoder('Temperature', '<h', -2, 'C'))
+
+    log.debug('%s', decoder.name(chara.uuid))  # '<Device Name>'
+    (text, hex_str) = decoder.render(chara.uuid, val)
+    log.debug('Value: %s', text)     # formatted only when logged
+    log.debug('       %s', hex_str)
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__   = '2020'
+
+import struct
+from BleUuid import BleUuid, UuidIndex
+from MyLogger import get_logger
+
+
+class HexBytes:
+    '''
+    '<01 02 ..>'. formatted in str()
+    '''
+    __slots__ = ('_val',)
+
+    def __init__(self, val):
+        self._val = val
+
+    def __str__(self):
+        s = bytes(self._val).hex()
+        return '<' + ' '.join([s[i:i+2] for i in range(0, len(s), 2)]) + '>'
+
+
+class ValueText:
+    '''
+    text of the decoded value. formatted in str()
+    '''
+    __slots__ = ('_decoder', '_val')
+
+    def __init__(self, decoder, val):
+        self._decoder = decoder
+        self._val = val
+
+    def __str__(self):
+        if self._decoder is not None:
+            try:
+                return self._decoder.text(self._val)
+            except struct.error:
+                pass
+        return '%a' % self._val
+
+
+class ValueDecoder:
+    '''
+    fmt: struct format (ex. '<h'), or 'utf8'
+    exp: decimal exponent (ex. -2: value * 0.01)
+    '''
+    __slots__ = ('name', 'unit', '_struct', '_exp')
+
+    UTF8 = 'utf8'
+
+    def __init__(self, name, fmt=None, exp=0, unit=''):
+        self.name = name
+        self.unit = unit
+        self._exp = exp
+
+        self._struct = None
+        if fmt is not None and fmt != self.UTF8:
+            self._struct = struct.Struct(fmt)
+
+    @property
+    def is_text(self):
+        return self._struct is None
+
+    def decode(self, val):
+        '''
+        Returns
+        -------
+        value: str, int, float, or tuple of them
+
+        Raises
+        ------
+        struct.error: too short
+        '''
+        if self._struct is None:
+            return bytes(val).decode('utf-8', errors='replace')
+
+        v = self._struct.unpack_from(val)
+        if self._exp != 0:
+            v = tuple([round(x * 10 ** self._exp, -self._exp)
+                       if self._exp < 0 else x * 10 ** self._exp
+                       for x in v])
+        if len(v) == 1:
+            return v[0]
+        return v
+
+    def text(self, val):
+        v = self.decode(val)
+        if self._struct is None:
+            return '"' + v + '"'
+
+        if isinstance(v, tuple):
+            s = ', '.join([str(x) for x in v])
+        else:
+            s = str(v)
+        if self.unit:
+            s += ' ' + self.unit
+        return s
+
+
+class GattDecoder:
+    # standard characteristics (short UUID)
+    STANDARD = {
+        '2a00': ValueDecoder('Device Name', ValueDecoder.UTF8),
+        '2a01': ValueDecoder('Appearance', '<H'),
+        '2a04': ValueDecoder('Peripheral Preferred Connection Parameters',
+                             '<HHHH'),
+        '2a05': ValueDecoder('Service Changed', '<HH'),
+        '2a07': ValueDecoder('Tx Power Level', '<b', unit='dBm'),
+        '2a19': ValueDecoder('Battery Level', '<B', unit='%'),
+        '2a1f': ValueDecoder('Temperature Celsius', '<h', -1, 'C'),
+        '2a24': ValueDecoder('Model Number String', ValueDecoder.UTF8),
+        '2a25': ValueDecoder('Serial Number String', ValueDecoder.UTF8),
+        '2a26': ValueDecoder('Firmware Revision String', ValueDecoder.UTF8),
+        '2a27': ValueDecoder('Hardware Revision String', ValueDecoder.UTF8),
+        '2a28': ValueDecoder('Software Revision String', ValueDecoder.UTF8),
+        '2a29': ValueDecoder('Manufacturer Name String', ValueDecoder.UTF8),
+        '2a50': ValueDecoder('PnP ID', '<BHHH'),
+        '2a6d': ValueDecoder('Pressure', '<I', -1, 'Pa'),
+        '2a6e': ValueDecoder('Temperature', '<h', -2, 'C'),
+        '2a6f': ValueDecoder('Humidity', '<H', -2, '%'),
+    }
+
+    _log = None
+
+    def __init__(self, index=None, debug=False):
+        '''
+        index: UuidIndex of the known services and characteristics
+        '''
+        self._dbg = debug
+        __class__._log = get_logger(__class__.__name__, self._dbg)
+        self._log.debug('')
+
+        self._decoder = {}
+        for (uuid, decoder) in self.STANDARD.items():
+            self.register(uuid, decoder)
+
+        self._index = index
+        if self._index is None:
+            self._index = UuidIndex()
+
+    def register(self, uuid, decoder):
+        '''
+        uuid: str, int (16/32-bit) or btle.UUID
+        '''
+        self._decoder[BleUuid(uuid)] = decoder
+
+    def name(self, uuid):
+        '''
+        Returns
+        -------
+        name: str, or None if unknown
+        '''
+        decoder = self.lookup(uuid)
+        if decoder is not None:
+            return decoder.name
+        return self._index.name(uuid)
+
+    def lookup(self, uuid):
+        return self._decoder.get(BleUuid(uuid))
+
+    def decode(self, uuid, val):
+        '''
+        Returns
+        -------
+        value: decoded value, or val as it is if unknown or invalid
+        '''
+        decoder = self.lookup(uuid)
+        if decoder is None:
+            return val
+        try:
+            return decoder.decode(val)
+        except struct.error as e:
+            self._log.debug('%s: %s', uuid, e)
+            return val
+
+    def render(self, uuid, val):
+        '''
+        Returns
+        -------
+        (text, hex_str): ValueText, and HexBytes or None (text values).
+          both are formatted in str()
+        '''
+        decoder = self.lookup(uuid)
+        if decoder is not None and decoder.is_text:
+            return (ValueText(decoder, val), None)
+        return (ValueText(decoder, val), HexBytes(val))
@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+#
+# (c) 2020 Yoichi Tanibayashi
+#
+"""
+Raw HCI socket scanner (without bluepy-helper)
+
+same interface as bluepy.btle.Scanner:
+    scanner = HciScanner(0).withDelegate(ScanDelegate(..))
+    devs = scanner.scan(5)
+
+needs 'cap_net_raw,cap_net_admin+eip' for python3.
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__   = '2020'
+
+import socket
+import select
+import struct
+import time
+from AdvEntry import AdvEntry
+from MyLogger import get_logger
+
+
+class HciScanner:
+    HCI_COMMAND_PKT = 0x01
+    HCI_EVENT_PKT = 0x04
+
+    EVT_CMD_COMPLETE = 0x0e
+    EVT_CMD_STATUS = 0x0f
+    EVT_LE_META_EVENT = 0x3e
+    EVT_LE_ADVERTISING_REPORT = 0x02
+
+    OGF_LE_CTL = 0x08
+    OCF_LE_SET_SCAN_PARAMETERS = 0x000b
+    OCF_LE_SET_SCAN_ENABLE = 0x000c
+
+    SCAN_INTERVAL = 0x0010  # x 0.625 msec
+    SCAN_WINDOW = 0x0010    # x 0.625 msec
+
+    RECV_SIZE = 1024
+
+    _CMD_HDR = struct.Struct('<BHB')
+    _EVT_HDR = struct.Struct('<BBB')
+    _REPORT_HDR = struct.Struct('<BB6sB')
+    _SCAN_PARAM = struct.Struct('<BHHBB')
+    _SCAN_ENABLE = struct.Struct('<BB')
+    _CMD_COMPLETE = struct.Struct('<BHB')
+    _HCI_FILTER = struct.Struct('<IIIH2x')
+
+    _log = None
+
+    def __init__(self, iface=0, sock=None, filter_dup=False, debug=False):
+        '''
+        sock: connected socket for test (ex. socket.socketpair())
+        '''
+        self._dbg = debug
+        __class__._log = get_logger(__class__.__name__, self._dbg)
+        self._log.debug('iface=%s, sock=%s, filter_dup=%s',
+                        iface, sock, filter_dup)
+
+        self.iface = iface
+        self._sock = sock
+        self._own_sock = sock is None
+        self._filter_dup = filter_dup
+
+        self.delegate = None
+        self.passive = False
+        self.scanned = {}
+        self._by_raw_addr = {}
+        self._buf = b''
+
+    def withDelegate(self, delegate_):
+        self.delegate = delegate_
+        return self
+
+    def _open(self):
+        self._log.debug('iface=%s', self.iface)
+
+        sock = socket.socket(socket.AF_BLUETOOTH, socket.SOCK_RAW,
+                             socket.BTPROTO_HCI)
+        sock.bind((self.iface,))
+
+        event_mask = [0, 0]
+        for evt in (self.EVT_CMD_COMPLETE, self.EVT_CMD_STATUS,
+                    self.EVT_LE_META_EVENT):
+            event_mask[evt >> 5] |= 1 << (evt & 0x1f)
+        sock.setsockopt(socket.SOL_HCI, socket.HCI_FILTER,
+                        self._HCI_FILTER.pack(1 << self.HCI_EVENT_PKT,
+                                              event_mask[0], event_mask[1],
+                                              0))
+        return sock
+
+    def _send_cmd(self, ocf, param):
+        opcode = (self.OGF_LE_CTL << 10) | ocf
+        self._log.debug('opcode=0x%04x, param=%s', opcode, param.hex())
+
+        self._sock.sendall(self._CMD_HDR.pack(self.HCI_COMMAND_PKT, opcode,
+                                              len(param)) + param)
+
+    def start(self, passive=False):
+        self._log.debug('passive=%s', passive)
+
+        self.passive = passive
+        if self._sock is None:
+            self._sock = self._open()
+        self._buf = b''
+
+        self._send_cmd(self.OCF_LE_SET_SCAN_ENABLE,
+                       self._SCAN_ENABLE.pack(0, 0))
+        self._send_cmd(self.OCF_LE_SET_SCAN_PARAMETERS,
+                       self._SCAN_PARAM.pack(0 if passive else 1,
+                                             self.SCAN_INTERVAL,
+                                             self.SCAN_WINDOW, 0, 0))
+        self._send_cmd(self.OCF_LE_SET_SCAN_ENABLE,
+                       self._SCAN_ENABLE.pack(1, int(self._filter_dup)))
+
+    def stop(self):
+        self._log.debug('')
+
+        if self._sock is None:
+            return
+
+        try:
+            self._send_cmd(self.OCF_LE_SET_SCAN_ENABLE,
+                           self._SCAN_ENABLE.pack(0, 0))
+        except OSError as e:
+            self._log.warning('%s:%s', type(e).__name__, e)
+
+        if self._own_sock:
+            self._sock.close()
+            self._sock = None
+
+    def clear(self):
+        self.scanned = {}
+        self._by_raw_addr = {}
+
+    def forget(self, addr):
+        '''
+        remove a scanned device (ex. evicted from the device table)
+        '''
+        self.scanned.pop(addr, None)
+        raw_addr = bytes.fromhex(addr.replace(':', ''))[::-1]
+        self._by_raw_addr.pop(raw_addr, None)
+
+    def process(self, timeout=10.0):
+        if self._sock is None:
+            raise RuntimeError('socket not opened (did you call start()?)')
+
+        start = time.time()
+        while True:
+            remain = None
+            if timeout:
+                remain = start + timeout - time.time()
+                if remain <= 0.0:
+                    break
+
+            (r, w, x) = select.select([self._sock], [], [], remain)
+            if len(r) == 0:
+                break
+
+            data = self._sock.recv(self.RECV_SIZE)
+            if len(data) == 0:  # closed
+                break
+
+            self._buf += data
+            self._buf = self.feed(self._buf)
+
+    def feed(self, buf):
+        '''
+        handle complete HCI event packets in buf
+
+        Returns
+        -------
+        rest: bytes
+          incomplete packet
+        '''
+        hdr_len = self._EVT_HDR.size
+        i = 0
+        n = len(buf)
+        while i + hdr_len <= n:
+            (pkt_type, evt, plen) = self._EVT_HDR.unpack_from(buf, i)
+            if pkt_type != self.HCI_EVENT_PKT:
+                self._log.warning('unexpected packet type: 0x%02x', pkt_type)
+                return b''
+
+            if i + hdr_len + plen > n:
+                break
+
+            param = memoryview(buf)[i + hdr_len:i + hdr_len + plen]
+            i += hdr_len + plen
+
+            if evt == self.EVT_LE_META_EVENT:
+                if param[0] == self.EVT_LE_ADVERTISING_REPORT:
+                    for report in self.parse_adv_report(param):
+                        self.handle_report(*report)
+
+            elif evt == self.EVT_CMD_COMPLETE:
+                (ncmd, opcode, status) = self._CMD_COMPLETE.unpack_from(param)
+                self._log.debug('Command Complete: opcode=0x%04x, status=%d',
+                                opcode, status)
+                if status != 0:
+                    self._log.warning('opcode=0x%04x: status=0x%02x',
+                                      opcode, status)
+
+        return buf[i:]
+
+    @classmethod
+    def parse_adv_report(cls, param):
+        '''
+        param: LE Meta Event parameter (Subevent_Code, Num_Reports, ..)
+
+        Returns
+        -------
+        reports: list of (adv_type, addr_type, raw_addr, data, rssi)
+          raw_addr: bytes (little endian)
+        '''
+        reports = []
+
+        num = param[1]
+        i = 2
+        for r in range(num):
+            if i + cls._REPORT_HDR.size > len(param):
+                break
+            (adv_type, addr_type, raw_addr,
+             data_len) = cls._REPORT_HDR.unpack_from(param, i)
+            i += cls._REPORT_HDR.size
+
+            if i + data_len + 1 > len(param):
+                cls._log.warning('truncated report')
+                break
+            data = bytes(param[i:i + data_len])
+            rssi = param[i + data_len]
+            if rssi > 127:
+                rssi -= 256
+            i += data_len + 1
+
+            reports.append((adv_type, addr_type, raw_addr, data, rssi))
+
+        return reports
+
+    def handle_report(self, adv_type, addr_type, raw_addr, data, rssi):
+        dev = self._by_raw_addr.get(raw_addr)
+        if dev is None:
+            addr = ':'.join(['%02x' % c for c in reversed(raw_addr)])
+            dev = self.scanned.get(addr)
+            if dev is None:
+                dev = AdvEntry(addr, self.iface)
+                self.scanned[addr] = dev
+            self._by_raw_addr[raw_addr] = dev
+
+        isNewData = dev.update(addr_type, rssi, adv_type, data)
+        if self.delegate is not None:
+            self.delegate.handleDiscovery(dev, (dev.updateCount <= 1),
+                                          isNewData)
+
+    def getDevices(self):
+        return self.scanned.values()
+
+    def scan(self, timeout=10, passive=False):
+        self.clear()
+        self.start(passive=passive)
+        self.process(timeout)
+        self.stop()
+        return self.getDevices()
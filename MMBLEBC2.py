@@ -10,6 +10,12 @@ __date__   = '2020'
 
 import bluepy
 import time
+from AdvFilter import AdvFilter
+from AdView import AdView
+from AdvLog import AdvLogWriter, AdvLogDelegate, AdvReplayScanner
+from AdvArchive import AdvArchiveWriter
+from BleRetry import RetryPolicy
+from RpaResolver import RpaResolver
 from MyLogger import get_logger
 
 
@@ -24,6 +30,11 @@ class BleBeacon:
         self._scanner = scanner
         self._addr_hdr = addr_hdr
         self._data_keyword = data_keyword
+        self._data_type = AdView.TYPE_BY_DESC.get(self._data_keyword, -1)
+
+        self._filter = AdvFilter(
+            ouis=() if self._addr_hdr is None else (self._addr_hdr,),
+            debug=self._debug)
 
         if self._scanner is None:
             self._scanner = bluepy.btle.Scanner(0)
@@ -35,16 +46,20 @@ class BleBeacon:
         devs = self._scanner.scan(sec)
 
         for dev in devs:
-            if self._addr_hdr is not None:
-                if not dev.addr.startswith(self._addr_hdr):
-                    continue
+            if not self._filter.match_dev(dev):
+                continue
 
             self._lg.debug('addr=%s', dev.addr)
 
-            for (adtype, desc, val) in dev.getScanData():
-                if self._data_keyword is not None:
-                    if desc != self._data_keyword:
-                        continue
+            view = AdView.of(dev)
+            if self._data_keyword is None:
+                vals = [view.text(t, v) for (t, v) in view.items()]
+            else:
+                vals = [view.text(self._data_type)]
+
+            for val in vals:
+                if val is None:
+                    continue
 
                 batt_str     = val[8:10]
                 temp_str     = val[10:14]
@@ -60,20 +75,62 @@ class BleBeacon:
                                temp_val, int(humidity_val))
 
 
+class MMBLEBC2Delegate(bluepy.btle.DefaultDelegate):
+    '''
+    decode each advertisement and push the reading to the callback
+    '''
+    def __init__(self, bledev, callback, delegate=None):
+        self._bledev = bledev
+        self._callback = callback
+        self._delegate = delegate
+
+        super().__init__()
+
+    def handleDiscovery(self, dev, isNewDev, isNewData):
+        if self._delegate is not None:
+            self._delegate.handleDiscovery(dev, isNewDev, isNewData)
+
+        if not isNewData:
+            return
+
+        reading = self._bledev.decode(dev)
+        if reading is not None:
+            self._callback(reading)
+
+
 class MMBLEBC2:
     ADDR_HDR = 'ac:23:3f:a0'
     DATA_KEYWORD = '16b Service Data'
+    DATA_TYPE = AdView.TYPE_BY_DESC[DATA_KEYWORD]
+
+    PROCESS_INTERVAL = 1.0  # sec
+    CLEAR_INTERVAL = 60     # sec
+    RESTART_DELAY = 1.0     # sec
 
-    def __init__(self, scanner=None, debug=False):
+    def __init__(self, scanner=None, resolver=None, debug=False):
+        '''
+        resolver: RpaResolver. for the beacons with a private address,
+          ADDR_HDR is matched with the identity, and it is reported
+        '''
         self._debug = debug
         self._lg = get_logger(__class__.__name__, self._debug)
-        self._lg.debug('scanner=%s', scanner)
+        self._lg.debug('scanner=%s, resolver=%s', scanner, resolver)
 
         self._scanner = scanner
         if self._scanner is None:
             self._scanner = bluepy.btle.Scanner(0)
             self._lg.debug('_scanner=%s', self._scanner)
 
+        self._resolver = resolver
+        self._filter = AdvFilter(ouis=(self.ADDR_HDR,),
+                                 resolver=self._resolver, debug=self._debug)
+
+        # restart the scanner only on error
+        self._scan_retry = RetryPolicy(
+            'Scan', RetryPolicy.FOREVER,
+            rules={bluepy.btle.BTLEException: self.RESTART_DELAY},
+            debug=self._debug)
+
     def scan(self, sec=5):
         self._lg.debug('sec=%s', sec)
 
@@ -85,30 +142,98 @@ class MMBLEBC2:
                 continue
             """
 
-            if not dev.addr.startswith(self.ADDR_HDR):
-                continue
-            self._lg.info('addr = %s', dev.addr)
-
-            for (adtype, desc, val) in dev.getScanData():
-                self._lg.debug('%s: %s.', desc, val)
-                # if 'ESP' in val:
-                #    print('%s %s:%s.' % (dev.addr, desc, val))
-                if desc == self.DATA_KEYWORD:
-                    batt_str     = val[8:10]
-                    temp_str     = val[10:14]
-                    humidity_str = val[14:18]
-                    self._lg.debug('batt_str=%s, temp_str=%s, humidity_str=%s',
-                                   batt_str, temp_str, humidity_str)
-
-                    batt_val = round(int(batt_str, 16) / int('64', 16)) * 100
-                    temp_val = self.hexstr2float(temp_str)
-                    humidity_val = self.hexstr2float(humidity_str)
-                    self._lg.info('  batt     =%d %% (0x%s)',
-                                  batt_val, batt_str)
-                    self._lg.info('  temp     = %.1f C (0x%s)',
-                                  temp_val, temp_str)
-                    self._lg.info('  humidity = %d %% (0x%s)',
-                                  humidity_val, humidity_str)
+            reading = self.decode(dev)
+            if reading is not None:
+                self.log_reading(reading)
+
+    def run(self, callback, timeout=0):
+        '''
+        continuous scan. the scanner keeps running and
+        callback(reading) is called as each advertisement arrives.
+
+        timeout: sec, 0 for forever (or until the replay is done)
+        '''
+        self._lg.debug('callback=%s, timeout=%s', callback, timeout)
+
+        delegate = getattr(self._scanner, 'delegate', None)
+        self._scanner.withDelegate(MMBLEBC2Delegate(self, callback,
+                                                    delegate))
+        try:
+            self._scan_retry.call(self._run, timeout)
+        finally:
+            self._scanner.withDelegate(delegate)
+            self._lg.debug('scan_retry=%s', self._scan_retry.stat)
+
+    def _run(self, timeout):
+        start = time.time()
+        clear_time = start
+
+        self._scanner.clear()
+        self._scanner.start(passive=False)
+        try:
+            while True:
+                self._scanner.process(self.PROCESS_INTERVAL)
+                now = time.time()
+
+                if getattr(self._scanner, 'done', False):
+                    return
+                if timeout and now - start >= timeout:
+                    return
+
+                # forget devices. unchanged readings are pushed again
+                if now - clear_time >= self.CLEAR_INTERVAL:
+                    self._scanner.clear()
+                    clear_time = now
+        finally:
+            try:
+                self._scanner.stop()
+            except bluepy.btle.BTLEException as e:
+                self._lg.warning('%s:%s', type(e).__name__, e)
+
+    def decode(self, dev):
+        '''
+        Returns
+        -------
+        reading: dict or None
+          {'addr', 'rssi', 'batt', 'temp', 'humidity', 'raw'}
+        '''
+        if not self._filter.match_dev(dev):
+            return None
+
+        val = AdView.of(dev).text(self.DATA_TYPE)
+        self._lg.debug('%s: %s: %s.', dev.addr, self.DATA_KEYWORD, val)
+        if val is None or len(val) < 18:
+            return None
+
+        batt_str     = val[8:10]
+        temp_str     = val[10:14]
+        humidity_str = val[14:18]
+        self._lg.debug('batt_str=%s, temp_str=%s, humidity_str=%s',
+                       batt_str, temp_str, humidity_str)
+
+        addr = dev.addr
+        if self._resolver is not None:
+            addr = self._resolver.resolve(dev.addr) or addr
+
+        return {
+            'addr': addr,
+            'rssi': dev.rssi,
+            'batt': int(batt_str, 16),
+            'temp': self.hexstr2float(temp_str),
+            'humidity': self.hexstr2float(humidity_str),
+            'raw': (batt_str, temp_str, humidity_str)
+        }
+
+    def log_reading(self, reading):
+        (batt_str, temp_str, humidity_str) = reading['raw']
+
+        self._lg.info('addr = %s', reading['addr'])
+        self._lg.info('  batt     =%d %% (0x%s)',
+                      reading['batt'], batt_str)
+        self._lg.info('  temp     = %.1f C (0x%s)',
+                      reading['temp'], temp_str)
+        self._lg.info('  humidity = %d %% (0x%s)',
+                      reading['humidity'], humidity_str)
 
     def hexstr2float(self, val_str):
         '''
@@ -125,21 +250,66 @@ class MMBLEBC2:
 
 
 class App:
-    def __init__(self, debug=False):
+    def __init__(self, record=None, replay=None, speed=1.0,
+                 continuous=False, irks=(), archive=None, debug=False):
+        '''
+        irks: ['IDENTITY=IRK(hex)', ..]
+        archive: directory to archive advertisements (AdvArchiveWriter)
+        '''
         self._debug = debug
         self._lg = get_logger(__class__.__name__, self._debug)
-        self._lg.debug('')
-
-        self._bledev = MMBLEBC2(debug=self._debug)
+        self._lg.debug('record=%s, replay=%s, speed=%s',
+                       record, replay, speed)
+        self._lg.debug('continuous=%s, irks=%d', continuous, len(irks))
+        self._lg.debug('archive=%s', archive)
+
+        self._continuous = continuous
+
+        self._writer = None
+        self._replay = None
+        scanner = None
+        if replay is not None:
+            self._replay = AdvReplayScanner(replay, speed, debug=self._debug)
+            scanner = self._replay
+        elif record is not None:
+            self._writer = AdvLogWriter(record, debug=self._debug)
+            scanner = bluepy.btle.Scanner(0).withDelegate(
+                AdvLogDelegate(self._writer))
+
+        self._archive = None
+        if archive is not None:
+            self._archive = AdvArchiveWriter(archive, debug=self._debug)
+            if scanner is None:
+                scanner = bluepy.btle.Scanner(0)
+            scanner.withDelegate(
+                AdvLogDelegate(self._archive,
+                               getattr(scanner, 'delegate', None)))
+
+        resolver = None
+        if len(irks) > 0:
+            resolver = RpaResolver.from_spec(irks, debug=self._debug)
+
+        self._bledev = MMBLEBC2(scanner, resolver, debug=self._debug)
 
     def main(self):
         self._lg.debug('')
+
+        if self._continuous:
+            self._bledev.run(self._bledev.log_reading)
+            return
+
         while True:
             self._bledev.scan(5)
+            if self._replay is not None and self._replay.done:
+                break
             time.sleep(0.1)
 
     def end(self):
         self._lg.debug('')
+        if self._writer is not None:
+            self._writer.close()
+        if self._archive is not None:
+            self._archive.close()
 
 
 import click
@@ -149,14 +319,30 @@ CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
 @click.command(context_settings=CONTEXT_SETTINGS, help='''
 BLE Beacon Scanner
 ''')
+@click.option('--record', '-R', 'record', type=str, default=None,
+              help='record advertisements to the log file')
+@click.option('--replay', '-P', 'replay', type=click.Path(exists=True),
+              default=None,
+              help='replay advertisements from the log file')
+@click.option('--speed', 'speed', type=float, default=1.0,
+              help='replay speed, 0 for as fast as possible')
+@click.option('--continuous', '-C', 'continuous', is_flag=True,
+              default=False,
+              help='keep scanning, and log each reading as it arrives')
+@click.option('--irk', 'irks', type=str, multiple=True,
+              help='resolve private addresses: IDENTITY=IRK(hex)')
+@click.option('--archive', '-a', 'archive', type=str, default=None,
+              help='archive advertisements to the directory (Parquet)')
 @click.option('--debug', '-d', 'debug', is_flag=True, default=False,
               help='debug flag')
-def main(debug):
+def main(record, replay, speed, continuous, irks, archive, debug):
     logger = get_logger(__name__, debug)
-    logger.debug('')
+    logger.debug('record=%s, replay=%s, speed=%s', record, replay, speed)
+    logger.debug('continuous=%s, irks=%d', continuous, len(irks))
+    logger.debug('archive=%s', archive)
 
     logger.info('start')
-    app = App(debug=debug)
+    app = App(record, replay, speed, continuous, irks, archive, debug=debug)
     try:
         app.main()
     finally:
@@ -0,0 +1,461 @@
+#!/usr/bin/env python3
+#
+# (c) 2020 Yoichi Tanibayashi
+#
+"""
+Concurrent multi-adapter scan
+
+one scanner process per HCI adapter. advertisements are merged into
+one deduplicated stream, with RSSI for each adapter that saw them.
+GATT connections go to the least busy adapter that saw the device.
+
+Usage:
+    multi = MultiScan(hcis=(0, 1))
+    multi.start()
+    for adv in multi.adverts(timeout=10):
+        print(adv.dev.addr, adv.seen)    # seen: {hci: rssi}
+        multi.dev_info(ble_scan, adv.dev)
+    multi.stop()
+
+    # test with recorded advertisements (one log per adapter)
+    multi = MultiScan(hcis=(0, 1), backend='replay',
+                      replay=('hci0.log', 'hci1.log'), speed=0)
+
+the scanner processes run scan_proc() with plain arguments, so any
+start method of multiprocessing ('fork', 'spawn', 'forkserver') works.
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__   = '2020'
+
+from bluepy import btle
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import multiprocessing
+import threading
+import queue
+import time
+import click
+from AdvEntry import AdvEntry
+from AdvFilter import AdvFilter
+from AdvLog import AdvLog, AdvReplayScanner
+from HciScanner import HciScanner
+from DevTable import DevTable
+from BleScan import BleScan
+from MyLogger import get_logger
+CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
+
+
+MergedAdvert = namedtuple('MergedAdvert', ['time', 'dev', 'seen', 'is_new'])
+
+
+class QueueDelegate(btle.DefaultDelegate):
+    '''
+    collect AdvRecord in the scanner process
+    '''
+    def __init__(self):
+        self.batch = []
+
+        super().__init__()
+
+    def handleDiscovery(self, dev, isNewDev, isNewData):
+        self.batch.append(AdvLog.record(dev))
+
+
+def new_scanner(hci, backend='bluepy', replay=None, speed=1.0,
+                debug=False):
+    '''
+    replay: log file for the 'replay' backend
+    '''
+    if backend == 'hci':
+        return HciScanner(hci, debug=debug)
+
+    if backend == 'replay':
+        return AdvReplayScanner(replay, speed, iface=hci, debug=debug)
+
+    return btle.Scanner(hci)
+
+
+def scan_proc(hci, backend, replay, speed, out_queue, stop, interval,
+              debug=False):
+    '''
+    scanner process: put (hci, [AdvRecord, ..]) and (hci, None) at end
+
+    stop: multiprocessing.Event
+    interval: sec of each process()
+    '''
+    log = get_logger('%s[hci%d]' % (MultiScan.__name__, hci), debug)
+    log.debug('start')
+
+    delegate = QueueDelegate()
+    scanner = new_scanner(hci, backend, replay, speed,
+                          debug).withDelegate(delegate)
+    try:
+        scanner.start(passive=False)
+        while not stop.is_set():
+            scanner.process(interval)
+            if len(delegate.batch) > 0:
+                out_queue.put((hci, delegate.batch))
+                delegate.batch = []
+
+            # keep memory flat. duplicates are handled by the parent
+            scanner.clear()
+
+            if getattr(scanner, 'done', False):
+                break
+
+    except Exception as e:
+        log.error('%s:%s', type(e).__name__, e)
+
+    finally:
+        try:
+            scanner.stop()
+        except Exception as e:
+            log.warning('%s:%s', type(e).__name__, e)
+        out_queue.put((hci, None))
+        log.debug('end')
+
+
+class MultiScan:
+    BACKENDS = ('bluepy', 'hci', 'replay')
+
+    DEF_DEDUP_WINDOW = 0.2  # sec
+    PROCESS_INTERVAL = 0.1  # sec
+    JOIN_TIMEOUT = 3        # sec
+
+    _log = None
+
+    def __init__(self, hcis=(0,), backend='bluepy', replay=(), speed=1.0,
+                 dedup_window=DEF_DEDUP_WINDOW,
+                 max_devs=DevTable.DEF_MAX_SIZE, dev_ttl=DevTable.DEF_TTL,
+                 adv_filter=None, mp_context=None, debug=False):
+        '''
+        replay: log files, one per hci (or one for all)
+        dedup_window: sec. the same advertisement seen by some adapters
+          in this time is merged
+        mp_context: multiprocessing start method ('fork', 'spawn',
+          'forkserver'), None for the default
+        '''
+        self._dbg = debug
+        __class__._log = get_logger(__class__.__name__, self._dbg)
+        self._log.debug('hcis=%s, backend=%s, replay=%s, speed=%s',
+                        hcis, backend, replay, speed)
+        self._log.debug('dedup_window=%s, max_devs=%s, dev_ttl=%s',
+                        dedup_window, max_devs, dev_ttl)
+
+        if backend not in self.BACKENDS:
+            raise ValueError('backend: %s' % backend)
+        if backend == 'replay' and len(replay) not in (1, len(hcis)):
+            raise ValueError('replay: one log, or one per hci')
+
+        self._hcis = tuple(hcis)
+        self._backend = backend
+        self._replay = tuple(replay)
+        self._speed = speed
+        self._dedup_window = dedup_window
+        self._filter = adv_filter
+        self._mp = multiprocessing.get_context(mp_context)
+
+        self._queue = None
+        self._stop = None
+        self._procs = {}
+        self._running = set()
+
+        # (addr, data) -> [first time, AdvRecord, {hci: rssi}]
+        self._pending = OrderedDict()
+
+        # merged devices and the adapters that saw them
+        self.devs = DevTable(max_devs, dev_ttl, on_evict=self._on_evict,
+                             debug=self._dbg)
+        self.adapters = {}  # addr -> {hci: (rssi, time)}
+
+        self._busy = {hci: 0 for hci in self._hcis}
+        self._busy_lock = threading.Lock()
+
+        self.stat = {'record': 0, 'merged': 0, 'advert': 0}
+
+    def _on_evict(self, rec, reason):
+        self.adapters.pop(rec.addr, None)
+
+    def _replay_path(self, hci):
+        if len(self._replay) == 0:
+            return None
+        if len(self._replay) > 1:
+            return self._replay[self._hcis.index(hci)]
+        return self._replay[0]
+
+    def new_scanner(self, hci):
+        return new_scanner(hci, self._backend, self._replay_path(hci),
+                           self._speed, debug=self._dbg)
+
+    def start(self):
+        self._log.debug('start_method=%s', self._mp.get_start_method())
+
+        self._queue = self._mp.Queue()
+        self._stop = self._mp.Event()
+        for hci in self._hcis:
+            proc = self._mp.Process(
+                target=scan_proc,
+                args=(hci, self._backend, self._replay_path(hci),
+                      self._speed, self._queue, self._stop,
+                      self.PROCESS_INTERVAL, self._dbg),
+                daemon=True)
+            proc.start()
+            self._procs[hci] = proc
+            self._running.add(hci)
+
+    def stop(self):
+        self._log.debug('')
+
+        if self._stop is None:
+            return
+        self._stop.set()
+
+        # drain the queue, or the processes can not exit
+        end = time.time() + self.JOIN_TIMEOUT
+        while len(self._running) > 0 and time.time() < end:
+            try:
+                (hci, batch) = self._queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if batch is None:
+                self._running.discard(hci)
+
+        for hci, proc in self._procs.items():
+            proc.join(max(end - time.time(), 0))
+            if proc.is_alive():
+                self._log.warning('hci%d: terminate', hci)
+                proc.terminate()
+        self._procs = {}
+        self._log.debug('stat=%s', self.stat)
+
+    def adverts(self, timeout=None):
+        '''
+        merged advertisements (MergedAdvert)
+
+        timeout: sec, None for until all scanners end
+        '''
+        self._log.debug('timeout=%s', timeout)
+
+        end = None
+        if timeout:
+            end = time.time() + timeout
+
+        while len(self._running) > 0 or len(self._pending) > 0:
+            now = time.time()
+            if end is not None and now >= end:
+                break
+
+            wait = self.PROCESS_INTERVAL
+            if len(self._pending) > 0:
+                first = next(iter(self._pending.values()))[0]
+                wait = max(first + self._dedup_window - now, 0)
+
+            if len(self._running) > 0:
+                try:
+                    (hci, batch) = self._queue.get(timeout=wait)
+                    self._merge(hci, batch)
+                except queue.Empty:
+                    pass
+
+            for adv in self._expire(time.time(),
+                                    force=len(self._running) == 0):
+                yield adv
+
+    def _merge(self, hci, batch):
+        if batch is None:
+            self._log.debug('hci%d: end', hci)
+            self._running.discard(hci)
+            return
+
+        now = time.time()
+        for rec in batch:
+            self.stat['record'] += 1
+
+            key = (rec.addr, rec.data)
+            ent = self._pending.get(key)
+            if ent is None:
+                self._pending[key] = [now, rec, {hci: rec.rssi}]
+                continue
+
+            self.stat['merged'] += 1
+            seen = ent[2]
+            if rec.rssi > seen.get(hci, -999):
+                seen[hci] = rec.rssi
+
+    def _expire(self, now, force=False):
+        limit = now - self._dedup_window
+        while len(self._pending) > 0:
+            (key, ent) = next(iter(self._pending.items()))
+            if not force and ent[0] > limit:
+                break
+            del self._pending[key]
+
+            (t, rec, seen) = ent
+            if self._filter is not None and \
+               not self._filter.match(rec.addr, rec.data,
+                                      self._scan_data(rec.addr)):
+                continue
+
+            adv = self._advert(t, rec, seen)
+            self.stat['advert'] += 1
+            yield adv
+
+    def _scan_data(self, addr):
+        '''
+        AD data of the other packets of the known device, or None
+        '''
+        devrec = self.devs.get(addr)
+        if devrec is None:
+            return None
+        return devrec.dev.scanData
+
+    def _advert(self, t, rec, seen):
+        best = max(seen, key=seen.get)
+
+        devrec = self.devs.get(rec.addr)
+        dev = devrec.dev if devrec is not None else AdvEntry(rec.addr, best)
+        dev.iface = best
+        dev.update(rec.addr_type, seen[best], rec.adv_type, rec.data)
+        (devrec, is_new) = self.devs.update(dev, t)
+
+        adapters = self.adapters.setdefault(rec.addr, {})
+        for hci, rssi in seen.items():
+            adapters[hci] = (rssi, t)
+
+        return MergedAdvert(t, dev, dict(seen), is_new)
+
+    def _least_busy(self, addr):
+        adapters = self.adapters.get(addr)
+        if not adapters:
+            adapters = {hci: (-999, 0) for hci in self._hcis}
+
+        return min(adapters, key=lambda h: (self._busy.get(h, 0),
+                                            -adapters[h][0]))
+
+    def pick_hci(self, addr):
+        '''
+        least busy adapter that saw addr (best RSSI first)
+        '''
+        with self._busy_lock:
+            return self._least_busy(addr)
+
+    @contextmanager
+    def adapter(self, addr):
+        '''
+        with multi.adapter(addr) as hci:
+            (connect with hci)
+        '''
+        with self._busy_lock:
+            hci = self._least_busy(addr)
+            self._busy[hci] = self._busy.get(hci, 0) + 1
+        self._log.debug('%s: hci%d, busy=%s', addr, hci, self._busy)
+        try:
+            yield hci
+        finally:
+            with self._busy_lock:
+                self._busy[hci] -= 1
+
+    def dev_info(self, ble_scan, dev, **kwargs):
+        '''
+        BleScan.dev_info() with the least busy adapter
+        '''
+        with self.adapter(dev.addr) as hci:
+            return ble_scan.dev_info(dev, hci=hci, **kwargs)
+
+
+class App:
+    _log = None
+
+    def __init__(self, addrs=(), hcis=(0,), backend='bluepy', replay=(),
+                 speed=1.0, scan_timeout=0, conn_svc=0, get_chara=3,
+                 read_chara=3, workers=2, debug=False):
+        self._dbg = debug
+        __class__._log = get_logger(__class__.__name__, self._dbg)
+        self._log.debug('addrs=%s, hcis=%s, backend=%s, replay=%s',
+                        addrs, hcis, backend, replay)
+        self._log.debug('conn_svc=%s, get_chara=%s, read_chara=%s',
+                        conn_svc, get_chara, read_chara)
+
+        self._scan_timeout = scan_timeout
+        self._conn_svc = conn_svc
+
+        adv_filter = None
+        if len(addrs) > 0:
+            adv_filter = AdvFilter(addrs=addrs, debug=self._dbg)
+
+        self._multi = MultiScan(hcis, backend, replay, speed,
+                                adv_filter=adv_filter, debug=self._dbg)
+
+        self._ble_scan = BleScan(addrs, hcis[0], scan_timeout=0,
+                                 conn_svc=conn_svc, get_chara=get_chara,
+                                 read_chara=read_chara, debug=self._dbg)
+        self._executor = ThreadPoolExecutor(workers)
+
+    def main(self):
+        self._log.debug('')
+
+        self._multi.start()
+        for adv in self._multi.adverts(self._scan_timeout):
+            print('%.3f [%s] %s dBm %s' % (
+                adv.time, adv.dev.addr, adv.dev.rssi,
+                ' '.join(['hci%d:%d' % (h, r)
+                          for h, r in sorted(adv.seen.items())])))
+
+            if adv.is_new and adv.dev.connectable and self._conn_svc > 0:
+                self._executor.submit(self._multi.dev_info, self._ble_scan,
+                                      adv.dev, dev_data=False)
+
+    def end(self):
+        self._log.debug('')
+        self._multi.stop()
+        self._executor.shutdown(wait=True)
+        self._ble_scan.end()
+
+
+@click.command(context_settings=CONTEXT_SETTINGS, help='''
+Multi-adapter BLE Scanner
+''')
+@click.argument('addrs', type=str, nargs=-1)
+@click.option('--hci', '-i', 'hcis', type=int, multiple=True, default=(0,),
+              help='Interface number for scan (multiple)')
+@click.option('--backend', '-b', 'backend',
+              type=click.Choice(MultiScan.BACKENDS), default='bluepy',
+              help='scanner backend')
+@click.option('--replay', '-P', 'replay', type=click.Path(exists=True),
+              multiple=True,
+              help='log file for --backend replay (one, or one per hci)')
+@click.option('--speed', 'speed', type=float, default=1.0,
+              help='replay speed, 0 for as fast as possible')
+@click.option('--scan_timeout', '-t', 'scan_timeout', type=int, default=0,
+              help='scan sec, 0 for continuous')
+@click.option('--conn_svc', '-s', 'conn_svc', type=int, default=0,
+              help='connect service, 0 for no connection')
+@click.option('--get_chara', '-c', 'get_chara', type=int, default=3,
+              help='get characteristics')
+@click.option('--read_chara', '-r', 'read_chara', type=int, default=3,
+              help='read characteristics value')
+@click.option('--workers', '-w', 'workers', type=int, default=2,
+              help='connection threads')
+@click.option('--debug', '-d', 'debug', is_flag=True, default=False,
+              help='debug flag')
+def main(addrs, hcis, backend, replay, speed, scan_timeout, conn_svc,
+         get_chara, read_chara, workers, debug):
+    logger = get_logger(__name__, debug)
+    logger.debug('addrs=%s, hcis=%s, backend=%s', addrs, hcis, backend)
+    logger.debug('replay=%s, speed=%s', replay, speed)
+    logger.debug('scan_timeout=%s, conn_svc=%s, workers=%s',
+                 scan_timeout, conn_svc, workers)
+
+    app = App(addrs, hcis, backend, replay, speed, scan_timeout,
+              conn_svc, get_chara, read_chara, workers, debug=debug)
+    try:
+        app.main()
+    finally:
+        logger.debug('finally')
+        app.end()
+        logger.info('done')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+#
+# (c) 2020 Yoichi Tanibayashi
+#
+"""
+Persistent device name cache
+
+address -> Device Name (0x2a00) read over GATT. a device that did not
+answer is cached as None (negative entry) with a shorter TTL.
+
+a stale entry is still returned, and refreshed in a background thread
+(refresh()), so a repeat run needs no connection for known devices.
+a failed refresh keeps the name, and is not tried again for the
+negative TTL.
+
+Usage:
+    cache = NameCache()
+    ent = cache.get(addr)      # (name, fresh) or None
+    if ent is None:
+        cache.put(addr, read_name(addr, addr_type), addr_type)
+    cache.refresh(read_name)   # stale entries only, background
+    ..
+    cache.close()
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__   = '2020'
+
+import threading
+import json
+import time
+import os
+from MyLogger import get_logger
+
+
+class NameCache:
+    DEF_CACHE_FILE = '~/.BleBeacon_name_cache.json'
+    DEF_TTL = 7 * 24 * 3600  # sec
+    DEF_NEG_TTL = 3600       # sec, for the devices that did not answer
+    DEF_MAX_SIZE = 4096      # entries
+
+    _log = None
+
+    def __init__(self, cache_file=DEF_CACHE_FILE, ttl=DEF_TTL,
+                 neg_ttl=DEF_NEG_TTL, max_size=DEF_MAX_SIZE, debug=False):
+        self._dbg = debug
+        __class__._log = get_logger(__class__.__name__, self._dbg)
+        self._log.debug('cache_file=%s, ttl=%s, neg_ttl=%s, max_size=%s',
+                        cache_file, ttl, neg_ttl, max_size)
+
+        self._cache_file = os.path.expanduser(cache_file)
+        self._ttl = ttl
+        self._neg_ttl = neg_ttl
+        self._max_size = max_size
+
+        self._lock = threading.Lock()
+        self._cache = {}
+        self._dirty = False
+        self._refresh_th = None
+        self.load()
+
+    def load(self):
+        self._log.debug('')
+
+        try:
+            with open(self._cache_file) as f:
+                self._cache = json.load(f)
+        except FileNotFoundError:
+            self._cache = {}
+        except Exception as e:
+            self._log.warning('%s:%s', type(e).__name__, e)
+            self._cache = {}
+
+        self._log.debug('%d entries', len(self._cache))
+
+    def save(self):
+        self._log.debug('')
+
+        with self._lock:
+            if not self._dirty:
+                return
+
+            if len(self._cache) > self._max_size:
+                addrs = sorted(self._cache,
+                               key=lambda a: self._cache[a]['time'])
+                for addr in addrs[:len(self._cache) - self._max_size]:
+                    del self._cache[addr]
+
+            tmp_file = self._cache_file + '.tmp'
+            with open(tmp_file, 'w') as f:
+                json.dump(self._cache, f)
+            os.replace(tmp_file, self._cache_file)
+            self._dirty = False
+
+    def _is_fresh(self, ent, now):
+        # the last refresh failed
+        if now - ent.get('fail', 0) <= self._neg_ttl:
+            return True
+
+        ttl = self._ttl if ent['name'] is not None else self._neg_ttl
+        return ttl <= 0 or now - ent['time'] <= ttl
+
+    def get(self, addr):
+        '''
+        Returns
+        -------
+        (name, fresh): None if not cached.
+          name is None for a negative entry
+        '''
+        with self._lock:
+            ent = self._cache.get(addr)
+            if ent is None:
+                return None
+            return (ent['name'], self._is_fresh(ent, time.time()))
+
+    def __contains__(self, addr):
+        with self._lock:
+            return addr in self._cache
+
+    def put(self, addr, name, addr_type='public'):
+        '''
+        name: None for the device that did not answer
+        '''
+        self._log.debug('%s(%s): %s', addr, addr_type, name)
+
+        with self._lock:
+            self._cache[addr] = {'time': time.time(), 'name': name,
+                                 'type': addr_type}
+            self._dirty = True
+
+    def stale(self):
+        '''
+        Returns
+        -------
+        [(addr, addr_type)]: the stale entries
+        '''
+        now = time.time()
+        with self._lock:
+            return [(addr, ent.get('type', 'public'))
+                    for (addr, ent) in self._cache.items()
+                    if not self._is_fresh(ent, now)]
+
+    def refresh(self, resolve, addrs=None):
+        '''
+        resolve the stale entries in a background thread
+
+        resolve: func(addr, addr_type) -> name or None
+        addrs: entries to refresh if stale. all entries if None
+        '''
+        stale = self.stale()
+        if addrs is not None:
+            stale = [(a, t) for (a, t) in stale if a in addrs]
+        self._log.debug('stale=%s', stale)
+
+        if len(stale) == 0 or \
+           (self._refresh_th is not None and self._refresh_th.is_alive()):
+            return None
+
+        self._refresh_th = threading.Thread(target=self._refresh,
+                                            args=(resolve, stale),
+                                            daemon=True)
+        self._refresh_th.start()
+        return self._refresh_th
+
+    def _refresh(self, resolve, addrs):
+        for (addr, addr_type) in addrs:
+            try:
+                name = resolve(addr, addr_type)
+            except Exception as e:
+                self._log.debug('%s: %s:%s', addr, type(e).__name__, e)
+                name = None
+
+            # keep the last known name
+            ent = self.get(addr)
+            if name is None and ent is not None and ent[0] is not None:
+                self._failed(addr)
+                continue
+            self.put(addr, name, addr_type)
+
+        self.save()
+
+    def _failed(self, addr):
+        '''
+        not tried again for neg_ttl sec
+        '''
+        self._log.debug('%s', addr)
+
+        with self._lock:
+            ent = self._cache.get(addr)
+            if ent is not None:
+                ent['fail'] = time.time()
+                self._dirty = True
+
+    def close(self, timeout=None):
+        '''
+        timeout: sec to wait for the background refresh.
+          the rest is refreshed in the next run
+        '''
+        self._log.debug('timeout=%s', timeout)
+
+        if self._refresh_th is not None:
+            self._refresh_th.join(timeout)
+        self.save()
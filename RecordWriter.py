@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+#
+# (c) 2020 Yoichi Tanibayashi
+#
+"""
+Buffered record writer (JSON Lines or MessagePack)
+
+records (dict) are encoded one by one and written in batches,
+when 'batch' records are buffered or 'flush_interval' sec passed
+since the last flush. a flush thread writes the buffered records
+even if no more record comes (ex. between scans).
+bytes values are hex strings in JSON Lines.
+
+Usage:
+    writer = RecordWriter(sys.stdout.buffer, 'jsonl')
+    writer.write({'type': 'adv', 'addr': .., ..})
+    writer.close()
+
+msgpack is optional ('pip install msgpack').
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__   = '2020'
+
+import json
+import threading
+import time
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+from MyLogger import get_logger
+
+
+class RecordWriter:
+    FORMATS = ('jsonl', 'msgpack')
+
+    DEF_FLUSH_INTERVAL = 1.0  # sec
+    DEF_BATCH = 256           # records
+
+    _log = None
+
+    def __init__(self, out, fmt='jsonl', flush_interval=DEF_FLUSH_INTERVAL,
+                 batch=DEF_BATCH, debug=False):
+        '''
+        out: binary file object (ex. sys.stdout.buffer)
+        flush_interval: sec, 0 for every record
+        '''
+        self._dbg = debug
+        __class__._log = get_logger(__class__.__name__, self._dbg)
+        self._log.debug('fmt=%s, flush_interval=%s, batch=%s',
+                        fmt, flush_interval, batch)
+
+        if fmt not in self.FORMATS:
+            raise ValueError('fmt: %s' % fmt)
+        if fmt == 'msgpack' and msgpack is None:
+            raise RuntimeError('msgpack is not installed')
+
+        self._out = out
+        self._fmt = fmt
+        self._flush_interval = flush_interval
+        self._batch = batch
+
+        if self._fmt == 'msgpack':
+            self._encode = msgpack.Packer(use_bin_type=True,
+                                          default=self._default).pack
+        else:
+            self._encode = self._encode_json
+
+        self._buf = []
+        self._flush_time = time.time()
+        self._lock = threading.Lock()
+
+        self.stat = {'record': 0, 'flush': 0, 'bytes': 0}
+
+        self._closed = threading.Event()
+        self._flusher = None
+        if self._flush_interval > 0:
+            self._flusher = threading.Thread(target=self._flush_loop,
+                                             daemon=True)
+            self._flusher.start()
+
+    @staticmethod
+    def _default(obj):
+        if isinstance(obj, memoryview):
+            return bytes(obj)
+        raise TypeError('%s is not serializable' % type(obj).__name__)
+
+    @staticmethod
+    def _json_default(obj):
+        if isinstance(obj, (bytes, bytearray, memoryview)):
+            return bytes(obj).hex()
+        raise TypeError('%s is not serializable' % type(obj).__name__)
+
+    def _encode_json(self, rec):
+        return (json.dumps(rec, separators=(',', ':'),
+                           default=self._json_default) + '\n').encode('utf-8')
+
+    def write(self, rec):
+        data = self._encode(rec)
+        with self._lock:
+            self._buf.append(data)
+            self.stat['record'] += 1
+
+            if len(self._buf) >= self._batch or \
+               time.time() - self._flush_time >= self._flush_interval:
+                self._flush()
+
+    def _flush_loop(self):
+        '''
+        flush thread: 'flush_interval' sec after the last flush
+        '''
+        timeout = self._flush_interval
+        while not self._closed.wait(timeout):
+            with self._lock:
+                timeout = self._flush_time + self._flush_interval - time.time()
+                if timeout <= 0:
+                    self._flush()
+                    timeout = self._flush_interval
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        self._flush_time = time.time()
+        if len(self._buf) == 0:
+            return
+
+        data = b''.join(self._buf)
+        self._buf = []
+        self._out.write(data)
+        self._out.flush()
+        self.stat['flush'] += 1
+        self.stat['bytes'] += len(data)
+
+    def close(self):
+        self._log.debug('stat=%s', self.stat)
+        self._closed.set()
+        if self._flusher is not None:
+            self._flusher.join()
+        self.flush()
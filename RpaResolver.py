@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+#
+# (c) 2020 Yoichi Tanibayashi
+#
+"""
+Resolvable Private Address (RPA) resolver
+
+an RPA is resolved to the identity of the IRK that generates it, with
+the random address hash function ah() (Core spec Vol 3, Part H, 2.2.2).
+
+    addr = prand(24bit, top 2 bits: 01) || hash(24bit)
+    hash == ah(IRK, prand)
+
+the result of each address (also 'not resolved') is cached, so a
+rotating address is checked against the IRKs only once.
+
+AES-128 of 'cryptography' is used if installed, otherwise a pure
+Python implementation. both are fast enough with the cache.
+
+Usage:
+    resolver = RpaResolver({'aa:bb:cc:dd:ee:ff': 'ec0234a3..'})
+    identity = resolver.resolve(dev.addr)  # None if not resolved
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__   = '2020'
+
+from collections import OrderedDict
+from MyLogger import get_logger
+
+try:
+    from cryptography.hazmat.primitives.ciphers import (
+        Cipher, algorithms, modes)
+    from cryptography.hazmat.backends import default_backend
+except ImportError:
+    Cipher = None
+
+
+class Aes128:
+    '''
+    AES-128 block encryption (FIPS-197), pure Python
+    '''
+    _SBOX = None
+    _RCON = (0x01, 0x02, 0x04, 0x08, 0x10, 0x20, 0x40, 0x80, 0x1b, 0x36)
+
+    def __init__(self, key):
+        '''
+        key: 16 bytes
+        '''
+        if len(key) != 16:
+            raise ValueError('invalid key length: %d' % len(key))
+        if self._SBOX is None:
+            __class__._SBOX = self._make_sbox()
+        self._round_keys = self._expand(bytes(key))
+
+    @staticmethod
+    def _xtime(a):
+        a <<= 1
+        if a & 0x100:
+            a ^= 0x11b
+        return a
+
+    @classmethod
+    def _make_sbox(cls):
+        # multiplicative inverse in GF(2^8) with the generator 3
+        exp = [0] * 255
+        log = [0] * 256
+        a = 1
+        for i in range(255):
+            exp[i] = a
+            log[a] = i
+            a ^= cls._xtime(a)
+
+        sbox = [0] * 256
+        for x in range(256):
+            inv = 0 if x == 0 else exp[(255 - log[x]) % 255]
+            s = inv
+            for _ in range(4):
+                inv = ((inv << 1) | (inv >> 7)) & 0xff
+                s ^= inv
+            sbox[x] = s ^ 0x63
+        return bytes(sbox)
+
+    def _expand(self, key):
+        sbox = self._SBOX
+        w = [list(key[i:i + 4]) for i in range(0, 16, 4)]
+        for i in range(4, 44):
+            t = list(w[i - 1])
+            if i % 4 == 0:
+                t = [sbox[b] for b in t[1:] + t[:1]]
+                t[0] ^= self._RCON[i // 4 - 1]
+            w.append([a ^ b for (a, b) in zip(w[i - 4], t)])
+
+        return [sum(w[r * 4:r * 4 + 4], []) for r in range(11)]
+
+    def encrypt(self, block):
+        '''
+        block: 16 bytes
+
+        Returns
+        -------
+        16 bytes
+        '''
+        sbox = self._SBOX
+        xtime = self._xtime
+        rk = self._round_keys
+
+        s = [a ^ b for (a, b) in zip(block, rk[0])]
+        for r in range(1, 11):
+            # SubBytes and ShiftRows (column major state)
+            s = [sbox[s[(i + 4 * (i % 4)) % 16]] for i in range(16)]
+
+            # MixColumns
+            if r < 10:
+                m = []
+                for c in range(0, 16, 4):
+                    (a0, a1, a2, a3) = s[c:c + 4]
+                    t = a0 ^ a1 ^ a2 ^ a3
+                    m += [a0 ^ t ^ xtime(a0 ^ a1),
+                          a1 ^ t ^ xtime(a1 ^ a2),
+                          a2 ^ t ^ xtime(a2 ^ a3),
+                          a3 ^ t ^ xtime(a3 ^ a0)]
+                s = m
+
+            s = [a ^ b for (a, b) in zip(s, rk[r])]
+
+        return bytes(s)
+
+
+class CryptoAes128:
+    '''
+    AES-128 block encryption with 'cryptography'
+    '''
+    def __init__(self, key):
+        self._enc = Cipher(algorithms.AES(bytes(key)), modes.ECB(),
+                           backend=default_backend()).encryptor()
+
+    def encrypt(self, block):
+        return self._enc.update(bytes(block))
+
+
+class RpaResolver:
+    DEF_MAX_SIZE = 4096  # cached addresses
+
+    PADDING = bytes(13)
+
+    _log = None
+
+    def __init__(self, irks=None, max_size=DEF_MAX_SIZE, debug=False):
+        '''
+        irks: {identity: IRK}. IRK is 16 bytes or hex str (MSB first)
+          identity is str, usually the identity address
+        '''
+        self._dbg = debug
+        __class__._log = get_logger(__class__.__name__, self._dbg)
+        self._log.debug('identities=%s, max_size=%s',
+                        list((irks or {}).keys()), max_size)
+
+        self.max_size = max_size
+
+        self._aes_class = CryptoAes128 if Cipher is not None else Aes128
+        self._log.debug('aes=%s', self._aes_class.__name__)
+
+        self._keys = []              # [(identity, AES object)]
+        self._cache = OrderedDict()  # addr -> identity or None
+
+        for (identity, irk) in (irks or {}).items():
+            self.add(identity, irk)
+
+        self.stat = {'hit': 0, 'miss': 0, 'resolved': 0}
+
+    @classmethod
+    def from_spec(cls, spec, max_size=DEF_MAX_SIZE, debug=False):
+        '''
+        spec: ['IDENTITY=IRK(hex)', ..]
+        '''
+        irks = {}
+        for s in spec:
+            (identity, sep, irk) = s.partition('=')
+            if sep == '' or identity == '':
+                raise ValueError('invalid IRK spec: %s' % s)
+            irks[identity.lower()] = irk
+        return cls(irks, max_size, debug=debug)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def add(self, identity, irk):
+        if isinstance(irk, str):
+            irk = bytes.fromhex(irk.replace(':', '').replace(' ', ''))
+        if len(irk) != 16:
+            raise ValueError('%s: invalid IRK length: %d' % (
+                identity, len(irk)))
+
+        self._keys.append((identity, self._aes_class(irk)))
+
+        # negative results may be resolved with the new IRK
+        self._cache.clear()
+
+    def ah(self, aes, prand):
+        '''
+        random address hash function
+
+        aes: AES object of the IRK
+        prand: 3 bytes (MSB first)
+
+        Returns
+        -------
+        hash: 3 bytes (MSB first)
+        '''
+        return aes.encrypt(self.PADDING + prand)[13:]
+
+    @staticmethod
+    def is_rpa(addr):
+        '''
+        addr: 'aa:bb:cc:dd:ee:ff'
+        '''
+        return int(addr[0:2], 16) >> 6 == 0x1
+
+    def resolve(self, addr):
+        '''
+        addr: 'aa:bb:cc:dd:ee:ff'
+
+        Returns
+        -------
+        identity: None if not resolved (or not an RPA)
+        '''
+        try:
+            identity = self._cache[addr]
+        except KeyError:
+            pass
+        else:
+            self.stat['hit'] += 1
+            self._cache.move_to_end(addr)
+            return identity
+
+        self.stat['miss'] += 1
+        identity = self._resolve(addr)
+
+        self._cache[addr] = identity
+        while len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+        return identity
+
+    def _resolve(self, addr):
+        if len(self._keys) == 0 or not self.is_rpa(addr):
+            return None
+
+        try:
+            b = bytes.fromhex(addr.replace(':', ''))
+        except ValueError:
+            return None
+        if len(b) != 6:
+            return None
+
+        (prand, hash_) = (b[:3], b[3:])
+        for (identity, aes) in self._keys:
+            if self.ah(aes, prand) == hash_:
+                self._log.debug('%s -> %s', addr, identity)
+                self.stat['resolved'] += 1
+                return identity
+        return None
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+#
+# (c) 2020 Yoichi Tanibayashi
+#
+"""
+Adaptive scan scheduler for BleScan.scan()
+
+adapts, for each scan window:
+  window:  longer while no helper error (less restart gap),
+           shorter on error (AIMD, with a slowly rising ceiling)
+  passive: passive while no new devices are found,
+           active again when new devices appear (or to probe)
+
+bluepy-helper is stopped at the end of each window by Scanner.scan(),
+and it is restarted only when an error leaves it running.
+
+Usage:
+    sched = ScanScheduler(ble_scan)
+    sched.run(10)       # 10 windows
+    sched.metrics       # decisions and observed rates
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__   = '2020'
+
+from bluepy import btle
+from collections import deque
+import time
+from BlePresence import Ewma
+from MyLogger import get_logger
+
+
+class ScanScheduler:
+    DEF_WINDOW = 5        # sec
+    DEF_MIN_WINDOW = 2    # sec
+    DEF_MAX_WINDOW = 20   # sec
+
+    INCREASE = 1.25
+    DECREASE = 0.5
+    CEILING_RATIO = 0.8   # of the window with error
+    CEILING_PROBE = 1.05  # ceiling rises every good window
+
+    PASSIVE_AFTER = 3     # windows without new device
+    ACTIVE_PROBE = 10     # passive windows
+
+    ALPHA = 0.3
+    HISTORY = 100
+
+    _log = None
+
+    def __init__(self, ble_scan, window=DEF_WINDOW,
+                 min_window=DEF_MIN_WINDOW, max_window=DEF_MAX_WINDOW,
+                 debug=False):
+        self._dbg = debug
+        __class__._log = get_logger(__class__.__name__, self._dbg)
+        self._log.debug('window=%s, min_window=%s, max_window=%s',
+                        window, min_window, max_window)
+
+        self._ble_scan = ble_scan
+        self.window = window
+        self.min_window = min_window
+        self.max_window = max_window
+        self._ceiling = max_window
+
+        self.passive = False
+
+        self._advert_rate = Ewma(self.ALPHA)
+        self._new_rate = Ewma(self.ALPHA)
+        self._error_rate = Ewma(self.ALPHA)
+
+        self._no_new = 0
+        self._passive_windows = 0
+
+        self.history = deque(maxlen=self.HISTORY)
+        self._count = {'windows': 0, 'errors': 0, 'restarts': 0,
+                       'adverts': 0, 'time': 0.0}
+        self._reason = ''
+
+    @property
+    def metrics(self):
+        m = dict(self._count)
+        m.update({
+            'window': round(self.window, 2),
+            'ceiling': round(self._ceiling, 2),
+            'passive': self.passive,
+            'adverts_per_sec': self._advert_rate.value or 0.0,
+            'new_devs_per_sec': self._new_rate.value or 0.0,
+            'error_rate': self._error_rate.value or 0.0,
+            'reason': self._reason
+        })
+        return m
+
+    def run(self, windows=0, callback=None):
+        '''
+        windows: number of windows, 0 for forever
+        callback: func(devs, metrics) after each window
+        '''
+        self._log.debug('windows=%s', windows)
+
+        n = 0
+        while windows == 0 or n < windows:
+            devs = self.scan_once()
+            if callback is not None:
+                callback(devs, self.metrics)
+            n += 1
+
+    def scan_once(self):
+        '''
+        Returns
+        -------
+        devs: list of ScanEntry (empty on error)
+        '''
+        window = self.window
+        passive = self.passive
+        add0 = self._ble_scan.dev_table.stat['add']
+        start = time.time()
+        error = False
+        devs = []
+        try:
+            devs = list(self._ble_scan.scan(window, passive=passive))
+        except btle.BTLEException as e:
+            self._log.warning('%s:%s', type(e).__name__, e)
+            error = True
+            self._restart('error')
+
+        elapsed = max(time.time() - start, 1e-3)
+        adverts = sum([d.updateCount for d in devs])
+        new = self._ble_scan.dev_table.stat['add'] - add0
+
+        self._count['windows'] += 1
+        self._count['adverts'] += adverts
+        self._count['time'] += elapsed
+
+        self._adapt(elapsed, adverts, new, error)
+
+        self.history.append({
+            'time': start, 'window': window, 'passive': passive,
+            'elapsed': elapsed, 'adverts': adverts, 'new': new,
+            'error': error, 'reason': self._reason})
+        self._log.debug('%s', self.history[-1])
+        return devs
+
+    def _restart(self, reason):
+        self._log.debug('reason=%s', reason)
+        if self._ble_scan.restart_scanner():
+            self._count['restarts'] += 1
+
+    def _adapt(self, elapsed, adverts, new, error):
+        self._advert_rate.update(adverts / elapsed)
+        self._new_rate.update(new / elapsed)
+        self._error_rate.update(1.0 if error else 0.0)
+
+        reasons = []
+
+        # window
+        if error:
+            self._count['errors'] += 1
+            self._ceiling = max(self.min_window,
+                                self.window * self.CEILING_RATIO)
+            self.window = max(self.min_window, self.window * self.DECREASE)
+            reasons.append('error: window=%.1f' % self.window)
+        else:
+            self._ceiling = min(self.max_window,
+                                self._ceiling * self.CEILING_PROBE)
+            window = min(self._ceiling, self.window * self.INCREASE)
+            if window > self.window:
+                self.window = window
+                reasons.append('grow: window=%.1f' % self.window)
+
+        # passive / active
+        if self.passive:
+            self._passive_windows += 1
+            if new > 0:
+                self.passive = False
+                reasons.append('active: %d new devices' % new)
+            elif self._passive_windows >= self.ACTIVE_PROBE:
+                self.passive = False
+                reasons.append('active: probe')
+        else:
+            self._no_new = self._no_new + 1 if new == 0 else 0
+            if self._no_new >= self.PASSIVE_AFTER:
+                self.passive = True
+                self._passive_windows = 0
+                self._no_new = 0
+                reasons.append('passive: no new devices')
+
+        self._reason = ', '.join(reasons)
+        if self._reason:
+            self._log.info('%s', self._reason)
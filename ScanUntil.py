@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+#
+# (c) 2020 Yoichi Tanibayashi
+#
+"""
+Predicate terminated scan
+
+scans until a predicate is satisfied or the deadline, and stops the
+scanner (bluepy-helper) at once, so the connection can start without
+waiting for the rest of a fixed scan time.
+
+the predicate is checked in handleDiscovery(), and the scan is stopped
+within 'interval' sec after it is satisfied.
+
+Usage:
+    su = ScanUntil(btle.Scanner(0).withDelegate(delegate))
+
+    # all of the addresses or Local Names
+    devs = su.scan(['ac:23:3f:a0:01:02', 'MyESP32'], timeout=10)
+
+    # a predicate for each advertisement
+    devs = su.scan(lambda dev: dev.rssi > -50, timeout=10)
+
+    su.satisfied, su.elapsed
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__   = '2020'
+
+from bluepy import btle
+import time
+from AdView import AdView
+from MyLogger import get_logger
+
+
+class Targets:
+    '''
+    predicate: True when all (or any) of the targets are found
+
+    targets: addresses or Local Names
+    identity: func(dev) -> address to match (ex. BleScan.identity)
+    '''
+    def __init__(self, targets, any_=False, identity=None):
+        self.targets = frozenset(targets)
+        self.any = any_
+        self._identity = identity
+        self.found = {}  # target -> addr
+
+    def __call__(self, dev):
+        hit = False
+        addr = dev.addr
+        if self._identity is not None:
+            addr = self._identity(dev)
+        if addr in self.targets and addr not in self.found:
+            self.found[addr] = dev.addr
+            hit = True
+
+        name = AdView.of(dev).name
+        if name is not None and name in self.targets and \
+           name not in self.found:
+            self.found[name] = dev.addr
+            hit = True
+
+        if self.any:
+            return hit
+        return len(self.found) >= len(self.targets)
+
+
+class UntilDelegate(btle.DefaultDelegate):
+    def __init__(self, delegate, until):
+        self.delegate = delegate
+        self._until = until
+        self.satisfied = None  # addr
+        super().__init__()
+
+    def handleDiscovery(self, dev, isNewDev, isNewData):
+        if self.delegate is not None:
+            self.delegate.handleDiscovery(dev, isNewDev, isNewData)
+
+        if self.satisfied is None and self._until(dev):
+            self.satisfied = dev.addr
+
+
+class ScanUntil:
+    DEF_TIMEOUT = 10     # sec
+    DEF_INTERVAL = 0.05  # sec
+
+    _log = None
+
+    def __init__(self, scanner, interval=DEF_INTERVAL, debug=False):
+        '''
+        scanner: bluepy.btle.Scanner compatible object
+        interval: sec to check the predicate
+        '''
+        self._dbg = debug
+        __class__._log = get_logger(__class__.__name__, self._dbg)
+        self._log.debug('interval=%s', interval)
+
+        self._scanner = scanner
+        self._interval = interval
+
+        self.satisfied = False
+        self.elapsed = 0.0
+
+    def scan(self, until, timeout=DEF_TIMEOUT, passive=False):
+        '''
+        until: func(dev) -> bool, or addresses and Local Names (Targets)
+        timeout: deadline sec, 0 for no deadline
+
+        Returns
+        -------
+        devs: list of ScanEntry scanned so far
+        '''
+        self._log.debug('until=%s, timeout=%s, passive=%s',
+                        until, timeout, passive)
+
+        if isinstance(until, str):
+            until = [until]
+        if not callable(until):
+            until = Targets(until)
+
+        delegate = self._scanner.delegate
+        until_delegate = UntilDelegate(delegate, until)
+        self._scanner.withDelegate(until_delegate)
+
+        start = time.time()
+        try:
+            self._scanner.clear()
+            self._scanner.start(passive=passive)
+            while until_delegate.satisfied is None:
+                interval = self._interval
+                if timeout:
+                    remain = start + timeout - time.time()
+                    if remain <= 0:
+                        break
+                    interval = min(interval, remain)
+                self._scanner.process(interval)
+
+                # AdvReplayScanner: all records replayed
+                if getattr(self._scanner, 'done', False):
+                    break
+        finally:
+            self._scanner.withDelegate(delegate)
+            self._stop()
+            self.elapsed = time.time() - start
+
+        self.satisfied = until_delegate.satisfied is not None
+
+        self._log.debug('satisfied=%s, elapsed=%.3f',
+                        self.satisfied, self.elapsed)
+        return self._scanner.getDevices()
+
+    def _stop(self):
+        try:
+            self._scanner.stop()
+        except Exception as e:
+            self._log.warning('%s:%s', type(e).__name__, e)
@@ -10,8 +10,13 @@ __date__   = '2020'
 
 from bluepy import btle
 import time
-import binascii
+import sys
 import click
+from AdView import AdView
+from DevTable import DevTable
+from RecordWriter import RecordWriter
+from GattDecoder import GattDecoder
+from BleRetry import RetryPolicy, CircuitBreaker, RetryError
 from MyLogger import get_logger
 
 
@@ -28,16 +33,23 @@ class ScanDelegate(btle.DefaultDelegate):
     def handleDiscovery(self, dev, isNewDev, isNewData):
         self._log.debug('isNewDev=%s, isNewData=%s', isNewDev, isNewData)
 
-        if self._ble_scan.scan_timeout == 0:
-            print('')
-
         newflag = '[-]'
 
         if isNewData:
             newflag = '[U]'
         if isNewDev:
-            self._ble_scan.devs.append(dev)
             newflag = '[N]'
+        self._ble_scan.devs.update(dev)
+
+        writer = self._ble_scan.writer
+        if writer is not None:
+            writer.write(self._ble_scan.adv_record(dev, newflag[1]))
+            if isNewData and self._ble_scan.scan_timeout == 0:
+                self._ble_scan.dev_info(dev, dev_data=False, conn_retry=2)
+            return
+
+        if self._ble_scan.scan_timeout == 0:
+            print('')
         print('%s ' % (newflag), end='')
 
         # print(self._ble_scan.dev2string(dev))
@@ -49,20 +61,46 @@ class ScanDelegate(btle.DefaultDelegate):
 
 
 class BleScan:
-    _log = None
+    CONN_RETRY_BASE = 0.5  # sec
+    GATT_RETRY_BASE = 0.1  # sec
 
-    def __init__(self, hci=0, scan_timeout=5, debug=False):
+    _log = None
+    _conn_retry = None
+    _gatt_retry = None
+    _decoder = None
+
+    def __init__(self, hci=0, scan_timeout=5, writer=None, debug=False):
+        '''
+        writer: RecordWriter. records instead of text if given
+        '''
         self._dbg = debug
         __class__._log = get_logger(__class__.__name__, self._dbg)
-        self._log.debug('hci=%s, scan_timeout=%s', hci, scan_timeout)
+        self._log.debug('hci=%s, scan_timeout=%s, writer=%s',
+                        hci, scan_timeout, writer)
+
+        __class__._conn_retry = RetryPolicy(
+            'Connection',
+            rules={btle.BTLEDisconnectError: self.CONN_RETRY_BASE,
+                   Exception: self.GATT_RETRY_BASE},
+            breaker=CircuitBreaker(debug=self._dbg), debug=self._dbg)
+        __class__._gatt_retry = RetryPolicy(
+            'GATT',
+            rules={btle.BTLEDisconnectError: RetryPolicy.RAISE,
+                   Exception: self.GATT_RETRY_BASE},
+            debug=self._dbg)
+        __class__._decoder = GattDecoder(debug=self._dbg)
 
         self._hci = hci
         self.scan_timeout = scan_timeout
+        self.writer = writer
 
         self._delegate = ScanDelegate(self, debug=self._dbg)
         self._scanner = btle.Scanner(self._hci).withDelegate(self._delegate)
 
-        self.devs = []
+        self.devs = DevTable(on_evict=self._on_evict, debug=self._dbg)
+
+    def _on_evict(self, rec, reason):
+        self._scanner.scanned.pop(rec.addr, None)
 
     def scan(self, scan_timeout=None):
         self._log.debug('scan_timeout=%s', scan_timeout)
@@ -80,10 +118,15 @@ class BleScan:
         self._log.debug('conn_retry=%s, get_chara=%s, read_chara=%s',
                         conn_retry, get_chara, read_chara)
 
-        print(self.dev2string(dev))
+        report = None
+        if self.writer is not None:
+            report = {'type': 'gatt', 'time': time.time(),
+                      'addr': dev.addr, 'svcs': []}
+        else:
+            print(self.dev2string(dev))
 
-        if dev_data:
-            self.dev_data(dev, indent=4)
+            if dev_data:
+                self.dev_data(dev, indent=4)
 
         if not dev.connectable:
             return
@@ -91,28 +134,33 @@ class BleScan:
         if conn_retry < 1:
             return
 
-        count = 0  # < 0: OK
-        while count < conn_retry:
-            try:
-                with btle.Peripheral(dev, dev.addrType) as peri:
-                    self._log.debug('Connection: OK .. %d/%d',
-                                    count + 1, conn_retry)
-                    self.dump_svc(peri, get_chara, read_chara, indent=2)
-                    count = -1
-                break
-            except btle.BTLEDisconnectError as e:
-                self._log.debug('%s:%s', type(e).__name__, e)
-                self._log.warning('Connection: NG .. %d/%d',
-                                  count + 1, conn_retry)
-                count += 1
-            except Exception as e:
-                self._log.warning('%s:%s', type(e).__name__, e)
-                self._log.warning('Connection: NG .. %d/%d',
-                                  count + 1, conn_retry)
-                count += 1
+        try:
+            self._conn_retry.call(self._connect_dump,
+                                  dev, get_chara, read_chara, report,
+                                  retry=conn_retry, key=dev.addr)
+        except RetryError as e:
+            self._log.warning('%s', e)
+            if report is not None:
+                report['error'] = str(e)
+
+        if report is not None:
+            self.writer.write(report)
+
+    def _connect_dump(self, dev, get_chara, read_chara, report=None):
+        if report is not None:
+            report['svcs'] = []
+
+        with btle.Peripheral(dev, dev.addrType) as peri:
+            self._log.debug('Connection: OK')
+            self.dump_svc(peri, get_chara, read_chara, indent=2,
+                          report=report)
 
     def end(self):
         self._log.debug('')
+        if self.writer is not None:
+            self.writer.close()
+        self._log.debug('Connection: %s', self._conn_retry.stat)
+        self._log.debug('GATT: %s', self._gatt_retry.stat)
 
     @classmethod
     def dev2string(cls, dev):
@@ -120,11 +168,8 @@ class BleScan:
 
         ret = 'Device '
 
-        name = ''
-        for (adtype, desc, val) in dev.getScanData():
-            if 'Local Name' in desc:
-                name = val
-        if name != '':
+        name = AdView.of(dev).name
+        if name:
             ret += '"' + name + '"'
 
         ret += '[%s](%s) %s dBm connectable:%s' % (dev.addr,
@@ -133,33 +178,63 @@ class BleScan:
                                                    dev.connectable)
         return ret
 
+    @classmethod
+    def adv_record(cls, dev, flag=None):
+        '''
+        flag: 'N'(new device), 'U'(updated data) or '-'
+        '''
+        return {
+            'type': 'adv',
+            'time': time.time(),
+            'addr': dev.addr,
+            'addrType': dev.addrType,
+            'rssi': dev.rssi,
+            'connectable': dev.connectable,
+            'flag': flag,
+            'name': AdView.of(dev).name,
+            'raw': dev.rawData
+        }
+
     @classmethod
     def dev_data(cls, dev, indent=4):
         cls._log.debug('indent=%d', indent)
 
         indent_str = ' ' * indent
 
-        for (adtype, desc, val) in dev.getScanData():
+        view = AdView.of(dev)
+        for (adtype, val) in view.items():
             # print('%s%3d:%s: "%s"' % (indent_str, adtype, desc, val))
-            print('%s%s: "%s"' % (indent_str, desc, val))
+            print('%s%s: "%s"' % (indent_str, view.description(adtype),
+                                  view.text(adtype, val)))
         if not dev.scanData:
             print('%s(no data)' % (indent_str))
 
     @classmethod
-    def dump_svc(cls, peri, get_chara=3, read_chara=3, indent=2):
+    def dump_svc(cls, peri, get_chara=3, read_chara=3, indent=2,
+                 report=None):
+        '''
+        report: dict. filled instead of print if given
+        '''
         cls._log.debug('read_chara=%s, indent=%d', read_chara, indent)
 
         indent_str = ' ' * indent
 
         svcs = sorted(peri.services, key=lambda s: s.hndStart)
         for i, s in enumerate(svcs):
-            # print('%s%3d:Service[%s]' % (indent_str, i, s.uuid))
-            print(indent_str, end='')
-            print('Service [%s]' % (s.uuid))
-            cls.dump_chara(s, get_chara, read_chara, indent=indent+2)
+            svc_report = None
+            if report is not None:
+                svc_report = {'uuid': str(s.uuid), 'charas': []}
+                report['svcs'].append(svc_report)
+            else:
+                # print('%s%3d:Service[%s]' % (indent_str, i, s.uuid))
+                print(indent_str, end='')
+                print('Service [%s]' % (s.uuid))
+            cls.dump_chara(s, get_chara, read_chara, indent=indent+2,
+                           report=svc_report)
 
     @classmethod
-    def dump_chara(cls, svc, get_chara=3, read_chara=3, indent=8):
+    def dump_chara(cls, svc, get_chara=3, read_chara=3, indent=8,
+                   report=None):
         cls._log.debug('get_chara=%s, read_chara=%d, indent=%d',
                        get_chara, read_chara, indent)
 
@@ -168,35 +243,34 @@ class BleScan:
 
         indent_str = ' ' * indent
 
-        count = 0
-        while count < get_chara:
-            try:
-                chara = svc.getCharacteristics()
-                count = -1
-                break
-            except btle.BTLEDisconnectError as e:
-                cls._log.warning('%s:%s', type(e).__name__, e)
-                raise e
-            except Exception as e:
-                cls._log.warning('%s:%s', type(e).__name__, e)
-                time.sleep(1)
-                count += 1
-
-        if count >= 0:  # failed
-            print('%s(getCharacteristics: failed)' % (indent_str))
-            raise RuntimeError('getCharacteristics: failed')
+        try:
+            chara = cls._gatt_retry.call(svc.getCharacteristics,
+                                         retry=get_chara)
+        except RetryError as e:
+            if report is not None:
+                report['error'] = 'getCharacteristics: failed'
+            else:
+                print('%s(getCharacteristics: failed)' % (indent_str))
+            raise RuntimeError('getCharacteristics: failed') from e
 
         for i, c in enumerate(chara):
-            # print('%s%3d:%s' % (indent_str, i, c))
-            print('%s%s' % (indent_str, c))
-            print('%s  Properties: %s' %
-                  (indent_str, c.propertiesToString()))
+            chara_report = None
+            if report is not None:
+                chara_report = {'uuid': str(c.uuid), 'handle': c.valHandle,
+                                'props': c.propertiesToString().split()}
+                report['charas'].append(chara_report)
+            else:
+                # print('%s%3d:%s' % (indent_str, i, c))
+                print('%s%s' % (indent_str, c))
+                print('%s  Properties: %s' %
+                      (indent_str, c.propertiesToString()))
 
             if c.supportsRead():
-                cls.chara_read(c, retry=read_chara, indent=indent+2)
+                cls.chara_read(c, retry=read_chara, indent=indent+2,
+                               report=chara_report)
 
     @classmethod
-    def chara_read(cls, chara, retry=5, indent=10):
+    def chara_read(cls, chara, retry=5, indent=10, report=None):
         cls._log.debug('retry=%d, indent=%d', retry, indent)
 
         if retry < 1:
@@ -204,40 +278,26 @@ class BleScan:
 
         indent_str = ' ' * indent
 
-        count = 0
-        while count < retry:
-            try:
-                val = chara.read()
-                count = -1
-                break
-            except btle.BTLEDisconnectError as e:
-                cls._log.warning('%s:%s', type(e).__name__, e)
-                raise e
-            except Exception as e:
-                cls._log.warning('%s:%s', type(e).__name__, e)
-                time.sleep(1)
-                count += 1
-
-        if count >= 0:  # read failed
-            print('%s(read: failed)', indent_str)
-            raise RuntimeError('read: failed')
-
-        val_str1 = ''
-        val_str2 = ''
-        if chara.uuid == btle.AssignedNumbers.device_name:
-            val_str1 = '"' + val.decode('utf-8') + '"'
-        elif chara.uuid == btle.AssignedNumbers.device_information:
-            val_str1 = '|' + repr(val) + '|'
-        else:
-            val_str1 = '%a' % val
-            # val_str2 = '<' + binascii.b2a_hex(val).decode('utf-8') + '>'
-            s = binascii.b2a_hex(val).decode('utf-8')
-            val_str2 = ' '.join([s[i:i+2] for i in range(0, len(s), 2)])
-            val_str2 = '<' + val_str2 + '>'
+        try:
+            val = cls._gatt_retry.call(chara.read, retry=retry)
+        except RetryError as e:
+            if report is not None:
+                report['error'] = 'read: failed'
+            else:
+                print('%s(read: failed)' % (indent_str))
+            raise RuntimeError('read: failed') from e
+
+        if report is not None:
+            report['value'] = val
+            decoded = cls._decoder.decode(chara.uuid, val)
+            if decoded is not val:
+                report['decoded'] = decoded
+            return
 
-        print('%sValue: %s' % (indent_str, val_str1))
-        if val_str2 != '':
-            print('%s       %s' % (indent_str, val_str2))
+        (val_str, hex_str) = cls._decoder.render(chara.uuid, val)
+        print('%sValue: %s' % (indent_str, val_str))
+        if hex_str is not None:
+            print('%s       %s' % (indent_str, hex_str))
 
 
 class App:
@@ -245,12 +305,14 @@ class App:
 
     def __init__(self, hci=0, scan_timeout=5,
                  conn_svc=3, get_chara=3, read_chara=3,
+                 fmt='text', flush_interval=RecordWriter.DEF_FLUSH_INTERVAL,
                  debug=False):
         self._dbg = debug
         __class__._log = get_logger(__class__.__name__, self._dbg)
         self._log.debug('hci=%s, scan_timeout=%s', hci, scan_timeout)
         self._log.debug('conn_svc=%s,get_chara=%s,read_chara=%s',
                         conn_svc, get_chara, read_chara)
+        self._log.debug('fmt=%s, flush_interval=%s', fmt, flush_interval)
 
         self._hci = hci
         self._scan_timeout = scan_timeout
@@ -258,19 +320,28 @@ class App:
         self._get_chara = get_chara
         self._read_chara = read_chara
 
-        self._ble_scan = BleScan(self._hci, self._scan_timeout, debug)
+        self._writer = None
+        if fmt != 'text':
+            self._writer = RecordWriter(sys.stdout.buffer, fmt,
+                                        flush_interval, debug=self._dbg)
+
+        self._ble_scan = BleScan(self._hci, self._scan_timeout,
+                                 self._writer, debug)
 
     def main(self):
         self._log.debug('')
 
-        print('=====< Scan start >=====')
+        if self._writer is None:
+            print('=====< Scan start >=====')
         devs = self._ble_scan.scan()
-        print('=====< Scan end >=====')
+        if self._writer is None:
+            print('=====< Scan end >=====')
         devs2 = self._ble_scan.devs
         self._log.debug('len(devs)=%d, len(dev2)=%d', len(devs), len(devs2))
 
         for d in devs2:
-            print('')
+            if self._writer is None:
+                print('')
             self._ble_scan.dev_info(d, dev_data=True,
                                     conn_retry=self._conn_svc,
                                     get_chara=self._get_chara,
@@ -297,15 +368,25 @@ BLE Device Scanner
               help='get characteristics')
 @click.option('--read_chara', '-r', 'read_chara', type=int, default=3,
               help='read characteristics value')
+@click.option('--format', '-f', 'fmt',
+              type=click.Choice(('text',) + RecordWriter.FORMATS),
+              default='text',
+              help='output format (jsonl, msgpack: one record per line/object)')
+@click.option('--flush_interval', '-F', 'flush_interval', type=float,
+              default=RecordWriter.DEF_FLUSH_INTERVAL,
+              help='flush interval sec for jsonl/msgpack, 0 for every record')
 @click.option('--debug', '-d', 'debug', is_flag=True, default=False,
               help='debug flag')
-def main(hci, scan_timeout, conn_svc, get_chara, read_chara, debug):
+def main(hci, scan_timeout, conn_svc, get_chara, read_chara, fmt,
+         flush_interval, debug):
     logger = get_logger(__name__, debug)
     logger.debug('hci=%s, scan_timeout=%s', hci, scan_timeout)
     logger.debug('conn_svc=%s, get_chara=%s, read_chara=%s',
                  conn_svc, get_chara, read_chara)
+    logger.debug('fmt=%s, flush_interval=%s', fmt, flush_interval)
 
-    app = App(hci, scan_timeout, conn_svc, get_chara, read_chara, debug=debug)
+    app = App(hci, scan_timeout, conn_svc, get_chara, read_chara,
+              fmt, flush_interval, debug=debug)
     try:
         app.main()
     finally:
@@ -12,6 +12,10 @@ import bluepy.btle
 import queue
 import time
 import click
+from BleRetry import RetryPolicy
+from BleUuid import BleUuid
+from AdParser import AdParser
+from ScanUntil import ScanUntil
 from MyLogger import get_logger
 
 
@@ -39,11 +43,13 @@ class ScanDelegate(DefaultDelegate):
 
         addr = scanEntry.addr
         addr_type = scanEntry.addrType
-        scan_data = scanEntry.getScanData()
-        for (ad_type, ad_desc, ad_value) in scan_data:
-            if self.dev_name in ad_value:
+        for (ad_type, payload) in AdParser.parse(scanEntry.rawData):
+            if ad_type not in AdParser.LOCAL_NAME:
+                continue
+            name = AdParser.name(payload)
+            if self.dev_name in name:
                 self._logger.debug('%s(%s)', addr, addr_type)
-                self._logger.debug('%3s,%s,%s', ad_type, ad_desc, ad_value)
+                self._logger.debug('%3s,%s', ad_type, name)
 
                 self.addrq.put((addr, addr_type))
 
@@ -61,7 +67,9 @@ class ScanDelegate(DefaultDelegate):
 
 
 class App:
-    DST_UUID = 'beb5483e-36e1-4688-b7f5-ea07361b26a8'
+    DST_UUID = BleUuid('beb5483e-36e1-4688-b7f5-ea07361b26a8')
+    CONN_RETRY_BASE = 0.1  # sec
+    SCAN_TIMEOUT = 10      # sec for each scan
 
     def __init__(self, dev_name, cmd, debug=False):
         self._debug = debug
@@ -75,6 +83,11 @@ class App:
         self._delegate = ScanDelegate(self.dev_name, self.addrq,
                                       debug=self._debug)
         self._scanner = Scanner().withDelegate(self._delegate)
+        self._scan_until = ScanUntil(self._scanner, debug=self._debug)
+
+        self._conn_retry = RetryPolicy('Connection', RetryPolicy.FOREVER,
+                                       rules={Exception: self.CONN_RETRY_BASE},
+                                       debug=self._debug)
 
     def main(self):
         self._logger.debug('')
@@ -83,7 +96,10 @@ class App:
             if self.addrq.empty():
                 try:
                     self._logger.info('scanning..')
-                    self._scanner.scan(1, passive=False)
+                    # until the device is found by the delegate
+                    self._scan_until.scan(
+                        lambda dev: not self.addrq.empty(),
+                        self.SCAN_TIMEOUT, passive=False)
                 except Exception as e:
                     msg = '%s:%s' % (type(e), e)
                     self._logger.error(msg)
@@ -96,18 +112,10 @@ class App:
                 self.addrq.put((addr, addr_type))
                 self._logger.info('addr=%s(%s)', addr, addr_type)
 
-                while True:
-                    try:
-                        self._logger.info('connecting..')
-                        peri = bluepy.btle.Peripheral(addr, addr_type)
-                        self._logger.info('connected')
-                        break
-
-                    except Exception as e:
-                        self._logger.error('%s:%s.', type(e), e)
-                        self._logger.info('retry!')
-                    finally:
-                        time.sleep(.1)
+                self._logger.info('connecting..')
+                peri = self._conn_retry.call(bluepy.btle.Peripheral,
+                                             addr, addr_type)
+                self._logger.info('connected')
 
                 try:
                     for svc in peri.getServices():
@@ -119,7 +127,7 @@ class App:
                             props = chara.propertiesToString()
                             self._logger.debug('    Props =%s', props)
 
-                            if chara.uuid == self.DST_UUID:
+                            if BleUuid(chara.uuid) == self.DST_UUID:
                                 self._logger.info('CharaUUID=%s',
                                                   self.DST_UUID)
                                 peri.writeCharacteristic(handle,
@@ -11,13 +11,14 @@ from bluepy.btle import DefaultDelegate, Scanner
 import bluepy.btle
 import queue
 import sys
-import time
 import click
+from BleRetry import RetryPolicy
 from MyLogger import get_logger
 
 
 class ScanDelegate(DefaultDelegate):
     DST_UUID = 'beb5483e-36e1-4688-b7f5-ea07361b26a8'
+    CONN_RETRY_BASE = 0.1  # sec
 
     def __init__(self, app, cmd='', debug=False):
         self._debug = debug
@@ -30,6 +31,11 @@ class ScanDelegate(DefaultDelegate):
         self.p_addr = ''
         self.p_addr_type = ''
 
+        self._conn_retry = RetryPolicy(
+            'Connection', RetryPolicy.FOREVER,
+            rules={bluepy.btle.BTLEDisconnectError: self.CONN_RETRY_BASE},
+            debug=self._debug)
+
         super().__init__()
 
     def handleNotification(self, handle, data):
@@ -60,51 +66,44 @@ class ScanDelegate(DefaultDelegate):
 
             # time.sleep(3)
 
-            while True:
-                try:
-                    self._lg.info('connecting..')
-                    peri = bluepy.btle.Peripheral(addr, addr_type)
-                    self._lg.info('connected')
-
-                except bluepy.btle.BTLEDisconnectError as e:
-                    self._lg.error('%s:%s.', type(e), e)
-                    self._lg.info('retry!')
-                    continue
-                except Exception as e:
-                    self._lg.error('%s:%s.', type(e), e)
-                    return
-                finally:
-                    time.sleep(.1)
-
-                for svc in peri.getServices():
-                    self._lg.debug('Svc UUID=%s', svc.uuid)
-                    for chara in svc.getCharacteristics():
-                        self._lg.debug('  Chara UUID=%s', chara.uuid)
-                        handle = chara.getHandle()
-                        self._lg.debug('    Handle=%s', handle)
-
-                        props = chara.propertiesToString()
-                        self._lg.debug('    Props =%s', props)
-
-                        if chara.uuid == self.DST_UUID:
-                            self._lg.info('CharaUUID=%s', self.DST_UUID)
-                            try:
-                                peri.writeCharacteristic(handle,
-                                                         self._cmd.encode(
-                                                             'utf-8'),
-                                                         False)
-                                self._lg.debug('write: done')
-                                self._app._stat = 'done'
-                            except Exception as e:
-                                self._lg.error('%s:%s.', type(e), e)
-
-                            peri.disconnect()
-                            return
-
-                self._app._stat = 'continue'
-
-                peri.disconnect()
+            self._lg.info('connecting..')
+            try:
+                peri = self._conn_retry.call(bluepy.btle.Peripheral,
+                                             addr, addr_type)
+            except Exception as e:
+                self._lg.error('%s:%s.', type(e), e)
                 return
+            self._lg.info('connected')
+
+            for svc in peri.getServices():
+                self._lg.debug('Svc UUID=%s', svc.uuid)
+                for chara in svc.getCharacteristics():
+                    self._lg.debug('  Chara UUID=%s', chara.uuid)
+                    handle = chara.getHandle()
+                    self._lg.debug('    Handle=%s', handle)
+
+                    props = chara.propertiesToString()
+                    self._lg.debug('    Props =%s', props)
+
+                    if chara.uuid == self.DST_UUID:
+                        self._lg.info('CharaUUID=%s', self.DST_UUID)
+                        try:
+                            peri.writeCharacteristic(handle,
+                                                     self._cmd.encode(
+                                                         'utf-8'),
+                                                     False)
+                            self._lg.debug('write: done')
+                            self._app._stat = 'done'
+                        except Exception as e:
+                            self._lg.error('%s:%s.', type(e), e)
+
+                        peri.disconnect()
+                        return
+
+            self._app._stat = 'continue'
+
+            peri.disconnect()
+            return
 
         self._app._stat = 'continue'
 
@@ -11,6 +11,7 @@ from bluepy.btle import DefaultDelegate, Scanner, BTLEException
 import bluepy.btle
 import time
 
+from DevTable import DevTable
 from MyLogger import get_logger
 
 
@@ -23,7 +24,7 @@ class ScanDelegate(DefaultDelegate):
         self._logger = get_logger(__class__.__name__, self._debug)
         self._logger.debug('')
 
-        self._addr = {}
+        self._addr = DevTable(debug=self._debug)
 
         super().__init__()
 
@@ -32,15 +33,15 @@ class ScanDelegate(DefaultDelegate):
         self._logger.debug('scanEntry=%s, isNewDev=%s, isNewData=%s',
                            scanEntry, isNewDev, isNewData)
         """
+        (rec, is_new) = self._addr.update(scanEntry)
         if not isNewDev:
             return
 
         addr = scanEntry.addr
         addr_type = scanEntry.addrType
 
-        if addr in self._addr.keys():
+        if not is_new:
             return
-        self._addr[addr] = True
         print(addr, addr_type)
         return
 
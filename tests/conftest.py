@@ -0,0 +1,10 @@
+#
+# (c) 2020 Yoichi Tanibayashi
+#
+import os
+import sys
+
+# flat modules in the top directory, and the fakes in tests/
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TEST_DIR))
+sys.path.insert(0, TEST_DIR)
@@ -0,0 +1,280 @@
+#
+# (c) 2020 Yoichi Tanibayashi
+#
+"""
+Fake bluepy-helper for tests
+
+FakePeripheral is a btle.Peripheral that talks to an in-process GATT
+database instead of bluepy-helper, so the real bluepy code (UUID
+conversion, response and error handling) runs. each command sleeps
+'latency' sec, like a round trip over the air.
+
+Usage:
+    db = FakeGatt([('1800', [('2a00', b'MyESP32')])])
+    FakePeripheral.setup(db, latency=0.05)
+    with FakePeripheral('aa:bb:cc:dd:ee:ff') as p:
+        p.getCharacteristics(uuid='2a00')[0].read()
+"""
+import threading
+import time
+from bluepy import btle
+
+
+class FakeGatt:
+    '''
+    services: [(svc_uuid, [(chara_uuid, value or None, props), ..]), ..]
+      props may be omitted (READ). value None: not readable
+    '''
+    PROP_READ = 0x02
+    PROP_INDICATE = 0x20
+    UUID_CCCD = btle.UUID(0x2902)
+
+    def __init__(self, services, mtu=247):
+        self.mtu = mtu
+        self.svcs = []    # [(uuid, start, end)]
+        self.charas = []  # [(uuid, hnd, props, vhnd)]
+        self.descs = []   # [(uuid, hnd)]
+        self.values = {}  # vhnd -> bytes
+
+        hnd = 1
+        for (svc_uuid, charas) in services:
+            start = hnd
+            for ent in charas:
+                (uuid, val) = ent[:2]
+                props = ent[2] if len(ent) > 2 else \
+                    (self.PROP_READ if val is not None else 0)
+                self.charas.append((btle.UUID(uuid), hnd, props, hnd + 1))
+                self.descs.append((btle.UUID(0x2803), hnd))
+                self.descs.append((btle.UUID(uuid), hnd + 1))
+                if val is not None:
+                    self.values[hnd + 1] = val
+                hnd += 2
+                if props & self.PROP_INDICATE:
+                    self.descs.append((self.UUID_CCCD, hnd))
+                    self.values[hnd] = b'\x00\x00'
+                    hnd += 1
+            self.svcs.append((btle.UUID(svc_uuid), start, hnd - 1))
+            hnd += 1
+
+    def value_handle(self, uuid):
+        for (u, hnd, props, vhnd) in self.charas:
+            if u == btle.UUID(uuid):
+                return vhnd
+        return None
+
+
+class FakePeripheral(btle.Peripheral):
+    '''
+    class attributes are shared by all connections (set by setup())
+    '''
+    db = None
+    latency = 0.0
+    conn_latency = None  # latency if None
+    fail_conn = 0        # number of connections to fail
+
+    lock = threading.Lock()
+    cmds = []            # commands sent, for assertions
+    active = 0           # connections (helpers) running
+    peak = 0             # max of active
+
+    @classmethod
+    def setup(cls, db, latency=0.0, conn_latency=None, fail_conn=0):
+        cls.db = db
+        cls.latency = latency
+        cls.conn_latency = conn_latency
+        cls.fail_conn = fail_conn
+        cls.cmds = []
+        cls.active = 0
+        cls.peak = 0
+
+    @classmethod
+    def count(cls, cmd):
+        return len([c for c in cls.cmds if c.split()[0] == cmd])
+
+    def __init__(self, deviceAddr=None, addrType=btle.ADDR_TYPE_PUBLIC,
+                 iface=None):
+        self._rsp = []
+        self.indications = []  # (hnd, data) sent after the CCCD is set
+        super().__init__(deviceAddr, addrType, iface)
+
+    # _helper is not None while connected, as bluepy checks it
+    def _startHelper(self, iface=None):
+        self._helper = self
+        with self.lock:
+            FakePeripheral.active += 1
+            FakePeripheral.peak = max(FakePeripheral.peak,
+                                      FakePeripheral.active)
+
+    def _stopHelper(self):
+        if self._helper is None:
+            return
+        self._helper = None
+        with self.lock:
+            FakePeripheral.active -= 1
+
+    def _writeCmd(self, cmd):
+        if self._helper is None:
+            raise btle.BTLEInternalError('Helper not started')
+
+        args = cmd.split()
+        with self.lock:
+            self.cmds.append(cmd.strip())
+
+        latency = self.latency
+        if args[0] == 'conn' and self.conn_latency is not None:
+            latency = self.conn_latency
+        time.sleep(latency)
+
+        self._rsp.append(getattr(self, '_cmd_' + args[0])(*args[1:]))
+
+    def _waitResp(self, wantType, timeout=None):
+        if self._helper is None:
+            raise btle.BTLEInternalError('Helper exited')
+
+        while True:
+            if len(self._rsp) == 0:
+                if timeout:
+                    time.sleep(min(timeout, 0.01))
+                return None
+
+            resp = self._rsp.pop(0)
+            resp_type = resp['rsp'][0]
+            if resp_type in wantType:
+                return resp
+            if resp_type == 'stat' and resp['state'][0] == 'disc':
+                self._stopHelper()
+                raise btle.BTLEDisconnectError('Device disconnected', resp)
+            if resp_type == 'err':
+                if resp['code'][0] == 'atterr':
+                    raise btle.BTLEGattError('Bluetooth command failed',
+                                             resp)
+                raise btle.BTLEException('Error from bluepy-helper (%s)' %
+                                         resp['code'][0], resp)
+            raise btle.BTLEInternalError('Unexpected response (%s)' %
+                                         resp_type, resp)
+
+    @staticmethod
+    def _err(code='atterr'):
+        return {'rsp': ['err'], 'code': [code]}
+
+    @staticmethod
+    def _stat(state='conn', **kwargs):
+        resp = {'rsp': ['stat'], 'state': [state]}
+        resp.update({k: [v] for (k, v) in kwargs.items()})
+        return resp
+
+    @staticmethod
+    def _find(**kwargs):
+        resp = {'rsp': ['find']}
+        resp.update(kwargs)
+        return resp
+
+    @staticmethod
+    def _range(start, end):
+        return (int(start, 16), int(end, 16))
+
+    def _cmd_conn(self, addr, addr_type, iface=None):
+        with self.lock:
+            if FakePeripheral.fail_conn > 0:
+                FakePeripheral.fail_conn -= 1
+                return self._stat('disc')
+        return self._stat('conn')
+
+    def _cmd_disc(self):
+        return self._stat('disc')
+
+    def _cmd_stat(self):
+        return self._stat('conn')
+
+    def _cmd_mtu(self, mtu):
+        return self._stat('conn', mtu=min(int(mtu, 16), self.db.mtu))
+
+    def _cmd_svcs(self, uuid=None):
+        svcs = [s for s in self.db.svcs
+                if uuid is None or s[0] == btle.UUID(uuid)]
+        if len(svcs) == 0:
+            return self._err()
+        return self._find(uuid=[str(s[0]) for s in svcs],
+                          hstart=[s[1] for s in svcs],
+                          hend=[s[2] for s in svcs])
+
+    def _cmd_char(self, start, end, uuid=None):
+        (start, end) = self._range(start, end)
+        charas = [c for c in self.db.charas
+                  if start <= c[1] <= end and
+                  (uuid is None or c[0] == btle.UUID(uuid))]
+        if len(charas) == 0:
+            return self._err()
+        return self._find(uuid=[str(c[0]) for c in charas],
+                          hnd=[c[1] for c in charas],
+                          props=[c[2] for c in charas],
+                          vhnd=[c[3] for c in charas])
+
+    def _cmd_desc(self, start, end):
+        (start, end) = self._range(start, end)
+        descs = [d for d in self.db.descs if start <= d[1] <= end]
+        if len(descs) == 0:
+            return self._err()
+        return {'rsp': ['desc'], 'uuid': [str(d[0]) for d in descs],
+                'hnd': [d[1] for d in descs]}
+
+    def _cmd_rd(self, hnd):
+        val = self.db.values.get(int(hnd, 16))
+        if val is None:
+            return self._err()
+        return {'rsp': ['rd'], 'd': [val]}
+
+    def _cmd_rdu(self, uuid, start, end):
+        (start, end) = self._range(start, end)
+        hnds = [c[3] for c in self.db.charas
+                if start <= c[1] <= end and c[0] == btle.UUID(uuid) and
+                c[3] in self.db.values]
+        if len(hnds) == 0:
+            return self._err()
+        return {'rsp': ['rd'], 'hnd': hnds,
+                'd': [self.db.values[h] for h in hnds]}
+
+    def _cmd_wr(self, hnd, val):
+        hnd = int(hnd, 16)
+        if hnd not in self.db.values:
+            return self._err()
+        self.db.values[hnd] = bytes.fromhex(val)
+
+        # CCCD: send the queued indications
+        if bytes.fromhex(val) == b'\x02\x00':
+            for (ind_hnd, data) in self.indications:
+                self._rsp.append({'rsp': ['ind'], 'hnd': [ind_hnd],
+                                  'd': [data]})
+            self.indications = []
+        return {'rsp': ['wr']}
+
+    _cmd_wrr = _cmd_wr
+
+
+class FakeDev:
+    '''
+    btle.ScanEntry compatible
+    '''
+    def __init__(self, addr, raw=b'\x02\x01\x06', addr_type='public',
+                 rssi=-60, connectable=True, scan_data=None):
+        self.addr = addr
+        self.addrType = addr_type
+        self.rssi = rssi
+        self.connectable = connectable
+        self.rawData = raw
+        self.iface = 0
+        self.updateCount = 1
+        self.scanData = {}
+        for data in (raw, scan_data or b''):
+            i = 0
+            while i + 1 < len(data) and data[i] > 0:
+                self.scanData[data[i + 1]] = data[i + 2:i + 1 + data[i]]
+                i += data[i] + 1
+
+    getScanData = btle.ScanEntry.getScanData
+    getValueText = btle.ScanEntry.getValueText
+    getValue = btle.ScanEntry.getValue
+    getDescription = btle.ScanEntry.getDescription
+    _decodeUUIDlist = btle.ScanEntry._decodeUUIDlist
+    _decodeUUID = btle.ScanEntry._decodeUUID
+    dataTags = btle.ScanEntry.dataTags
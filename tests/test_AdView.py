@@ -0,0 +1,49 @@
+#
+# (c) 2020 Yoichi Tanibayashi
+#
+import pytest
+
+pytest.importorskip('bluepy')
+
+from fake_btle import FakeDev  # noqa: E402
+from AdParser import AdParser  # noqa: E402
+from AdView import AdView      # noqa: E402
+
+UUID128 = '6e400001-b5a3-f393-e0a9-e50e24dcca9e'
+RAW = bytes.fromhex(
+    '020106'                                 # Flags
+    '05030f180a18'                           # 180f, 180a
+    '1107' + bytes.fromhex(UUID128.replace('-', ''))[::-1].hex() +
+    '0716e1ff01020304'                       # ffe1: 01020304
+    '05ff4c000215'                           # Apple
+    '08094d794553503332')                    # 'MyESP32'
+
+
+def test_same_as_scan_entry():
+    dev = FakeDev('aa:bb:cc:dd:ee:ff', RAW)
+    view = AdView.of(dev)
+
+    assert sorted(view.types()) == sorted(dev.scanData.keys())
+    for ad_type in view.types():
+        assert view.text(ad_type) == dev.getValueText(ad_type)
+
+
+def test_decoded():
+    view = AdView(RAW)
+
+    assert view.name == 'MyESP32'
+    assert view.flags == 0x06
+    assert view.manufacturer == (0x004c, b'\x02\x15')
+    assert view.service_uuids() == [
+        '0000180f-0000-1000-8000-00805f9b34fb',
+        '0000180a-0000-1000-8000-00805f9b34fb', UUID128]
+    assert view.service_data() == {
+        '0000ffe1-0000-1000-8000-00805f9b34fb': b'\x01\x02\x03\x04'}
+
+
+def test_fallback():
+    # the name in the last scan response
+    view = AdView(RAW[:3], {AdParser.COMPLETE_LOCAL_NAME: b'Rsp'})
+    assert view.flags == 0x06
+    assert view.name == 'Rsp'
+    assert view.service_uuids() == []
@@ -0,0 +1,98 @@
+#
+# (c) 2020 Yoichi Tanibayashi
+#
+import os
+import time
+import pytest
+
+pytest.importorskip('bluepy')
+pytest.importorskip('pyarrow')
+
+from AdvArchive import AdvArchiveWriter, AdvArchiveReader  # noqa: E402
+
+ADDR = 'ac:23:3f:a0:01:02'
+
+
+def test_idle_flush(tmp_path):
+    root = str(tmp_path)
+    writer = AdvArchiveWriter(root, flush_interval=0.2)
+
+    now = time.time()
+    writer.write(now, ADDR, 0, -60, 0, b'\x02\x01\x06')
+    writer.write(now + 0.01, ADDR, 0, -61, 0, b'\x02\x01\x06')
+    assert writer.stat['row_group'] == 0
+
+    # flushed without another write
+    time.sleep(0.5)
+    assert writer.stat['row_group'] == 1
+
+    writer.close()
+    assert not writer._flusher.is_alive()
+    assert writer.stat == {'row_group': 1, 'file': 1}
+
+    recs = list(AdvArchiveReader(root).records(addrs=[ADDR]))
+    assert [r.rssi for r in recs] == [-60, -61]
+
+
+def test_files(tmp_path):
+    root = str(tmp_path)
+    writer = AdvArchiveWriter(root)
+    writer.write(1600000000.0, ADDR, 0, -60, 0, b'')
+    writer.close()
+
+    # files() before any query
+    reader = AdvArchiveReader(root)
+    assert len(reader.files()) == 1
+    assert reader.stat['partition'] == 1
+
+    assert reader.files(start=1600000000.0 + 10) == []
+    assert reader.stat['pruned_file'] == 1
+    assert os.path.basename(reader.files()[0]).startswith('1600000000000-')
+
+
+def test_roll(tmp_path):
+    root = str(tmp_path)
+    writer = AdvArchiveWriter(root, batch=2, flush_interval=3600,
+                              roll_row_groups=2)
+
+    # 3 row groups in the same partition
+    ts = 1600000000.0
+    for i in range(6):
+        writer.write(ts + i, ADDR, 0, -60 - i, 0, b'')
+    assert writer.stat == {'row_group': 3, 'file': 1}
+
+    # closed file is queried before close()
+    reader = AdvArchiveReader(root)
+    assert len(reader.files()) == 1
+    assert [r.rssi for r in reader.records()] == [-60, -61, -62, -63]
+
+    writer.close()
+    assert writer.stat == {'row_group': 3, 'file': 2}
+    assert len(reader.files()) == 2
+    assert [r.rssi for r in reader.records(start=ts + 3)] == [-63, -64, -65]
+
+
+def test_roll_interval(tmp_path):
+    root = str(tmp_path)
+    writer = AdvArchiveWriter(root, flush_interval=0.1, roll_interval=0.2)
+
+    writer.write(time.time(), ADDR, 0, -60, 0, b'')
+
+    # closed without another write
+    time.sleep(0.6)
+    assert writer.stat == {'row_group': 1, 'file': 1}
+    assert len(AdvArchiveReader(root).files()) == 1
+    writer.close()
+    assert writer.stat == {'row_group': 1, 'file': 1}
+
+
+def test_roll_same_time(tmp_path):
+    root = str(tmp_path)
+    writer = AdvArchiveWriter(root, flush_interval=0, roll_row_groups=1)
+    for rssi in (-60, -61):
+        writer.write(1600000000.0, ADDR, 0, rssi, 0, b'')
+    writer.close()
+
+    reader = AdvArchiveReader(root)
+    assert len(reader.files()) == 2
+    assert sorted([r.rssi for r in reader.records()]) == [-61, -60]
@@ -0,0 +1,59 @@
+#
+# (c) 2020 Yoichi Tanibayashi
+#
+import pytest
+
+pytest.importorskip('bluepy')
+
+from AdvEntry import AdvEntry    # noqa: E402
+from AdvFilter import AdvFilter  # noqa: E402
+
+ADDR = 'aa:bb:cc:dd:ee:ff'
+ADV_IND = bytes.fromhex('020106' '03030f18')         # Flags, 180f
+SCAN_RSP = bytes.fromhex('08094d794553503332')       # 'MyESP32'
+
+
+def adv_entry(*packets):
+    dev = AdvEntry(ADDR)
+    for (adv_type, data) in packets:
+        dev.update(0, -60, adv_type, data)
+    return dev
+
+
+@pytest.mark.parametrize('packets', [
+    [(AdvEntry.ADV_IND, ADV_IND), (AdvEntry.SCAN_RSP, SCAN_RSP)],
+    [(AdvEntry.SCAN_RSP, SCAN_RSP), (AdvEntry.ADV_IND, ADV_IND)],
+])
+def test_other_packet(packets):
+    dev = adv_entry(*packets)
+
+    for f in (AdvFilter(names=['MyESP*']), AdvFilter(uuids=['180f'])):
+        assert f.match_dev(dev)
+
+    # the last packet only
+    f = AdvFilter(names=['MyESP*'])
+    assert f.match(dev.addr, dev.rawData) == (dev.rawData == SCAN_RSP)
+
+
+def test_no_match():
+    dev = adv_entry((AdvEntry.ADV_IND, ADV_IND),
+                    (AdvEntry.SCAN_RSP, SCAN_RSP))
+    f = AdvFilter(names=['Other*'], uuids=['180a'], companies=[0x004c])
+    assert not f.match_dev(dev)
+    assert f.stat == {'match': 0, 'reject': 1}
+
+
+@pytest.mark.parametrize('uuid', [
+    '180f', 0x180f, '0000180f', '0000180F-0000-1000-8000-00805F9B34FB'])
+def test_uuid_forms(uuid):
+    f = AdvFilter(uuids=[uuid])
+    for raw in ('03030f18',                                   # 16 bit
+                '05050f180000',                               # 32 bit
+                '1107fb349b5f80000080001000000f180000'):      # 128 bit
+        assert f.match(ADDR, bytes.fromhex(raw))
+    assert not f.match(ADDR, bytes.fromhex('03030a18'))
+
+
+def test_invalid_uuid():
+    with pytest.raises(ValueError):
+        AdvFilter(uuids=['0000180f00'])
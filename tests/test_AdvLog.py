@@ -0,0 +1,27 @@
+#
+# (c) 2020 Yoichi Tanibayashi
+#
+import pytest
+
+pytest.importorskip('bluepy')
+
+from AdvLog import AdvLog, AdvLogWriter, AdvLogReader  # noqa: E402
+
+
+def test_random_addresses(tmp_path, monkeypatch):
+    monkeypatch.setattr(AdvLog, 'MAX_ADDRS', 8)
+    path = str(tmp_path / 'adv.log')
+
+    recs = [(1000.0 + i, '7a:00:00:00:%02x:%02x' % (i >> 8, i & 0xff),
+             1, -60, 3, b'\x02\x01\x06') for i in range(100)]
+    recs.append((2000.0, recs[-1][1], 1, -61, 3, b''))
+
+    writer = AdvLogWriter(path)
+    for rec in recs:
+        writer.write(*rec)
+    writer.close()
+
+    # the address cache is bounded
+    assert len(writer._raw_addr) == 8
+
+    assert [tuple(r) for r in AdvLogReader(path)] == recs
@@ -0,0 +1,50 @@
+#
+# (c) 2020 Yoichi Tanibayashi
+#
+import pytest
+
+pytest.importorskip('bluepy')
+
+from AdvEntry import AdvEntry  # noqa: E402
+from BleScan import BleScan    # noqa: E402
+
+ADDR = 'aa:bb:cc:dd:ee:ff'
+ADV_IND = bytes.fromhex('020106' '03030f18')   # Flags, 180f
+
+
+class FakeScanner:
+    '''
+    an ADV_IND without scan response in each scan window
+    '''
+    def __init__(self):
+        self.delegate = None
+        self.scanned = {}
+
+    def withDelegate(self, delegate):
+        self.delegate = delegate
+        return self
+
+    def packet(self):
+        dev = AdvEntry(ADDR)
+        dev.update(0, -60, AdvEntry.ADV_IND, ADV_IND)
+        self.delegate.handleDiscovery(dev, True, True)
+        return dev
+
+    def scan(self, timeout=10, passive=False):
+        return [self.packet()]
+
+
+def test_flush_at_scan_end():
+    scanner = FakeScanner()
+    ble_scan = BleScan(addrs=[ADDR], scan_timeout=1, scanner=scanner,
+                       merge=10)
+
+    ble_scan.scan()
+    assert ble_scan._merger.stat['timeout'] == 1
+    assert [d.addr for d in ble_scan.devs] == [ADDR]
+
+    # pending at the end
+    scanner.packet()
+    assert ble_scan._merger.stat['timeout'] == 1
+    ble_scan.end()
+    assert ble_scan._merger.stat['timeout'] == 2
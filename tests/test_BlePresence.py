@@ -0,0 +1,131 @@
+#
+# (c) 2020 Yoichi Tanibayashi
+#
+import time
+import pytest
+
+pytest.importorskip('bluepy')
+
+from AdvEntry import AdvEntry                      # noqa: E402
+from BlePresence import BlePresence, Ewma, Kalman  # noqa: E402
+from BleScan import BleScan                        # noqa: E402
+
+ADDR = 'aa:bb:cc:dd:ee:ff'
+
+
+class Events:
+    def __init__(self):
+        self.events = []
+
+    def __call__(self, event, rec):
+        self.events.append((event, rec.addr))
+
+    def names(self):
+        return [e for (e, _) in self.events]
+
+
+def test_ewma():
+    f = Ewma(alpha=0.5)
+    assert [f.update(x) for x in (-60, -70, -70)] == [-60, -65, -67.5]
+
+
+def test_kalman():
+    f = Kalman(q=0.05, r=4.0)
+    assert f.update(-60) == -60
+
+    # an outlier moves the value less than the raw RSSI, and the
+    # estimate gets more certain with each measurement
+    p = f.p
+    v = f.update(-80)
+    assert -80 < v < -60
+    assert f.p < p
+
+    for _ in range(50):
+        v = f.update(-70)
+    assert abs(v - -70) < 1.0
+
+
+def test_hysteresis():
+    events = Events()
+    presence = BlePresence(events, alpha=1.0, near_rssi=-60, far_rssi=-70)
+
+    for (t, rssi) in enumerate((-65, -55, -65, -69, -72, -65, -58)):
+        presence.update(ADDR, rssi, now=1000.0 + t)
+    assert events.names() == ['enter', 'near', 'far', 'near']
+
+
+def test_kalman_smoothing():
+    events = Events()
+    presence = BlePresence(events, smoothing='kalman',
+                           near_rssi=-60, far_rssi=-70)
+
+    # a single strong packet is not 'near'
+    for (t, rssi) in enumerate((-75, -75, -75, -50, -75)):
+        presence.update(ADDR, rssi, now=1000.0 + t)
+    assert events.names() == ['enter']
+
+
+def test_leave_check():
+    events = Events()
+    presence = BlePresence(events, leave_timeout=10)
+    presence.update(ADDR, -60, now=1000.0)
+    presence.update('aa:bb:cc:dd:ee:01', -60, now=1005.0)
+
+    presence.check(now=1012.0)
+    assert events.events[-1] == ('leave', ADDR)
+    assert len(presence) == 1
+
+    presence.check(now=1016.0)
+    assert events.names().count('leave') == 2
+    assert len(presence) == 0
+
+
+def test_leave_thread():
+    events = Events()
+    presence = BlePresence(events, leave_timeout=0.1)
+    presence.start(0.02)
+    presence.update(ADDR, -65)
+
+    time.sleep(0.3)
+    presence.stop()
+    assert events.names() == ['enter', 'leave']
+
+
+class FakeScanner:
+    '''
+    an advertisement of ADDR in the first scan window only
+    '''
+    def __init__(self):
+        self.delegate = None
+        self.scanned = {}
+        self.count = 0
+
+    def withDelegate(self, delegate):
+        self.delegate = delegate
+        return self
+
+    def scan(self, timeout=10, passive=False):
+        self.count += 1
+        if self.count > 1:
+            time.sleep(0.2)
+            return []
+
+        dev = AdvEntry(ADDR)
+        dev.update(0, -50, AdvEntry.ADV_IND, b'\x02\x01\x06')
+        self.delegate.handleDiscovery(dev, True, True)
+        return [dev]
+
+
+def test_scan_leave():
+    events = Events()
+    presence = BlePresence(events, leave_timeout=0.1)
+    ble_scan = BleScan(addrs=[ADDR], scan_timeout=1, scanner=FakeScanner(),
+                       presence=presence)
+
+    ble_scan.scan()
+    assert events.names() == ['enter', 'near']
+
+    # no advertisement in the next window
+    ble_scan.scan()
+    assert events.names() == ['enter', 'near', 'leave']
+    ble_scan.end()
@@ -0,0 +1,43 @@
+#
+# (c) 2020 Yoichi Tanibayashi
+#
+import pytest
+from BleRetry import CircuitBreaker, RetryPolicy
+from BleRetry import RetryError, CircuitOpenError
+
+
+def test_breaker_open():
+    breaker = CircuitBreaker(threshold=2, reset_timeout=60)
+    for _ in range(2):
+        assert breaker.allow('a')
+        breaker.failure('a')
+    assert breaker.is_open('a')
+    assert not breaker.allow('a')
+
+    breaker.success('a')
+    assert not breaker.is_open('a')
+    assert len(breaker) == 0
+
+
+def test_breaker_bounded():
+    breaker = CircuitBreaker(threshold=1, max_size=8)
+    addrs = ['7a:00:00:00:00:%02x' % i for i in range(100)]
+    for addr in addrs:
+        breaker.failure(addr)
+
+    assert len(breaker) == 8
+    assert len(breaker._open_at) == 8
+    assert breaker.is_open(addrs[-1])
+    assert not breaker.is_open(addrs[0])
+
+
+def test_policy_circuit_open():
+    def fail():
+        raise OSError('fail')
+
+    policy = RetryPolicy('Test', retry=2, rules={OSError: 0.001},
+                         breaker=CircuitBreaker(threshold=1))
+    with pytest.raises(RetryError):
+        policy.call(fail, key='a')
+    with pytest.raises(CircuitOpenError):
+        policy.call(fail, key='a')
@@ -0,0 +1,81 @@
+#
+# (c) 2020 Yoichi Tanibayashi
+#
+import time
+import pytest
+
+pytest.importorskip('bluepy')
+
+from fake_btle import FakeGatt, FakePeripheral  # noqa: E402
+from BleScan2 import BleScan                    # noqa: E402
+from NameCache import NameCache                 # noqa: E402
+
+ADDR = 'aa:bb:cc:dd:ee:ff'
+
+
+@pytest.fixture
+def ble_scan(monkeypatch):
+    monkeypatch.setattr(BleScan, 'CONN_RETRY_BASE', 0.01)
+    FakePeripheral.setup(FakeGatt([
+        ('1800', [('2a00', b'MyESP32'), ('2a01', b'\x00\x00')]),
+    ]))
+    return BleScan(conn_svc=2, peripheral=FakePeripheral)
+
+
+def test_read_name(ble_scan):
+    assert ble_scan.read_name(ADDR) == 'MyESP32'
+    assert FakePeripheral.count('char') == 1
+
+
+def test_read_name_no_device_name(ble_scan):
+    FakePeripheral.setup(FakeGatt([('180f', [('2a19', b'\x64')])]))
+    assert ble_scan.read_name(ADDR) is None
+
+
+def test_read_name_retry(ble_scan):
+    FakePeripheral.fail_conn = 1
+    assert ble_scan.read_name(ADDR) == 'MyESP32'
+
+    FakePeripheral.fail_conn = 2
+    assert ble_scan.read_name(ADDR) is None
+    assert FakePeripheral.count('conn') == 4
+
+
+def test_read_name_bug(ble_scan):
+    # not a bluetooth error: not retried
+    def broken(*args, **kwargs):
+        broken.count += 1
+        raise TypeError('bug')
+    broken.count = 0
+
+    ble_scan._peripheral = broken
+    with pytest.raises(TypeError):
+        ble_scan.read_name(ADDR)
+    assert broken.count == 1
+
+
+def test_refresh_failed(tmp_path):
+    path = str(tmp_path / 'names.json')
+    cache = NameCache(path, ttl=10, neg_ttl=100)
+    cache.put(ADDR, 'MyESP32')
+    cache._cache[ADDR]['time'] -= 20
+    assert cache.get(ADDR) == ('MyESP32', False)
+
+    calls = []
+
+    def resolve(addr, addr_type):
+        calls.append(addr)
+        return None
+
+    cache.refresh(resolve).join()
+    assert calls == [ADDR]
+
+    # the name is kept, and not tried again in the next run
+    cache = NameCache(path, ttl=10, neg_ttl=100)
+    assert cache.get(ADDR) == ('MyESP32', True)
+    assert cache.refresh(resolve) is None
+    assert calls == [ADDR]
+
+    # tried again after neg_ttl
+    cache._cache[ADDR]['fail'] = time.time() - 200
+    assert cache.get(ADDR) == ('MyESP32', False)
@@ -0,0 +1,62 @@
+#
+# (c) 2020 Yoichi Tanibayashi
+#
+import pytest
+
+pytest.importorskip('bluepy')
+
+from fake_btle import FakeGatt, FakePeripheral, FakeDev  # noqa: E402
+from BleScan import BleScan                               # noqa: E402
+from BleScanPool import BleScanPool                       # noqa: E402
+
+N_DEVS = 8
+CONCURRENCY = 4
+
+
+@pytest.fixture
+def ble_scan():
+    db = FakeGatt([
+        ('1800', [('2a00', b'Fake'), ('2a01', b'\x00\x00')]),
+        ('180f', [('2a19', b'\x64')]),
+    ])
+    FakePeripheral.setup(db, latency=0.01, conn_latency=0.1)
+    ble_scan = BleScan(peripheral=FakePeripheral, conn_svc=1)
+    yield ble_scan
+    ble_scan.end()
+
+
+def devs():
+    return [FakeDev('aa:bb:cc:dd:ee:%02x' % i) for i in range(N_DEVS)]
+
+
+def test_interrogate(ble_scan):
+    report = BleScanPool(ble_scan).interrogate(devs())
+
+    assert len(report['devs']) == N_DEVS
+    for d in report['devs']:
+        assert d['result'] == 'OK'
+        assert [c['value'] for s in d['svcs'] for c in s['charas']] == \
+            [b'Fake', b'\x00\x00', b'\x64']
+
+
+def test_pool_concurrency(ble_scan):
+    for d in devs():
+        assert ble_scan.dev_info(d, dev_data=False) == 'OK'
+    assert FakePeripheral.peak == 1
+
+    pool = BleScanPool(ble_scan, concurrency=CONCURRENCY)
+    report = pool.interrogate(devs())
+    assert [d['result'] for d in report['devs']] == ['OK'] * N_DEVS
+
+    # connections overlap up to the concurrency, and are all closed
+    assert FakePeripheral.peak == CONCURRENCY
+    assert FakePeripheral.active == 0
+
+
+def test_dev_timeout(ble_scan):
+    # the deadline stops the retries, not a running connection
+    FakePeripheral.fail_conn = 100
+    pool = BleScanPool(ble_scan, dev_timeout=0.3)
+    report = pool.interrogate(devs()[:1], conn_svc=20)
+    assert report['devs'][0]['result'] == 'Timeout'
+    assert report['elapsed'] < 2.0
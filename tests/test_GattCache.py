@@ -0,0 +1,75 @@
+#
+# (c) 2020 Yoichi Tanibayashi
+#
+import pytest
+
+pytest.importorskip('bluepy')
+
+from fake_btle import FakeGatt, FakePeripheral  # noqa: E402
+from GattCache import GattCache                 # noqa: E402
+
+ADDR = 'aa:bb:cc:dd:ee:ff'
+
+
+@pytest.fixture
+def db():
+    db = FakeGatt([
+        ('1800', [('2a00', b'Fake')]),
+        ('1801', [('2a05', None, FakeGatt.PROP_INDICATE),
+                  ('2b2a', bytes(16))]),
+    ])
+    FakePeripheral.setup(db)
+    return db
+
+
+@pytest.fixture
+def gatt_cache(tmp_path, db):
+    gatt_cache = GattCache(str(tmp_path / 'gatt_cache.json'))
+    with FakePeripheral(ADDR) as p:
+        gatt_cache.put(ADDR, sorted(p.services, key=lambda s: s.hndStart))
+    return gatt_cache
+
+
+def test_cached(gatt_cache, db):
+    FakePeripheral.cmds = []
+    with FakePeripheral(ADDR) as p:
+        svcs = gatt_cache.services(p)
+
+    assert [str(s.uuid)[4:8] for s in svcs] == ['1800', '1801']
+    assert FakePeripheral.count('svcs') == 0
+    assert FakePeripheral.count('char') == 0
+
+    # Service Changed indication enabled
+    cccd = gatt_cache.get(ADDR)['sc_cccd']
+    assert cccd == db.value_handle('2a05') + 1
+    assert 'wrr %X 0200' % cccd in FakePeripheral.cmds
+
+
+def test_service_changed(gatt_cache, db):
+    with FakePeripheral(ADDR) as p:
+        p.indications = [(db.value_handle('2a05'), b'\x01\x00\xff\xff')]
+        assert gatt_cache.services(p) is None
+
+    assert gatt_cache.get(ADDR) is None
+
+
+def test_database_hash_changed(gatt_cache, db):
+    db.values[db.value_handle('2b2a')] = b'\x01' * 16
+    with FakePeripheral(ADDR) as p:
+        assert gatt_cache.services(p) is None
+
+    assert gatt_cache.get(ADDR) is None
+
+
+def test_save(tmp_path, gatt_cache):
+    # saved in close(), not on each put()
+    path = tmp_path / 'gatt_cache.json'
+    assert not path.exists()
+
+    gatt_cache.close()
+    assert GattCache(str(path)).get(ADDR)['svcs'] == \
+        gatt_cache.get(ADDR)['svcs']
+
+    gatt_cache.invalidate(ADDR)
+    gatt_cache.close()
+    assert GattCache(str(path)).get(ADDR) is None
@@ -0,0 +1,50 @@
+#
+# (c) 2020 Yoichi Tanibayashi
+#
+import pytest
+
+pytest.importorskip('bluepy')
+
+from GattDecoder import GattDecoder, ValueDecoder  # noqa: E402
+from BleScan import BleScan                        # noqa: E402
+
+
+class CountDecoder(ValueDecoder):
+    count = 0
+
+    def text(self, val):
+        CountDecoder.count += 1
+        return super().text(val)
+
+
+def test_name():
+    decoder = GattDecoder(BleScan.SERVICE_INDEX)
+
+    assert decoder.name('1800') == '<GeneralAccess>'
+    assert decoder.name(0x1801) == '<Generic Attribute>'
+    assert decoder.name('2a19') == 'Battery Level'
+    assert decoder.name('ffe1') is None
+
+
+def test_render_lazy():
+    decoder = GattDecoder()
+    decoder.register('2a6e', CountDecoder('Temperature', '<h', -2, 'C'))
+
+    (text, hex_str) = decoder.render('2a6e', b'\x34\x08')
+    assert CountDecoder.count == 0
+
+    assert str(text) == '21.0 C'
+    assert str(hex_str) == '<34 08>'
+    assert CountDecoder.count == 1
+
+
+def test_render():
+    decoder = GattDecoder()
+
+    (text, hex_str) = decoder.render('2a00', b'MyESP32')
+    assert (str(text), hex_str) == ('"MyESP32"', None)
+
+    # too short, and unknown
+    for uuid in ('2a6e', 'ffe1'):
+        (text, hex_str) = decoder.render(uuid, b'\x01')
+        assert (str(text), str(hex_str)) == ("b'\\x01'", '<01>')
@@ -0,0 +1,97 @@
+#
+# (c) 2020 Yoichi Tanibayashi
+#
+import socket
+import pytest
+
+pytest.importorskip('bluepy')
+
+from HciScanner import HciScanner  # noqa: E402
+
+# HCI LE Advertising Report events (recorded)
+#   ADV_IND ac:23:3f:a0:01:02 public -60 dBm: Flags, Local Name 'MyESP32'
+ADV_IND = bytes.fromhex(
+    '043e18'                # event packet, LE Meta Event, length
+    '0201'                  # Advertising Report, Num_Reports
+    '00' '00' '0201a03f23ac'
+    '0c' '020106' '08094d794553503332'
+    'c4')
+#   SCAN_RSP 11:22:33:44:55:66 random -70 dBm: 16b Service Data
+#   and ADV_NONCONN_IND of the same address, in one event
+TWO_REPORTS = bytes.fromhex(
+    '043e1f'
+    '0202'
+    '0401' '665544332211' '06' '0516e1ff0102' 'ba'
+    '0301' '665544332211' '03' '020104' 'bb')
+#   Command Complete: LE Set Scan Enable, status 0
+CMD_COMPLETE = bytes.fromhex('040e0401' '0c20' '00')
+
+ADDR1 = 'ac:23:3f:a0:01:02'
+ADDR2 = '11:22:33:44:55:66'
+
+
+class Recorder:
+    def __init__(self):
+        self.calls = []
+
+    def handleDiscovery(self, dev, isNewDev, isNewData):
+        self.calls.append((dev.addr, isNewDev, isNewData, dev.rssi))
+
+
+@pytest.fixture
+def hci():
+    (sock, peer) = socket.socketpair()
+    recorder = Recorder()
+    scanner = HciScanner(sock=sock).withDelegate(recorder)
+    yield (scanner, peer, recorder)
+    sock.close()
+    peer.close()
+
+
+def test_parse_adv_report():
+    reports = HciScanner.parse_adv_report(memoryview(ADV_IND)[3:])
+    assert reports == [
+        (0x00, 0x00, bytes.fromhex('0201a03f23ac'),
+         bytes.fromhex('020106' '08094d794553503332'), -60)]
+
+    reports = HciScanner.parse_adv_report(memoryview(TWO_REPORTS)[3:])
+    assert [(r[0], r[1], r[4]) for r in reports] == [(4, 1, -70),
+                                                      (3, 1, -69)]
+    assert reports[0][3] == bytes.fromhex('0516e1ff0102')
+
+
+def test_start_commands(hci):
+    (scanner, peer, recorder) = hci
+    scanner.start(passive=True)
+
+    cmds = peer.recv(1024)
+    # disable, parameters (passive), enable
+    assert cmds == bytes.fromhex(
+        '010c20020000'
+        '010b200700100010000000'
+        '010c20020100')
+
+
+def test_socketpair(hci):
+    (scanner, peer, recorder) = hci
+    scanner.start()
+    peer.recv(1024)
+
+    # split in the middle of a packet, as recv() may return
+    data = CMD_COMPLETE + ADV_IND + TWO_REPORTS
+    peer.sendall(data[:20])
+    scanner.process(0.1)
+    peer.sendall(data[20:])
+    scanner.process(0.1)
+
+    assert recorder.calls == [
+        (ADDR1, True, True, -60),
+        (ADDR2, True, True, -70),
+        (ADDR2, False, True, -69),
+    ]
+
+    devs = {d.addr: d for d in scanner.getDevices()}
+    assert set(devs) == {ADDR1, ADDR2}
+    assert devs[ADDR1].getValueText(9) == 'MyESP32'
+    assert devs[ADDR1].addrType == 'public'
+    assert devs[ADDR2].addrType == 'random'
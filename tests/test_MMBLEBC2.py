@@ -0,0 +1,35 @@
+#
+# (c) 2020 Yoichi Tanibayashi
+#
+import pytest
+
+pytest.importorskip('bluepy')
+
+from fake_btle import FakeDev    # noqa: E402
+from MMBLEBC2 import MMBLEBC2    # noqa: E402
+
+ADDR = 'ac:23:3f:a0:01:02'
+
+# Flags, 16b Service Data ffe1: frame a1, ver 01, batt 92 %,
+# temp 26.5 C, humidity 45.0 %, MAC
+RAW = bytes.fromhex('020106' '1016e1ffa1015c1a802d000201a03f23ac')
+
+
+def test_decode():
+    bledev = MMBLEBC2(scanner=object())
+    reading = bledev.decode(FakeDev(ADDR, RAW, rssi=-70))
+
+    assert reading['addr'] == ADDR
+    assert reading['rssi'] == -70
+    assert reading['batt'] == 92
+    assert reading['temp'] == 26.5
+    assert reading['humidity'] == 45.0
+    assert reading['raw'] == ('5c', '1a80', '2d00')
+
+
+def test_decode_other():
+    bledev = MMBLEBC2(scanner=object())
+
+    # other vendor, and too short
+    assert bledev.decode(FakeDev('aa:bb:cc:dd:ee:ff', RAW)) is None
+    assert bledev.decode(FakeDev(ADDR, RAW[:12])) is None
@@ -0,0 +1,49 @@
+#
+# (c) 2020 Yoichi Tanibayashi
+#
+import pytest
+
+pytest.importorskip('bluepy')
+
+from AdvLog import AdvLogWriter  # noqa: E402
+from MultiScan import MultiScan  # noqa: E402
+
+ADDR1 = 'ac:23:3f:a0:01:02'
+ADDR2 = 'ac:23:3f:a0:01:03'
+DATA = b'\x02\x01\x06\x05\x09ABCD'
+
+
+def write_log(path, recs):
+    writer = AdvLogWriter(str(path))
+    for rec in recs:
+        writer.write(*rec)
+    writer.close()
+    return str(path)
+
+
+@pytest.mark.parametrize('mp_context', [None, 'spawn', 'forkserver'])
+def test_replay_merge(tmp_path, mp_context):
+    log0 = write_log(tmp_path / 'hci0.log',
+                     [(1000.0, ADDR1, 0, -50, 0, DATA),
+                      (1000.1, ADDR2, 0, -80, 0, DATA)])
+    log1 = write_log(tmp_path / 'hci1.log',
+                     [(1000.0, ADDR1, 0, -70, 0, DATA)])
+
+    multi = MultiScan(hcis=(0, 1), backend='replay', replay=(log0, log1),
+                      speed=0, dedup_window=1.0, mp_context=mp_context)
+    multi.start()
+    try:
+        adverts = list(multi.adverts(timeout=10))
+    finally:
+        multi.stop()
+
+    seen = {adv.dev.addr: adv.seen for adv in adverts}
+    assert seen == {ADDR1: {0: -50, 1: -70}, ADDR2: {0: -80}}
+    assert multi.stat['record'] == 3
+    assert multi.stat['merged'] == 1
+
+    # the strongest adapter is used for the connection
+    dev = multi.devs.get(ADDR1).dev
+    assert dev.iface == 0 and dev.rssi == -50
+    assert multi.pick_hci(ADDR1) == 0
+    assert multi.pick_hci(ADDR2) == 0
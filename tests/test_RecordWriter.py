@@ -0,0 +1,39 @@
+#
+# (c) 2020 Yoichi Tanibayashi
+#
+import io
+import json
+import time
+from RecordWriter import RecordWriter
+
+
+def test_idle_flush():
+    out = io.BytesIO()
+    writer = RecordWriter(out, 'jsonl', flush_interval=0.2)
+
+    writer.write({'type': 'adv', 'addr': 'aa:bb:cc:dd:ee:01'})
+    writer.write({'type': 'adv', 'addr': 'aa:bb:cc:dd:ee:02',
+                  'data': b'\x02\x01\x06'})
+    assert out.getvalue() == b''
+
+    # flushed without another write
+    time.sleep(0.5)
+    lines = out.getvalue().splitlines()
+    assert len(lines) == 2
+    assert json.loads(lines[1])['data'] == '020106'
+
+    writer.close()
+    assert not writer._flusher.is_alive()
+    assert writer.stat['record'] == 2
+
+
+def test_batch():
+    out = io.BytesIO()
+    writer = RecordWriter(out, 'jsonl', flush_interval=60, batch=3)
+    for i in range(7):
+        writer.write({'i': i})
+    assert len(out.getvalue().splitlines()) == 6
+
+    writer.close()
+    assert [json.loads(line)['i'] for line in out.getvalue().splitlines()] \
+        == list(range(7))
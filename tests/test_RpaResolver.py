@@ -0,0 +1,176 @@
+#
+# (c) 2020 Yoichi Tanibayashi
+#
+import pytest
+
+pytest.importorskip('bluepy')
+
+from AdvEntry import AdvEntry                           # noqa: E402
+from AdvFilter import AdvFilter                         # noqa: E402
+from BleScan import BleScan                             # noqa: E402
+from DevTable import DevTable                           # noqa: E402
+import RpaResolver as rpa                               # noqa: E402
+from RpaResolver import RpaResolver, Aes128             # noqa: E402
+
+# FIPS-197 Appendix C.1
+AES_KEY = bytes.fromhex('000102030405060708090a0b0c0d0e0f')
+AES_PLAIN = bytes.fromhex('00112233445566778899aabbccddeeff')
+AES_CIPHER = bytes.fromhex('69c4e0d86a7b0430d8cdb78070b4c55a')
+
+# Core spec Vol 3, Part H, D.7 (ah)
+IRK = 'ec0234a357c8ad05341010a60a397d9b'
+RPA = '70:81:94:0d:fb:aa'
+IDENTITY = 'c0:11:22:33:44:55'
+
+OTHER_IRK = '00112233445566778899aabbccddeeff'
+
+
+def rpa_of(resolver, prand):
+    '''
+    a resolvable private address of IRK
+    '''
+    (_, aes) = resolver._keys[0]
+    hash_ = resolver.ah(aes, bytes.fromhex(prand))
+    return ':'.join(['%02x' % b for b in bytes.fromhex(prand) + hash_])
+
+
+def adv(addr):
+    dev = AdvEntry(addr)
+    dev.update(0, -50, AdvEntry.ADV_IND, b'\x02\x01\x06')
+    return dev
+
+
+def test_aes128():
+    assert Aes128(AES_KEY).encrypt(AES_PLAIN) == AES_CIPHER
+
+    with pytest.raises(ValueError):
+        Aes128(AES_KEY[:15])
+
+
+def test_crypto_aes128():
+    pytest.importorskip('cryptography')
+
+    assert rpa.CryptoAes128(AES_KEY).encrypt(AES_PLAIN) == AES_CIPHER
+
+
+@pytest.mark.parametrize('aes_class', ['Aes128', 'CryptoAes128'])
+def test_ah(aes_class):
+    if aes_class == 'CryptoAes128':
+        pytest.importorskip('cryptography')
+
+    aes = getattr(rpa, aes_class)(bytes.fromhex(IRK))
+    ah = RpaResolver().ah(aes, bytes.fromhex('708194'))
+    assert ah == bytes.fromhex('0dfbaa')
+
+
+def test_resolve():
+    resolver = RpaResolver({'other': OTHER_IRK, IDENTITY: IRK})
+    assert len(resolver) == 2
+    assert RpaResolver.is_rpa(RPA)
+
+    assert resolver.resolve(RPA) == IDENTITY
+
+    # hash mismatch, not an RPA, invalid address
+    assert resolver.resolve('70:81:94:0d:fb:ab') is None
+    assert resolver.resolve('c0:81:94:0d:fb:aa') is None
+    assert resolver.resolve('70:81:94') is None
+
+    assert resolver.stat == {'hit': 0, 'miss': 4, 'resolved': 1}
+
+
+def test_cache():
+    resolver = RpaResolver({IDENTITY: IRK}, max_size=2)
+
+    assert resolver.resolve(RPA) == IDENTITY
+    assert resolver.resolve(RPA) == IDENTITY
+    assert resolver.resolve('70:81:94:0d:fb:ab') is None
+    assert resolver.resolve('70:81:94:0d:fb:ab') is None
+    assert resolver.stat == {'hit': 2, 'miss': 2, 'resolved': 1}
+
+    # the least recently used one is evicted
+    resolver.resolve('70:81:94:0d:fb:ac')
+    resolver.resolve(RPA)
+    assert resolver.stat == {'hit': 2, 'miss': 4, 'resolved': 2}
+
+    # a negative result is resolved with a new IRK
+    resolver = RpaResolver({'other': OTHER_IRK})
+    assert resolver.resolve(RPA) is None
+    resolver.add(IDENTITY, bytes.fromhex(IRK))
+    assert resolver.resolve(RPA) == IDENTITY
+
+
+def test_from_spec():
+    resolver = RpaResolver.from_spec(['C0:11:22:33:44:55=' + IRK])
+    assert resolver.resolve(RPA) == IDENTITY
+
+    for spec in (IRK, '=' + IRK, IDENTITY + '=ec02'):
+        with pytest.raises(ValueError):
+            RpaResolver.from_spec([spec])
+
+
+def test_filter():
+    resolver = RpaResolver({IDENTITY: IRK})
+    f = AdvFilter(addrs=[IDENTITY], resolver=resolver)
+
+    assert f.match_dev(adv(RPA))
+    assert f.match_dev(adv(rpa_of(resolver, '4a1234')))
+    assert not f.match_dev(adv('70:81:94:0d:fb:ab'))
+
+    # without the resolver
+    assert not AdvFilter(addrs=[IDENTITY]).match_dev(adv(RPA))
+
+
+def test_dev_table():
+    resolver = RpaResolver({IDENTITY: IRK})
+    table = DevTable()
+
+    for addr in (RPA, rpa_of(resolver, '4a1234')):
+        dev = adv(addr)
+        table.update(dev, addr=resolver.resolve(addr) or addr)
+
+    assert len(table) == 1
+    assert table.get(IDENTITY).dev.addr == rpa_of(resolver, '4a1234')
+
+
+class FakeScanner:
+    '''
+    like bluepy.btle.Scanner, the scanned devices are kept in 'scanned'
+
+    windows: [[addr, ..], ..] advertised in each scan window
+    '''
+    def __init__(self, windows):
+        self.delegate = None
+        self.scanned = {}
+        self.windows = list(windows)
+
+    def withDelegate(self, delegate):
+        self.delegate = delegate
+        return self
+
+    def scan(self, timeout=10, passive=False):
+        for addr in self.windows.pop(0):
+            is_new = addr not in self.scanned
+            dev = self.scanned.setdefault(addr, adv(addr))
+            self.delegate.handleDiscovery(dev, is_new, True)
+        return list(self.scanned.values())
+
+
+def test_scan():
+    resolver = RpaResolver({IDENTITY: IRK})
+    rpa2 = rpa_of(resolver, '4a1234')
+    scanner = FakeScanner([[RPA, '70:81:94:0d:fb:ab'], [rpa2]])
+    ble_scan = BleScan(addrs=[IDENTITY], scan_timeout=1, scanner=scanner,
+                       resolver=resolver)
+
+    ble_scan.scan()
+    assert ble_scan.dev_table.get(IDENTITY).dev.addr == RPA
+    assert [d.addr for d in ble_scan.devs] == [RPA]
+    assert '70:81:94:0d:fb:ab' in ble_scan.dev_table
+
+    # a new private address of the identity: the old one is forgotten
+    ble_scan.scan()
+    assert len(ble_scan.dev_table) == 2
+    assert [d.addr for d in ble_scan.devs] == [rpa2]
+    assert RPA not in scanner.scanned
+    assert rpa2 in scanner.scanned
+    ble_scan.end()
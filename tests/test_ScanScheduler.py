@@ -0,0 +1,115 @@
+#
+# (c) 2020 Yoichi Tanibayashi
+#
+import pytest
+
+btle = pytest.importorskip('bluepy.btle')
+
+from AdvEntry import AdvEntry            # noqa: E402
+from BleScan import BleScan              # noqa: E402
+from ScanScheduler import ScanScheduler  # noqa: E402
+
+ADDR = 'aa:bb:cc:dd:ee:ff'
+
+
+class FakeScanner:
+    '''
+    like bluepy.btle.Scanner: scan() stops the helper at the end,
+    except on error
+
+    fail: windows (1, 2, ..) raising BTLEException
+    '''
+    def __init__(self, fail=(), helper_on_error=True):
+        self.delegate = None
+        self.scanned = {}
+        self.fail = fail
+        self.helper_on_error = helper_on_error
+        self.calls = []
+        self._helper = None
+        self.stopped = 0
+
+    def withDelegate(self, delegate):
+        self.delegate = delegate
+        return self
+
+    def _stopHelper(self):
+        self._helper = None
+        self.stopped += 1
+
+    def scan(self, timeout=10, passive=False):
+        self.calls.append((timeout, passive))
+        self._helper = self
+
+        if len(self.calls) in self.fail:
+            if not self.helper_on_error:
+                self._helper = None
+            raise btle.BTLEException('Unexpected response (fake)')
+
+        # a new device in the first window only
+        if len(self.calls) > 1:
+            self._helper = None
+            return []
+
+        dev = AdvEntry(ADDR)
+        dev.update(0, -50, AdvEntry.ADV_IND, b'\x02\x01\x06')
+        self.delegate.handleDiscovery(dev, True, True)
+        self._helper = None
+        return [dev]
+
+
+def new_sched(scanner, window=8):
+    ble_scan = BleScan(scanner=scanner)
+    return ScanScheduler(ble_scan, window=window, min_window=2, max_window=10)
+
+
+def test_error():
+    scanner = FakeScanner(fail=(2,))
+    sched = new_sched(scanner)
+
+    assert len(sched.scan_once()) == 1
+    window = sched.window
+    assert window == 10
+
+    # the helper left running by the error is restarted
+    assert sched.scan_once() == []
+    assert sched.window == window * ScanScheduler.DECREASE
+    assert sched.metrics['errors'] == 1
+    assert sched.metrics['restarts'] == 1
+    assert scanner.stopped == 1
+    assert scanner._helper is None
+    assert sched.history[-1]['error']
+
+    # the window grows again, below the ceiling
+    sched.scan_once()
+    assert window * ScanScheduler.DECREASE < sched.window < window
+    assert sched.metrics['errors'] == 1
+
+
+def test_error_no_helper():
+    scanner = FakeScanner(fail=(1,), helper_on_error=False)
+    sched = new_sched(scanner)
+
+    sched.scan_once()
+    assert sched.metrics['errors'] == 1
+    assert sched.metrics['restarts'] == 0
+    assert scanner.stopped == 0
+
+
+def test_no_restart_without_error():
+    scanner = FakeScanner()
+    sched = new_sched(scanner)
+
+    sched.run(5)
+    assert sched.metrics['windows'] == 5
+    assert sched.metrics['restarts'] == 0
+    assert scanner.stopped == 0
+
+
+def test_passive():
+    scanner = FakeScanner()
+    sched = new_sched(scanner)
+
+    sched.run(1 + ScanScheduler.PASSIVE_AFTER + 1)
+    passive = [p for (_, p) in scanner.calls]
+    assert passive == [False] * (1 + ScanScheduler.PASSIVE_AFTER) + [True]
+    assert sched.metrics['passive']